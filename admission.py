@@ -0,0 +1,166 @@
+# admission.py by Eden Pardo
+# In-process admission control for expensive routes (bcrypt, budget creation, PYF recalculation):
+#  - per-route concurrency limits --> 503 when a route is saturated
+#  - per-user token buckets       --> 429 when one user sends too much
+# Both answer immediately with Retry-After instead of queueing behind the slow work.
+#   ADMISSION_CONTROL=0        turn it off
+import math
+import os
+import threading
+import time
+from flask import Blueprint, request, g, jsonify, current_app
+
+admission_bp = Blueprint('admission', __name__)
+
+# Max requests running at once per endpoint
+DEFAULT_ROUTE_LIMITS = {
+    "user.login": 4,                    # bcrypt checkpw
+    "user.create_user": 4,              # bcrypt hashpw
+    "budget.create_budget": 4,
+    "purchase.create_purchase": 8,      # Everything below triggers pyf_purchase_calculation
+    "purchase.update_purchase": 8,
+    "purchase.delete_purchase": 8,
+    "budget_items.add_budget_income": 8,
+    "budget_items.update_budget_income": 8,
+    "budget_items.add_budget_expense": 8,
+    "budget_items.update_budget_expense": 8,
+    "budget_items.delete_budget_expense": 8,
+    "oplog.apply_operations": 4,        # Many writes, then a recalculation per budget
+}
+
+# Token bucket per user for the same endpoints: (tokens per second, burst size)
+DEFAULT_USER_RATE = (5, 20)
+
+# Retry-After (seconds) sent with 503 responses
+SATURATED_RETRY_AFTER = 1
+
+# Drop idle buckets once there are more than this many
+BUCKET_PRUNE_SIZE = 10000
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Returns 0 if a token was taken, otherwise the seconds until one is available
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    def __init__(self, route_limits, user_rate):
+        self.route_limits = route_limits
+        self.rate, self.burst = user_rate
+        self.in_flight = {endpoint: 0 for endpoint in route_limits}
+        self.buckets = {}
+        self.rejected = {}
+        self.lock = threading.Lock()
+
+    def count_rejection(self, endpoint, reason):
+        key = f"{endpoint}:{reason}"
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+
+    # Returns None if admitted, otherwise (status, retry_after)
+    def admit(self, endpoint, user_key):
+        now = time.monotonic()
+        with self.lock:
+            if user_key is not None:
+                bucket = self.buckets.get((endpoint, user_key))
+                if bucket is None:
+                    if len(self.buckets) > BUCKET_PRUNE_SIZE:
+                        self.prune(now)
+                    bucket = self.buckets[(endpoint, user_key)] = TokenBucket(self.rate, self.burst)
+                wait = bucket.take(now)
+                if wait:
+                    self.count_rejection(endpoint, "rate_limited")
+                    return 429, wait
+
+            if self.in_flight[endpoint] >= self.route_limits[endpoint]:
+                self.count_rejection(endpoint, "overloaded")
+                return 503, SATURATED_RETRY_AFTER
+
+            self.in_flight[endpoint] += 1
+            return None
+
+    def release(self, endpoint):
+        with self.lock:
+            self.in_flight[endpoint] -= 1
+
+    # Forget buckets that have refilled completely (same as a brand new bucket)
+    def prune(self, now):
+        for key in [k for k, b in self.buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.burst]:
+            del self.buckets[key]
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "in_flight": dict(self.in_flight),
+                "limits": dict(self.route_limits),
+                "rejected": dict(self.rejected),
+                "rejected_total": sum(self.rejected.values()),
+                "tracked_users": len(self.buckets)
+            }
+
+# Who is sending the request: the user/budget in the route, the username for login/sign-up,
+# otherwise the client address
+def user_key():
+    view_args = request.view_args or {}
+    if "user_id" in view_args:
+        return f"user:{view_args['user_id']}"
+    if "budget_id" in view_args:
+        return f"budget:{view_args['budget_id']}"
+    username = (request.get_json(silent=True) or {}).get("username")
+    if isinstance(username, str) and username:
+        return f"username:{username.strip().lower()}"
+    return f"addr:{request.remote_addr}"
+
+def check_admission():
+    controller = current_app.extensions["admission"]
+    endpoint = request.endpoint
+    if endpoint not in controller.route_limits:
+        return None
+
+    rejection = controller.admit(endpoint, user_key())
+    if rejection is None:
+        g.admitted_endpoint = endpoint
+        return None
+
+    status, retry_after = rejection
+    msg = "Too many requests, slow down." if status == 429 else "Server busy, try again shortly."
+    response = jsonify({"status": "error", "msg": msg})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def release_admission(exc=None):
+    endpoint = g.pop("admitted_endpoint", None)
+    if endpoint is not None:
+        current_app.extensions["admission"].release(endpoint)
+
+# Call before the other before_request hooks so rejected requests do no work at all
+def init_admission(app):
+    app.config.setdefault("ADMISSION_CONTROL", os.environ.get("ADMISSION_CONTROL", "1") != "0")
+    app.config.setdefault("ADMISSION_ROUTE_LIMITS", DEFAULT_ROUTE_LIMITS)
+    app.config.setdefault("ADMISSION_USER_RATE", DEFAULT_USER_RATE)
+    if not app.config["ADMISSION_CONTROL"]:
+        return
+
+    app.extensions["admission"] = AdmissionController(
+        dict(app.config["ADMISSION_ROUTE_LIMITS"]), app.config["ADMISSION_USER_RATE"]
+    )
+    app.before_request(check_admission)
+    app.teardown_request(release_admission)
+
+# Rejection counters and current load
+@admission_bp.route("/api/metrics/admission", methods=["GET"])
+def admission_metrics():
+    controller = current_app.extensions.get("admission")
+    if controller is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **controller.metrics()}), 200
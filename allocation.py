@@ -0,0 +1,110 @@
+# allocation.py by Eden Pardo
+# Priority waterfall for pay-yourself-first budgets: income flows into the categories in priority
+# order (Savings first) and each category takes up to its allocated amount. Whatever is left when
+# the income runs out is the category's underfunded amount.
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, update
+from models import Budget, BudgetExpense, BudgetIncome, Category
+from money import format_money
+from extensions import db, RoutingSession
+
+# Number of (budget, items_version, income) results kept in memory
+CACHE_SIZE = 1024
+
+# Savings first, then by priority (lowest number first); id keeps equal priorities stable
+def waterfall_order(category):
+    return (not category.is_savings, category.priority, category.id)
+
+# One pass over the sorted categories. categories need id, title, allocated_amount, priority
+# and is_savings (ORM objects or rows).
+def waterfall_allocation(total_income, categories):
+    remaining = total_income
+    total_allocated = total_funded = 0
+    allocations = []
+    for category in sorted(categories, key=waterfall_order):
+        funded = max(min(category.allocated_amount, remaining), 0)
+        remaining -= funded
+        total_allocated += category.allocated_amount
+        total_funded += funded
+        allocations.append({
+            "id": category.id,
+            "title": category.title,
+            "priority": category.priority,
+            "is_savings": category.is_savings,
+            "allocated_amount": format_money(category.allocated_amount),
+            "funded": format_money(funded),
+            "underfunded": format_money(category.allocated_amount - funded),
+            "fully_funded": funded >= category.allocated_amount
+        })
+
+    return {
+        "income": format_money(total_income),
+        "categories": allocations,
+        "total_allocated": format_money(total_allocated),
+        "total_funded": format_money(total_funded),
+        "total_underfunded": format_money(total_allocated - total_funded),
+        "unallocated_income": format_money(max(remaining, 0))
+    }
+
+class AllocationCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+allocation_cache = AllocationCache(CACHE_SIZE)
+
+# Allocation for a budget, from the cache while its items_version has not changed.
+# what_if_income replaces the budget's real income (nothing is written).
+def budget_allocation(budget, what_if_income=None):
+    key = (budget.id, budget.items_version, what_if_income)
+    result = allocation_cache.get(key)
+    if result is None:
+        categories = Category.query.filter_by(budget_id=budget.id).all()
+        total_income = what_if_income
+        if total_income is None:
+            total_income = db.session.query(db.func.sum(BudgetIncome.amount)).filter_by(budget_id=budget.id).scalar() or 0
+        result = waterfall_allocation(total_income, categories)
+        allocation_cache.put(key, result)
+
+    return {
+        "budget_id": budget.id,
+        "items_version": budget.items_version,
+        "what_if": what_if_income is not None,
+        **result
+    }
+
+# Bump Budget.items_version whenever one of its categories, incomes or expenses is added, changed
+# or deleted. A plain UPDATE ... + 1 so concurrent item changes never conflict on the budget row.
+ITEM_MODELS = (Category, BudgetIncome, BudgetExpense)
+
+@event.listens_for(RoutingSession, "after_flush")
+def bump_items_version(session, flush_context):
+    budget_ids = {
+        obj.budget_id for obj in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(obj, ITEM_MODELS) and obj.budget_id is not None
+    }
+    if budget_ids:
+        session.execute(
+            update(Budget).where(Budget.id.in_(budget_ids)).values(items_version=Budget.items_version + 1),
+            execution_options={"synchronize_session": False}
+        )
+        for budget_id in budget_ids:
+            budget = session.identity_map.get(session.identity_key(Budget, budget_id))
+            if budget is not None:
+                session.expire(budget, ["items_version"])
@@ -0,0 +1,167 @@
+# anomaly.py by Eden Pardo
+# Flags purchases that are much larger than usual for their category. Amounts (integer cents) are
+# compared with a robust baseline, the median and the median absolute deviation (MAD), so a few big
+# purchases cannot hide themselves by dragging the average up:
+#   score = (amount - median) / (MAD / 0.6745)    (modified z-score)
+# When more than half of a category's amounts are equal (MAD = 0) the mean absolute deviation is used
+# instead. Purchases not linked to a category form one more group per budget.
+# Every group is scored at once: amounts are sorted by (group, amount) with one lexsort and each
+# group's median is picked by index, so the cost does not depend on the number of categories.
+# Results are cached per category and only recomputed when the category's purchases change (count,
+# total or latest change_seq differ): most analyses only run one aggregate query.
+#   ANOMALY_THRESHOLD=3.5         score above which a purchase is flagged
+#   ANOMALY_MIN_PURCHASES=5       purchases a category needs before any of them is flagged
+#   ANOMALY_CACHE_SIZE=10000      categories kept in the per-process cache
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import select, func, or_
+from models import Purchase, BudgetExpense
+from forecast_routes import to_cents_array, from_cents
+from extensions import db
+
+DEFAULT_THRESHOLD = 3.5
+DEFAULT_MIN_PURCHASES = 5
+DEFAULT_CACHE_SIZE = 10000
+
+# Turn a MAD / mean absolute deviation into a standard deviation (for normally distributed amounts)
+MAD_SCALE = 0.6745
+MEAN_AD_SCALE = 0.7979
+
+# Median of values within each group. groups are codes 0..n-1, counts the number of values per code.
+def group_medians(groups, values, counts):
+    sorted_values = values[np.lexsort((values, groups))]
+    starts = np.cumsum(counts) - counts
+    return (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+# Per group: number of amounts, median and spread (a standard deviation estimate, 0 if all are equal)
+def group_statistics(groups, amounts):
+    counts = np.bincount(groups)
+    medians = group_medians(groups, amounts, counts)
+    deviations = np.abs(amounts - medians[groups])
+    mads = group_medians(groups, deviations, counts)
+    mean_deviations = np.bincount(groups, weights=deviations) / counts
+    spreads = np.where(mads > 0, mads / MAD_SCALE, mean_deviations / MEAN_AD_SCALE)
+    return counts, medians, spreads
+
+# Flagged purchases per group: {(budget_id, category_id): [anomaly]}.
+# rows need budget_id, category_id, id, title, amount, date and budget_expense_id.
+def find_anomalies(rows, threshold=DEFAULT_THRESHOLD, min_purchases=DEFAULT_MIN_PURCHASES):
+    if not rows:
+        return {}
+    codes = {}
+    groups = np.array([codes.setdefault((row.budget_id, row.category_id), len(codes)) for row in rows], dtype=np.int64)
+    amounts = to_cents_array(row.amount for row in rows).astype(np.float64)
+
+    counts, medians, spreads = group_statistics(groups, amounts)
+    spread = spreads[groups]
+    scores = np.divide(amounts - medians[groups], spread, out=np.zeros_like(amounts), where=spread > 0)
+    flagged = np.flatnonzero((scores > threshold) & (counts[groups] >= min_purchases))
+
+    keys = list(codes)
+    anomalies = {}
+    for position in flagged:
+        row = rows[position]
+        group = groups[position]
+        anomalies.setdefault(keys[group], []).append({
+            "id": row.id,
+            "title": row.title,
+            "amount": from_cents(amounts[position]),
+            "date": row.date.strftime("%d/%m/%y") if row.date else None,
+            "budget_expense_id": row.budget_expense_id,
+            "category_id": row.category_id,
+            "typical_amount": from_cents(round(medians[group])),
+            "score": round(float(scores[position]), 2)
+        })
+    return anomalies
+
+# Most unusual first
+def rank_anomalies(anomalies):
+    return sorted(anomalies, key=lambda anomaly: (-anomaly["score"], anomaly["id"]))
+
+# Purchase columns find_anomalies needs, with the category of each purchase's expense
+def purchase_rows_query(purchases, expenses):
+    return select(
+        purchases.c.budget_id, expenses.c.category_id, purchases.c.id, purchases.c.title,
+        purchases.c.amount, purchases.c.date, purchases.c.budget_expense_id
+    ).select_from(purchases.outerjoin(expenses, expenses.c.id == purchases.c.budget_expense_id))
+
+# What the cached result of each category depends on: {category_id: (count, total, latest change_seq)}
+def purchase_fingerprints(budget_id):
+    rows = db.session.execute(
+        select(BudgetExpense.category_id, func.count(Purchase.id), func.sum(Purchase.amount), func.max(Purchase.change_seq))
+        .select_from(Purchase).outerjoin(BudgetExpense, BudgetExpense.id == Purchase.budget_expense_id)
+        .where(Purchase.budget_id == budget_id).group_by(BudgetExpense.category_id)
+    ).all()
+    return {category_id: (count, total, change_seq) for category_id, count, total, change_seq in rows}
+
+class AnomalyDetector:
+    def __init__(self, threshold=DEFAULT_THRESHOLD, min_purchases=DEFAULT_MIN_PURCHASES, cache_size=DEFAULT_CACHE_SIZE):
+        self.threshold = threshold
+        self.min_purchases = min_purchases
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # (budget_id, category_id) --> (fingerprint, anomalies)
+        self.lock = threading.Lock()
+
+    def cached(self, key, fingerprint):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None or entry[0] != fingerprint:
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def store(self, key, fingerprint, anomalies):
+        with self.lock:
+            self.cache[key] = (fingerprint, anomalies)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    # Flagged purchases of one budget, most unusual first. Only the categories whose purchases
+    # changed since the last call are loaded and scored again.
+    def budget_anomalies(self, budget_id):
+        fingerprints = purchase_fingerprints(budget_id)
+        anomalies = []
+        stale = []
+        for category_id, fingerprint in fingerprints.items():
+            if fingerprint[0] < self.min_purchases:
+                continue # Too few purchases to tell what is usual
+            found = self.cached((budget_id, category_id), fingerprint)
+            if found is None:
+                stale.append(category_id)
+            else:
+                anomalies += found
+
+        if stale:
+            category_ids = [category_id for category_id in stale if category_id is not None]
+            in_stale = BudgetExpense.category_id.in_(category_ids)
+            if None in stale:
+                in_stale = or_(in_stale, BudgetExpense.category_id.is_(None))
+            rows = db.session.execute(
+                purchase_rows_query(Purchase.__table__, BudgetExpense.__table__)
+                .where(Purchase.budget_id == budget_id, in_stale)
+            ).all()
+            fresh = find_anomalies(rows, self.threshold, self.min_purchases)
+            for category_id in stale:
+                found = fresh.get((budget_id, category_id), [])
+                self.store((budget_id, category_id), fingerprints[category_id], found)
+                anomalies += found
+
+        return rank_anomalies(anomalies)
+
+anomaly_detector = AnomalyDetector()
+
+def init_anomalies(app):
+    app.config.setdefault("ANOMALY_THRESHOLD", float(os.environ.get("ANOMALY_THRESHOLD", DEFAULT_THRESHOLD)))
+    app.config.setdefault("ANOMALY_MIN_PURCHASES", int(os.environ.get("ANOMALY_MIN_PURCHASES", DEFAULT_MIN_PURCHASES)))
+    app.config.setdefault("ANOMALY_CACHE_SIZE", int(os.environ.get("ANOMALY_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
+    anomaly_detector.threshold = app.config["ANOMALY_THRESHOLD"]
+    anomaly_detector.min_purchases = app.config["ANOMALY_MIN_PURCHASES"]
+    anomaly_detector.cache_size = app.config["ANOMALY_CACHE_SIZE"]
+    anomaly_detector.clear()
@@ -10,12 +10,33 @@ from budget_item_routes import budget_item_bp
 from category_routes import category_bp
 from purchase_routes import purchase_bp
 from pyf_budget_routes import pyf_budget_bp
+from fiftythirtytwenty_budget_routes import fiftythirtytwenty_budget_bp
+from zerobased_budget_routes import zerobased_budget_bp
+from purchase_rollups import rebuild_rollups_command, check_rollups_command
+from forecast_routes import forecast_bp
+from scenario_routes import scenario_bp
+from search_routes import search_bp, init_search, rebuild_search_command
+from pyf_batch import pyf_batch_command
+from db_routing import init_read_routing
+from migrations import run_migrations
+from sharding import init_sharding, create_shards, rebalance_shards_command
+from admission import admission_bp, init_admission
+from idempotency import init_idempotency, purge_idempotency_keys_command
+from soft_delete import init_soft_delete, purge_deleted_command
+from recurring_routes import recurring_bp, init_recurring, run_recurring_command
+from change_stream import change_stream_bp, init_change_stream
+from sync_routes import sync_bp, init_sync, prune_tombstones_command
+from dashboard_routes import dashboard_bp
+from batch_routes import batch_bp
+from oplog_routes import oplog_bp
+from anomaly import init_anomalies
+from read_paths import benchmark_reads_command
 
 import os
 
 # Flask wants to pass--> Important for relative pass
 app = Flask(__name__)
-CORS(app) # Allows requests/responses between websites
+CORS(app, expose_headers=["ETag"]) # Allows requests/responses between websites (and lets the frontend read ETags)
 
 @app.route('/api/run-check')
 def run_check():
@@ -29,6 +50,30 @@ app.register_blueprint(budget_item_bp)
 app.register_blueprint(category_bp)
 app.register_blueprint(purchase_bp)
 app.register_blueprint(pyf_budget_bp)
+app.register_blueprint(fiftythirtytwenty_budget_bp)
+app.register_blueprint(zerobased_budget_bp)
+app.register_blueprint(forecast_bp)
+app.register_blueprint(scenario_bp)
+app.register_blueprint(recurring_bp)
+app.register_blueprint(change_stream_bp)
+app.register_blueprint(sync_bp)
+app.register_blueprint(dashboard_bp)
+app.register_blueprint(batch_bp)
+app.register_blueprint(oplog_bp)
+app.register_blueprint(search_bp)
+app.register_blueprint(admission_bp)
+
+# Register CLI commands (run with: flask --app app <command>)
+app.cli.add_command(rebuild_rollups_command)
+app.cli.add_command(check_rollups_command)
+app.cli.add_command(rebuild_search_command)
+app.cli.add_command(pyf_batch_command)
+app.cli.add_command(rebalance_shards_command)
+app.cli.add_command(purge_idempotency_keys_command)
+app.cli.add_command(purge_deleted_command)
+app.cli.add_command(run_recurring_command)
+app.cli.add_command(prune_tombstones_command)
+app.cli.add_command(benchmark_reads_command)
 
 ## Configure database:
 # database is created locally under the backend folder
@@ -37,6 +82,27 @@ app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///budgetUsers.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 #print(app.config.keys())
 
+# Shed load on expensive routes before any other request hook runs (ADMISSION_CONTROL=0 turns it off),
+# so a rejected request never claims an Idempotency-Key
+init_admission(app)
+
+# Replay stored responses for retried POSTs (Idempotency-Key header) before doing any other work
+init_idempotency(app)
+
+# Optional: send GET requests to a read-only engine (off unless DB_READ_ROUTING=1)
+init_read_routing(app)
+# Optional: spread users over several SQLite files (off unless DB_SHARDS is 2 or more)
+init_sharding(app)
+# Deleted users/budgets are hidden at once and purged in the background (PURGE_WORKER=0 turns the worker off)
+init_soft_delete(app)
+# Optional: create recurring purchases in a background thread (off unless RECURRING_WORKER=1)
+init_recurring(app)
+# Change events for GET /api/users/<id>/events (in-process pub/sub)
+init_change_stream(app)
+init_sync(app)
+# Unusual purchase detection in the pay-yourself-first recommendations
+init_anomalies(app)
+
 # Initialize db with app
 db.init_app(app)
 
@@ -44,6 +110,12 @@ db.init_app(app)
 # Need to pass so sqlAlc can do it's job in a more optimized way
 with app.app_context():
     db.create_all()
+    # One-time data migrations for databases created by older versions
+    run_migrations()
+
+# Full-text search index over purchase/expense titles (FTS5 on SQLite)
+init_search(app)
+create_shards(app)
 
 print(__name__)
 if __name__ == "__main__":
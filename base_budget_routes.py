@@ -3,7 +3,13 @@ from flask import Blueprint, request, jsonify
 from models import Users, Budget, InitialExpense, InitialIncome, BudgetExpense, BudgetIncome
 from constants import VALID_FREQUENCIES, VALID_PERIODS, VALID_CATEGORIES_503020, VALID_METHODS
 from pyf_budget_routes import create_base_savings_category
-from utils import normalize_to_weekly
+from fiftythirtytwenty_budget_routes import create_503020_categories
+from utils import convert_frequency
+from sharding import register_budget, unregister_budget
+from soft_delete import soft_delete_budget, request_purge
+from concurrency import if_match_failed, precondition_failed, with_etag
+from read_paths import BUDGETS, BUDGET_COLLECTIONS, sparse_fieldset, user_budgets, budget_json
+from sqlalchemy.orm.exc import StaleDataError
 from extensions import db
 from copy import deepcopy
 
@@ -68,6 +74,7 @@ def create_budget(user_id):
         new_budget = Budget(user_id=user_id, title=data['title'], method=data['method'], period=budget_period)
         db.session.add(new_budget)
         db.session.flush() # Get the current budget ID
+        register_budget(new_budget)
 
         # Copy initial expenses to budget expenses
         for expense in user.initial_expenses:
@@ -80,8 +87,7 @@ def create_budget(user_id):
                     }
             # Convert amount if frequency does not match budget period
             if budget_period.lower() != expense.frequency.lower():
-                weekly_amount = normalize_to_weekly(expense.amount, expense.frequency, VALID_PERIODS)
-                expense_data['amount'] = weekly_amount * VALID_PERIODS[budget_period]
+                expense_data['amount'] = convert_frequency(expense.amount, expense.frequency, budget_period, VALID_PERIODS)
                 expense_data['frequency'] = budget_period
                 #category_type=expense.category_type
             budget_expense = BudgetExpense(**expense_data)
@@ -98,8 +104,7 @@ def create_budget(user_id):
                     }
             # Convert income(s) to match budget period if needed
             if budget_period.lower() != income.frequency.lower():
-                weekly_amount = normalize_to_weekly(income.amount, income.frequency, VALID_PERIODS)
-                income_data['amount'] = weekly_amount * VALID_PERIODS[budget_period]
+                income_data['amount'] = convert_frequency(income.amount, income.frequency, budget_period, VALID_PERIODS)
                 income_data['frequency'] = budget_period
 
             budget_income = BudgetIncome(**income_data)
@@ -120,6 +125,16 @@ def create_budget(user_id):
             
             db.session.commit()
 
+        elif new_budget.method.lower() == "50-30-20":
+            # Creating required Needs/Wants/Savings categories (allocations split from total income)
+            categories = create_503020_categories(new_budget.id)
+            # Initial expenses are bills: link them all to Needs to begin
+            needs_category = next(c for c in categories if c.title == "Needs")
+            for expense in new_budget.expenses:
+                expense.category_id = needs_category.id
+
+            db.session.commit()
+
         ###### calculate after categories are assigned --> Calculation is based on which calculation method is called
         #calculate_budget(user_id, new_budget.id)
 
@@ -136,6 +151,8 @@ def update_budget(user_id, budget_id):
         budget = Budget.query.filter_by(id=budget_id, user_id=user_id).first()
         if not budget:
             return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if if_match_failed(budget):
+            return precondition_failed(budget)
 
         data = request.json
 
@@ -152,11 +169,14 @@ def update_budget(user_id, budget_id):
         budget.title = new_title
         db.session.commit()
 
-        return jsonify({
+        return with_etag(jsonify({
             "msg": "Budget updated successfully",
             "updated_budget": budget.to_json()
-        }), 200
+        }), budget), 200
 
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -190,29 +210,39 @@ def calculate_budget(user_id, budget_id):
         return jsonify({"error": str(e)}), 500'''
 
 # Get all Budgets for a User
+# ?fields=id,title,total_income and ?include=expenses,incomes,all_categories trim the budgets and
+# skip the queries of whatever is left out (see read_paths.sparse_fieldset)
 @base_budget_bp.route("/api/users/<int:user_id>/budgets", methods=["GET"])
 def get_all_budgets(user_id):
     try:
+        keys, include = sparse_fieldset(BUDGETS, BUDGET_COLLECTIONS)
         user = Users.query.get(user_id)
         if user is None:
             return jsonify({"status":"error", "msg":"User not found"}), 404
         
-        budgets = Budget.query.filter_by(user_id=user_id).all()
+        budgets = user_budgets(user_id, keys, include)
         if not budgets:
             return jsonify({"msg": "User does not have a budget."}), 200
         
-        return jsonify([budget.to_json() for budget in budgets]), 200
+        return jsonify(budgets), 200
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
     
 # Get specific budget for a user
 @base_budget_bp.route("/api/users/<int:user_id>/budgets/<int:budget_id>", methods=["GET"])
 def get_specific_budget(user_id, budget_id):
+        try:
+            keys, include = sparse_fieldset(BUDGETS, BUDGET_COLLECTIONS)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
         budget = Budget.query.filter_by(id=budget_id, user_id=user_id).first()
         if not budget:
             return jsonify({"status":"error", "msg": "Budget not found"}), 404
         
-        return jsonify(budget.to_json())
+        return with_etag(jsonify(budget_json(budget_id, keys, include)), budget)
 
 # Deleting a Budget
 @base_budget_bp.route("/api/users/<int:user_id>/budgets/<int:budget_id>", methods=["DELETE"])
@@ -222,13 +252,24 @@ def delete_budget(user_id, budget_id):
         budget = Budget.query.filter_by(id=budget_id, user_id=user_id).first()
         if not budget:
             return jsonify({"status":"error", "msg": "Budget not found"}), 404
+        if if_match_failed(budget):
+            return precondition_failed(budget)
         
-        deleted_budget_data = budget.to_json()
+        # Serializing the budget loads all of its items: only do it when asked (?return_deleted=true)
+        deleted_budget_data = {"id": budget_id}
+        if request.args.get("return_deleted", "").lower() == "true":
+            deleted_budget_data = budget.to_json()
 
-        db.session.delete(budget)
+        # Soft delete: the budget disappears now, the purge worker removes it and its items later
+        soft_delete_budget(budget)
+        unregister_budget(budget_id)
         db.session.commit()
+        request_purge()
         return jsonify({"msg": "Budget deleted successfully", "deleted_budget":deleted_budget_data}), 200
     
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
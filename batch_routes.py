@@ -0,0 +1,173 @@
+# batch_routes.py by Eden Pardo
+# POST /api/batch runs several API calls in one HTTP request, for clients on slow connections.
+# Body: {"atomic": false, "requests": [{"method": "POST", "path": "/api/budgets/1/purchases", "body": {...}},
+#                                     {"method": "GET", "path": "/api/users/1/dashboard?purchases=5"}]}
+# Each sub-request goes through the normal URL map and request hooks (sharding, admission, ETags) and
+# gets back {"status", "body"} (plus "etag" when the route sends one), in order.
+#  - atomic=false: sub-requests are independent, each commits on its own like a separate call.
+#  - atomic=true: all sub-requests share one transaction per database. The first sub-request that
+#    answers with a 4xx/5xx rolls everything back and the rest are not run (status 424).
+# Idempotency-Key belongs on the batch request itself; sub-requests never carry one.
+from flask import Blueprint, request, jsonify, current_app, g
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from extensions import db
+from change_stream import publish_changes
+
+batch_bp = Blueprint('batch', __name__)
+
+MAX_BATCH_REQUESTS = 50
+BATCH_METHODS = ["GET", "POST", "PATCH", "PUT", "DELETE"]
+
+# Never dispatched from a batch: the batch itself, and streams that never finish
+BLOCKED_ENDPOINTS = ["batch.run_batch", "change_stream.stream_user_changes"]
+
+# Sub-request headers passed on to the route
+FORWARDED_HEADERS = ["If-Match", "If-None-Match"]
+
+# One open connection and transaction per engine, shared by every sub-request of an atomic batch
+class AtomicBatch:
+    def __init__(self):
+        self.connections = {}
+
+    def connection(self, engine):
+        connection = self.connections.get(engine)
+        if connection is None:
+            connection = engine.connect()
+            connection.begin()
+            self.connections[engine] = connection
+        return connection
+
+    def commit(self):
+        for connection in self.connections.values():
+            connection.commit()
+
+    def close(self):
+        # Closing without a commit rolls back
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+def error_body(msg):
+    return {"status": "error", "msg": msg}
+
+# Returns (sub-request, None) or (None, error message)
+def parse_sub_request(item):
+    if not isinstance(item, dict):
+        return None, "Each request must be an object"
+    method = item.get("method", "GET")
+    path = item.get("path")
+    if not isinstance(method, str) or method.upper() not in BATCH_METHODS:
+        return None, f"method must be one of {', '.join(BATCH_METHODS)}"
+    if not isinstance(path, str) or not path.startswith("/"):
+        return None, "path must be an absolute path such as /api/users/1"
+    headers = item.get("headers") or {}
+    if not isinstance(headers, dict):
+        return None, "headers must be an object"
+    return {
+        "method": method.upper(),
+        "path": path,
+        "body": item.get("body"),
+        "headers": {name: str(value) for name, value in headers.items() if name in FORWARDED_HEADERS}
+    }, None
+
+def blocked(sub_request):
+    adapter = current_app.url_map.bind("localhost")
+    try:
+        endpoint, _ = adapter.match(sub_request["path"].split("?", 1)[0], method=sub_request["method"])
+    except HTTPException:
+        return False # The dispatch answers with the usual 404/405
+    return endpoint in BLOCKED_ENDPOINTS
+
+def response_item(response):
+    body = response.get_json(silent=True)
+    item = {"status": response.status_code, "body": body if body is not None else response.get_data(as_text=True)}
+    if response.headers.get("ETag"):
+        item["etag"] = response.headers["ETag"]
+    return item
+
+# Run one sub-request through the app as if it had come in on its own
+def dispatch(sub_request, shared_context):
+    builder = EnvironBuilder(
+        path=sub_request["path"],
+        method=sub_request["method"],
+        json=sub_request["body"],
+        headers=sub_request["headers"],
+        environ_overrides={"REMOTE_ADDR": request.remote_addr}
+    )
+    app = current_app._get_current_object()
+    app_context = None if shared_context else app.app_context()
+    saved = dict(vars(g))
+    if app_context is not None:
+        app_context.push() # Own g and own database session, like a separate request
+    else:
+        vars(g).clear() # Same session, but none of the batch request's state (shard, idempotency key)
+    try:
+        with app.request_context(builder.get_environ()):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                response = jsonify({"error": str(e)})
+                response.status_code = 500
+            return response_item(response)
+    finally:
+        if app_context is not None:
+            app_context.pop()
+        else:
+            vars(g).clear()
+            vars(g).update(saved)
+
+@batch_bp.route("/api/batch", methods=["POST"])
+def run_batch():
+    data = request.get_json(silent=True) or {}
+    items = data.get("requests")
+    atomic = data.get("atomic", False)
+    if not isinstance(items, list) or not items:
+        return jsonify(error_body("Missing required field: requests")), 400
+    if len(items) > MAX_BATCH_REQUESTS:
+        return jsonify(error_body(f"At most {MAX_BATCH_REQUESTS} requests per batch")), 400
+    if not isinstance(atomic, bool):
+        return jsonify(error_body("atomic must be true or false")), 400
+
+    sub_requests = []
+    for index, item in enumerate(items):
+        sub_request, error = parse_sub_request(item)
+        if error is None and blocked(sub_request):
+            error = f"{sub_request['method']} {sub_request['path']} cannot be used in a batch"
+        if error is not None:
+            return jsonify(error_body(f"Request {index}: {error}")), 400
+        sub_requests.append(sub_request)
+
+    if not atomic:
+        return jsonify({"atomic": False, "responses": [dispatch(sub_request, False) for sub_request in sub_requests]}), 200
+
+    batch = AtomicBatch()
+    db.session.info["atomic_batch"] = batch
+    responses = []
+    committed = False
+    try:
+        for sub_request in sub_requests:
+            response = dispatch(sub_request, True)
+            responses.append(response)
+            if response["status"] >= 400:
+                break
+        else:
+            db.session.commit()
+            batch.commit()
+            committed = True
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if not committed:
+            db.session.rollback()
+        del db.session.info["atomic_batch"]
+        db.session.close()
+        batch.close()
+
+    if committed:
+        publish_changes(db.session)
+    responses += [
+        {"status": 424, "body": error_body("Not run: an earlier request in this atomic batch failed")}
+        for sub_request in sub_requests[len(responses):]
+    ]
+    return jsonify({"atomic": True, "committed": committed, "responses": responses}), 200
@@ -1,14 +1,45 @@
 # budget_item_routes.py by Eden Pardo
 from flask import Blueprint, request, jsonify, redirect, url_for
 from models import Budget, BudgetExpense, BudgetIncome, Category
-from constants import VALID_FREQUENCIES, VALID_PERIODS, VALID_CATEGORIES_503020, VALID_METHODS
+from constants import VALID_CATEGORIES_503020, VALID_METHODS
 import base_budget_routes
-from utils import normalize_to_weekly
+from validation import require, checked_title, checked_amount, checked_frequency, per_budget_period
 from pyf_budget_routes import pyf_purchase_calculation
+from fiftythirtytwenty_budget_routes import update_503020_allocations, fifty_thirty_twenty_calculation
+from zerobased_budget_routes import check_zero_based_allocations, zero_based_calculation
+from purchase_rollups import move_expense_rollups, detach_expense_rollups
+from concurrency import if_match_failed, precondition_failed, with_etag
+from read_paths import BUDGET_INCOMES, BUDGET_EXPENSES, sparse_fieldset, pick
+from sqlalchemy.orm.exc import StaleDataError
 from extensions import db
 
 budget_item_bp = Blueprint('budget_items', __name__)
 
+## Checks and writes shared with the operation log (oplog_routes.py)
+# Amount and frequency of an income or expense, converted to the budget period.
+# `current` is kept for the fields that were not sent.
+def item_amount(data, budget, current=(None, None)):
+    amount = checked_amount(data["amount"]) if "amount" in data else current[0]
+    frequency = checked_frequency(data["frequency"]) if "frequency" in data else current[1]
+    return per_budget_period(amount, frequency, budget)
+
+# The category an expense names by title (category_type)
+def expense_category(budget_id, title):
+    category = Category.query.filter_by(budget_id=budget_id, title=title).first()
+    if not category:
+        raise ValueError(f"Category '{title}' does not exist in this budget. Please create it first.")
+    return category
+
+def set_expense_category(expense, category):
+    if expense.category_id != category.id:
+        move_expense_rollups(expense.id, category.id)
+    expense.category_id = category.id
+
+def remove_expense(expense):
+    # Purchases of a deleted expense become uncategorized, and so do their rollups
+    detach_expense_rollups(expense.id)
+    db.session.delete(expense)
+
 # Add Budget Income for user
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-incomes", methods=["POST"])
 def add_budget_income(budget_id):
@@ -20,42 +51,21 @@ def add_budget_income(budget_id):
         data = request.json
 
         # Validate required fields
-        required_fields = ["title", "amount", "frequency"]
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            return jsonify({"status":"error", "msg":f"Missing required field: {', '.join(missing_fields)}"}), 400
-        
-        # Validation
-        income_title = data["title"].strip()
-        if len(income_title) == 0:
-            return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-        if len(income_title) > 100:
-            return jsonify({"status": "error", "msg": "Title too long"}), 400
-
-        income_amount = float(data["amount"])
-        if income_amount < 0:
-            return jsonify({"status": "error", "msg": "Amount cannot be negative"}), 400
-
-        income_frequency = data["frequency"].lower()
-        if income_frequency not in VALID_FREQUENCIES:
-            return jsonify({"status": "error", "msg": "Invalid frequency"}), 400
-
+        require(data, ["title", "amount", "frequency"])
+        income_title = checked_title(data["title"])
         # Normalize if needed
-        budget_period = budget.period.lower()
-        if income_frequency != budget_period:
-            weekly = normalize_to_weekly(income_amount, income_frequency, VALID_PERIODS)
-            income_amount = weekly * VALID_PERIODS[budget_period]
-            income_frequency = budget_period
+        income_amount, income_frequency = item_amount(data, budget)
 
         new_income = BudgetIncome(
-            title=data['title'],
+            title=income_title,
             amount=income_amount,
             frequency=income_frequency,
             budget_id=budget_id
         )
 
         db.session.add(new_income)
+        if budget.method.lower() == "50-30-20":
+            update_503020_allocations(budget_id)
         db.session.commit()
 
         # Trigger budget recalculations
@@ -63,6 +73,10 @@ def add_budget_income(budget_id):
         status = 201
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
 
         return jsonify({
             "msg": "Budget Income created successfully",
@@ -70,6 +84,9 @@ def add_budget_income(budget_id):
             "recalculation": recalculation
         }), status
     
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"error":str(e)}), 500
@@ -81,44 +98,28 @@ def update_budget_income(budget_id, budget_income_id):
         income = BudgetIncome.query.filter_by(id=budget_income_id, budget_id=budget_id).first()
         if not income:
             return jsonify({"status":"error", "msg": "Budget Income not found"}), 404
+        if if_match_failed(income):
+            return precondition_failed(income)
         
         data = request.json
+        budget = Budget.query.get(budget_id)
 
-        # Validate required fields (if updated)
-        updated_amount = income.amount
-        updated_frequency = income.frequency
-
-        if "amount" in data:
-            updated_amount = float(data["amount"])
-            if updated_amount < 0:
-                return jsonify({"status": "error", "msg": "Amount cannot be negative"}), 400
-
-        if "frequency" in data:
-            freq = data["frequency"].lower()
-            if freq not in VALID_FREQUENCIES:
-                return jsonify({"status": "error", "msg": "Invalid frequency"}), 400
-            updated_frequency = freq
-
+        # Validate fields (if updated) and normalize if needed
+        updated_amount, updated_frequency = item_amount(data, budget, (income.amount, income.frequency))
         if "title" in data:
-            income_title = data["title"].strip()
-            if len(income_title) == 0:
-                return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-            if len(income_title) > 100:
-                return jsonify({"status": "error", "msg": "Title too long"}), 400
-            income.title = data["title"]
-
-        # Normalize if needed
-        budget = Budget.query.get(budget_id)
-        budget_period = budget.period.lower()
-        if updated_frequency != budget_period:
-            weekly = normalize_to_weekly(updated_amount, updated_frequency, VALID_PERIODS)
-            updated_amount = weekly * VALID_PERIODS[budget_period]
-            updated_frequency = budget_period
+            income.title = checked_title(data["title"])
 
         # Assign normalized or updated values
         income.amount = updated_amount
         income.frequency = updated_frequency
 
+        if budget.method.lower() == "50-30-20":
+            update_503020_allocations(budget_id)
+        elif budget.method.lower() == "zero-based":
+            error = check_zero_based_allocations(budget_id)
+            if error:
+                db.session.rollback()
+                return jsonify(error[0]), error[1]
         db.session.commit()
 
         # Trigger budget recalculations
@@ -126,13 +127,23 @@ def update_budget_income(budget_id, budget_income_id):
         status = 200
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
 
-        return jsonify({
+        return with_etag(jsonify({
             "msg": "Budget Income updated successfully",
             "updated_income": income.to_json(),
             "recalculation": recalculation
-        }), status
+        }), income), status
     
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -141,24 +152,31 @@ def update_budget_income(budget_id, budget_income_id):
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-incomes", methods=["GET"])
 def get_all_budget_incomes(budget_id):
     try:
+        keys, _ = sparse_fieldset(BUDGET_INCOMES)
         budget = Budget.query.get(budget_id)
         if budget is None:
             return jsonify({"status":"error", "msg":"Budget not found"}), 404
         
-        incomes = [income.to_json() for income in budget.incomes]
-        return jsonify(incomes), 200
+        return jsonify(BUDGET_INCOMES.list(budget_id, keys)), 200
     
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
     
 # Get specific income for a budget
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-incomes/<int:budget_income_id>", methods=["GET"])
 def get_specific_income(budget_id, budget_income_id):
+        try:
+            keys, _ = sparse_fieldset(BUDGET_INCOMES)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
         income = BudgetIncome.query.filter_by(id=budget_income_id, budget_id=budget_id).first()
         if not income:
             return jsonify({"status":"error", "msg": "Budget Income not found"}), 404
         
-        return jsonify(income.to_json())
+        return with_etag(jsonify(pick(income.to_json(), keys)), income)
 
 # Delete a Budget Income
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-incomes/<int:budget_income_id>", methods=["DELETE"])
@@ -167,11 +185,38 @@ def delete_budget_income(budget_id, budget_income_id):
         income = BudgetIncome.query.filter_by(id=budget_income_id, budget_id=budget_id).first()
         if not income:
             return jsonify({"status":"error", "msg": "Budget Income not found"}), 404
+        if if_match_failed(income):
+            return precondition_failed(income)
         
+        deleted_income_data = income.to_json()
         db.session.delete(income)
+
+        budget = Budget.query.get(budget_id)
+        recalculation = None
+        status = 200
+        if budget.method.lower() == "50-30-20":
+            update_503020_allocations(budget_id)
+        elif budget.method.lower() == "zero-based":
+            error = check_zero_based_allocations(budget_id)
+            if error:
+                db.session.rollback()
+                return jsonify(error[0]), error[1]
         db.session.commit()
-        return jsonify({"msg": "Budget Income deleted successfully", "deleted_income":income.to_json()}), 200
+
+        if budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
+
+        return jsonify({
+            "msg": "Budget Income deleted successfully",
+            "deleted_income": deleted_income_data,
+            "recalculation": recalculation
+        }), status
     
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
@@ -186,53 +231,23 @@ def add_budget_expense(budget_id):
         data = request.json
 
         # Validate required fields
-        required_fields = ["title", "amount", "frequency", "category_type"]
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            return jsonify({"status":"error", "msg":f"Missing required field: {', '.join(missing_fields)}"}), 400
-
-        if float(data['amount']) < 0:
-            return jsonify({"status":"error","msg": "Amount cannot be negative"}), 400
-
-        expense_title = data["title"].strip()
-        if len(expense_title) == 0:
-            return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-        if len(expense_title) > 100:
-            return jsonify({"status": "error", "msg": "Title too long"}), 400
-
-        if data['frequency'] not in VALID_FREQUENCIES:
-            return jsonify({"status":"error", "msg": "Frquency must be 'weekly', 'biweekly', 'monthly', or 'yearly'"}), 400
-        
+        require(data, ["title", "amount", "frequency", "category_type"])
+        expense_title = checked_title(data["title"])
         # Normalize amount if frequency does not match budget's period
-        expense_amount = float(data['amount'])
-        expense_frequency = data['frequency'].lower()
-        budget_period = budget.period.lower()
-
-        # Convert amount if frequency does not match budget period
-        if budget_period != expense_frequency:
-            weekly_amount = normalize_to_weekly(expense_amount, expense_frequency, VALID_PERIODS)
-            # Scale up to match budget period
-            expense_amount = weekly_amount * VALID_PERIODS[budget_period]
-            expense_frequency = budget_period
-        
+        expense_amount, expense_frequency = item_amount(data, budget)
         # Validate categories: Find matching category in budget
-        category = Category.query.filter_by(
-            budget_id=budget_id,
-            title=data['category_type']
-        ).first()
-
-        if not category:
-            return jsonify({"error": f"Category '{data['category_type']}' does not exist in this budget. Please create it first."}), 400
+        category = expense_category(budget_id, data['category_type'])
 
         # Create new expense category
-        new_expense = BudgetExpense(title=data['title'], amount=expense_amount, frequency=expense_frequency, budget_id=budget_id, category_id=category.id)
+        new_expense = BudgetExpense(title=expense_title, amount=expense_amount, frequency=expense_frequency, budget_id=budget_id, category_id=category.id)
         db.session.add(new_expense)
         db.session.commit()
 
         # Trigger budget recalculations
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
         else:
             recalculation = None
             status = 200
@@ -243,6 +258,9 @@ def add_budget_expense(budget_id):
             "recalculation": recalculation
         }), status
     
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"error":str(e)}), 500
@@ -254,68 +272,46 @@ def update_budget_expense(budget_id, budget_expense_id):
         expense = BudgetExpense.query.filter_by(id=budget_expense_id, budget_id=budget_id).first()
         if not expense:
             return jsonify({"status":"error", "msg": "Expense not found"}), 404
+        if if_match_failed(expense):
+            return precondition_failed(expense)
         
         data = request.json
-
-        updated_amount = expense.amount
-        updated_frequency = expense.frequency
-
-        if 'amount' in data:
-            updated_amount = float(data['amount'])
-            if updated_amount < 0:
-                return jsonify({"status":"error","msg": "Amount cannot be negative"}), 400
-        
-        if 'title' in data:
-            expense_title = data["title"].strip()
-            if len(expense_title) == 0:
-                return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-            if len(expense_title) > 100:
-                return jsonify({"status": "error", "msg": "Title too long"}), 400
-            expense.title = data['title']
-
-        if 'frequency' in data:
-            freq = data['frequency'].lower()
-            if freq not in VALID_FREQUENCIES:
-                return jsonify({"status":"error", "msg": "Frquency must be 'weekly', 'biweekly', 'monthly', or 'yearly'"}), 400
-            updated_frequency = freq
-
         budget = Budget.query.get(budget_id)
-        budget_period = budget.period.lower()
+
         # Normalize amount if frequency does not match budget's period
-        if updated_frequency != budget_period:
-            weekly_amount = normalize_to_weekly(updated_amount, updated_frequency, VALID_PERIODS)
-            # Scale up to match budget period
-            updated_amount = weekly_amount * VALID_PERIODS[budget_period]
-            updated_frequency = budget_period
-            
+        updated_amount, updated_frequency = item_amount(data, budget, (expense.amount, expense.frequency))
+        if 'title' in data:
+            expense.title = checked_title(data["title"])
         expense.amount = updated_amount
         expense.frequency = updated_frequency
         
         # Validate categories: Find matching category in budget
         if 'category_type' in data:
-            category = Category.query.filter_by(
-                budget_id=budget_id,
-                title=data['category_type']
-            ).first()
-            if not category:
-                return jsonify({"error": f"Category '{data['category_type']}' does not exist in this budget. Please create it first."}), 400
-            expense.category_id = category.id
+            set_expense_category(expense, expense_category(budget_id, data['category_type']))
 
         db.session.commit()
 
         # Trigger budget recalculations
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
         else:
             recalculation = None
             status = 200
 
-        return jsonify({
+        return with_etag(jsonify({
             "msg": "Expense updated successfully",
             "expense": expense.to_json(),
             "recalculation": recalculation
-        }), status
+        }), expense), status
 
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -324,24 +320,31 @@ def update_budget_expense(budget_id, budget_expense_id):
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-expenses", methods=["GET"])
 def get_all_budget_expenses(budget_id):
     try:
+        keys, _ = sparse_fieldset(BUDGET_EXPENSES)
         budget = Budget.query.get(budget_id)
         if budget is None:
             return jsonify({"status":"error", "msg":"Budget not found"}), 404
         
-        expenses = [expense.to_json() for expense in budget.expenses]
-        return jsonify(expenses), 200
+        return jsonify(BUDGET_EXPENSES.list(budget_id, keys)), 200
     
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
 
 # Get specific Budget Expense
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-expenses/<int:budget_expense_id>", methods=["GET"])
 def get_specific_budget_expense(budget_id, budget_expense_id):
-        expense = BudgetExpense.query.filter_by(id=expense_id, budget_id=budget_id).first()
+        try:
+            keys, _ = sparse_fieldset(BUDGET_EXPENSES)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
+        expense = BudgetExpense.query.filter_by(id=budget_expense_id, budget_id=budget_id).first()
         if not expense:
             return jsonify({"status":"error", "msg": "Expense not found"}), 404
         
-        return jsonify(expense.to_json())
+        return with_etag(jsonify(pick(expense.to_json(), keys)), expense)
     
 # Delete a Budget Expense
 @budget_item_bp.route("/api/budgets/<int:budget_id>/budget-expenses/<int:budget_expense_id>", methods=["DELETE"])
@@ -350,11 +353,13 @@ def delete_budget_expense(budget_id, budget_expense_id):
         expense = BudgetExpense.query.filter_by(id=budget_expense_id, budget_id=budget_id).first()
         if not expense:
             return jsonify({"status": "error", "msg": "Expense not found"}), 404
+        if if_match_failed(expense):
+            return precondition_failed(expense)
 
         # Store data before deletion
         deleted_expense_data = expense.to_json()
 
-        db.session.delete(expense)
+        remove_expense(expense)
         db.session.commit()
 
         budget = Budget.query.get(budget_id)
@@ -364,6 +369,8 @@ def delete_budget_expense(budget_id, budget_expense_id):
         # Trigger recalculations
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
         else:
             recalculation = None
             status = 200
@@ -374,5 +381,8 @@ def delete_budget_expense(budget_id, budget_expense_id):
             "recalculation": recalculation
         }), status
 
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
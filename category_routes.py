@@ -2,6 +2,11 @@
 from flask import Blueprint, request, jsonify
 from models import Category, Budget, BudgetExpense
 from pyf_budget_routes import pyf_allocation_calculation
+from zerobased_budget_routes import check_zero_based_allocations, zero_based_calculation
+from validation import require, checked_title, checked_amount
+from concurrency import if_match_failed, precondition_failed, with_etag
+from read_paths import CATEGORIES, sparse_fieldset, pick
+from sqlalchemy.orm.exc import StaleDataError
 from extensions import db
 
 def is_protected_category(budget_method, category_title):
@@ -22,6 +27,45 @@ def is_reserved_priority(budget, new_priority):
             return True
     return False
 
+## Checks shared with the operation log (oplog_routes.py)
+def checked_priority(value, budget, category=None):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError("Priority must be positive")
+    # Prevent using reserved priority numbers
+    if is_reserved_priority(budget, value) and not (category and category.is_savings):
+        raise ValueError(f"Priority {value} is reserved for a required category and cannot be used.")
+    return value
+
+# Optional description, stored as NULL when empty
+def checked_description(value):
+    if value is not None and not isinstance(value, str):
+        raise ValueError("Description must be text")
+    description = (value or "").strip()
+    if len(description) > 100:
+        raise ValueError("Description too long (max 100 chars)")
+    return description or None
+
+# Category titles are unique per budget, ignoring case
+def unique_category_title(title, budget, category=None):
+    existing = Category.query.filter(Category.budget_id == budget.id, Category.title.ilike(title)).first()
+    if existing and existing is not category:
+        raise ValueError(f"'{title}' already exists in this budget.")
+    return title
+
+# Protected categories only take a new description (and allocation, except in 50-30-20)
+def check_protected_fields(budget, category, data):
+    if not is_protected_category(budget.method, category.title):
+        return
+    # 50-30-20 allocations always follow the income split
+    allowed_fields = ["description"] if budget.method.lower() == "50-30-20" else ["description", "allocated_amount"]
+    for field in data:
+        if field not in allowed_fields:
+            raise ValueError(f"Cannot change '{field}' for protected category '{category.title}'.")
+
+def check_deletable(budget, category):
+    if is_protected_category(budget.method, category.title):
+        raise ValueError(f"Cannot delete protected category '{category.title}' in {budget.method} budgeting.")
+
 category_bp = Blueprint('category', __name__)
 
 # Add category for a budget
@@ -39,57 +83,31 @@ def add_category(budget_id):
             return jsonify({"status":"error", "msg":"Cannot create additional categories for 50-30-20. Only 'Needs', 'Wants', and 'Savings' allowed."}), 400
         
         # Validate required fields
-        required_fields = ["title", "priority", "allocated_amount"]
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            return jsonify({"status":"error", "msg":f"Missing required field: {', '.join(missing_fields)}"}), 400
-            
-        # Check for duplicate category title IN THIS BUDGET
-        existing_category = Category.query.filter(Category.budget_id == budget_id,
-                                                  Category.title.ilike(data["title"].strip())  # Case-insensitive and trimmed
-                                                ).first()
-        if existing_category:
-            return jsonify({"status":"error", "msg": f"\"{data['title']}\" already exists in this budget."}), 400
-        
-        # Title length check (required)
-        title = data['title'].strip()
-        if len(title) == 0:
-            return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-        if len(title) > 100:
-            return jsonify({"status": "error", "msg": "Title too long (max 100 chars)"}), 400
-        
-        # Description length check
-        description = data.get("description", "").strip()  # Default to empty string if not provided
-        if description and len(description) > 100:
-            return jsonify({"status": "error", "msg": "Description too long (max 100 chars)"}), 400
-        
-        # Check that priority is a positive int
-        if data['priority'] < 1:
-            return jsonify({"status":"error","msg": "Priority cannot be negative"}), 400
-        # Prevent using reserved priority numbers
-        if is_reserved_priority(budget, data['priority']):
-            return jsonify({
-                "status": "error",
-                "msg": f"Priority {data['priority']} is reserved for a required category and cannot be used."
-            }), 400
-        
-        if data['allocated_amount'] < 0:
-            return jsonify({"status":"error","msg": "Allocated amount cannot be negative"}), 400
-        
+        require(data, ["title", "priority", "allocated_amount"])
+
         # Create new category (description is optional)
         new_category = Category(
-            title=data['title'],
-            priority=data['priority'],
-            allocated_amount=data['allocated_amount'],
+            # Check for duplicate category title IN THIS BUDGET
+            title=unique_category_title(checked_title(data["title"]), budget),
+            priority=checked_priority(data["priority"], budget),
+            allocated_amount=checked_amount(data["allocated_amount"], "Allocated amount"),
             budget_id=budget_id,
-            description=description if description else None  # Store NULL if empty
+            description=checked_description(data.get("description"))
         )
         db.session.add(new_category)
+        if budget.method.lower() == "zero-based":
+            error = check_zero_based_allocations(budget_id)
+            if error:
+                db.session.rollback()
+                return jsonify(error[0]), error[1]
         db.session.commit()
 
+        recalculation = None
+        status = 201
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_allocation_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
 
         return jsonify({
             "msg":"Category created successfully",
@@ -97,6 +115,9 @@ def add_category(budget_id):
             "recalculation": recalculation
             }), status
     
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"error":str(e)}), 500
@@ -112,75 +133,55 @@ def update_category(budget_id, category_id):
         category = Category.query.filter_by(id=category_id, budget_id=budget_id).first()
         if not category:
             return jsonify({"status":"error", "msg": "Category not found"}), 404
+        if if_match_failed(category):
+            return precondition_failed(category)
         
-        # Check if trying to update a protected category
-        if is_protected_category(budget.method, category.title):
-            # Only allow updating description and allocated amount if protected
-            allowed_fields = ["description", "allocated_amount"]
-
-            for field in request.json.keys():
-                if field not in allowed_fields:
-                    return jsonify({"status":"error", "msg": f"Cannot change '{field}' for protected category '{category.title}'."}), 400
-
         data = request.json
 
+        # Check if trying to update a protected category
+        check_protected_fields(budget, category, data)
+
         # Check for duplicate category title IN THIS BUDGET and validate length
         if 'title' in data:
-            title = data['title'].strip()
-            if len(title) == 0:
-                return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-            if len(title) > 100:
-                return jsonify({"status": "error", "msg": "Title too long (max 100 chars)"}), 400
-
-            existing_category = Category.query.filter(
-                Category.budget_id == budget_id,
-                Category.title.ilike(title)
-            ).first()
-            if existing_category and existing_category.id != category.id:
-                return jsonify({
-                    "status": "error",
-                    "msg": f"'{data['title']}' already exists in this budget."
-                }), 400
-
-            category.title = title
+            category.title = unique_category_title(checked_title(data["title"]), budget, category)
 
         # Description length check (if provided)
         if 'description' in data:
-            description = data['description'].strip()
-            if len(description) > 100:
-                return jsonify({"status": "error", "msg": "Description too long (max 100 chars)"}), 400
-            category.description = description if description else None
+            category.description = checked_description(data["description"])
 
         # Check that priority is a positive int and it is not a reserved priority
         if 'priority' in data:
-            new_priority = data['priority']
-            if new_priority < 1:
-                return jsonify({"status":"error", "msg": "Priority must be positive"}), 400
-            if is_reserved_priority(budget, new_priority) and not category.is_savings:
-                return jsonify({
-                    "status": "error",
-                    "msg": f"Priority {new_priority} is reserved for a required category and cannot be used."
-                }), 400
-            category.priority = new_priority
-            
-        # Check that priority is a positive int
+            category.priority = checked_priority(data["priority"], budget, category)
+
         if 'allocated_amount' in data:
-            new_amount = float(data['allocated_amount'])
-            if new_amount < 0:
-                return jsonify({"status":"error", "msg": "Allocated amount cannot be negative"}), 400
-            category.allocated_amount = new_amount
+            category.allocated_amount = checked_amount(data["allocated_amount"], "Allocated amount")
 
+        if budget.method.lower() == "zero-based":
+            error = check_zero_based_allocations(budget_id)
+            if error:
+                db.session.rollback()
+                return jsonify(error[0]), error[1]
         db.session.commit()
 
+        recalculation = None
+        status = 200
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_allocation_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
 
-        return jsonify({
+        return with_etag(jsonify({
             "msg":"Category updated successfully",
             "updated_category":category.to_json(),
             "recalculation": recalculation
-            }), status
+            }), category), status
     
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -189,24 +190,31 @@ def update_category(budget_id, category_id):
 @category_bp.route("/api/budgets/<int:budget_id>/categories", methods=["GET"])
 def get_all_budget_categories(budget_id):
     try:
+        keys, _ = sparse_fieldset(CATEGORIES)
         budget = Budget.query.get(budget_id)
         if budget is None:
             return jsonify({"status":"error", "msg":"Budget not found"}), 404
         
-        categories = [category.to_json() for category in budget.categories]
-        return jsonify(categories), 200
+        return jsonify(CATEGORIES.list(budget_id, keys)), 200
     
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
     
 # Get specific category for a budget
 @category_bp.route("/api/budgets/<int:budget_id>/categories/<int:category_id>", methods=["GET"])
 def get_specific_budget_category(budget_id, category_id):
+    try:
+        keys, _ = sparse_fieldset(CATEGORIES)
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
+
     category = Category.query.filter_by(id=category_id, budget_id=budget_id).first()
     if not category:
         return jsonify({"status":"error", "msg": "Category not found"}), 404
         
-    return jsonify(category.to_json())
+    return with_etag(jsonify(pick(category.to_json(), keys)), category)
 
 # Delete a category
 @category_bp.route("/api/budgets/<int:budget_id>/categories/<int:category_id>", methods=["DELETE"])
@@ -220,21 +228,33 @@ def delete_category(budget_id, category_id):
         if not category:
             return jsonify({"status":"error", "msg": "Category not found"}), 404
         
-        if is_protected_category(budget.method, category.title):
-            return jsonify({"status":"error", "msg": f"Cannot delete protected category '{category.title}' in {budget.method} budgeting."}), 400
+        try:
+            check_deletable(budget, category)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+        if if_match_failed(category):
+            return precondition_failed(category)
 
+        deleted_category_data = category.to_json()
         db.session.delete(category)
         db.session.commit()
 
+        recalculation = None
+        status = 200
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_allocation_calculation(budget_id)
+        elif budget.method.lower() == "zero-based":
+            recalculation, status = zero_based_calculation(budget_id)
 
         return jsonify({
             "msg": "Category deleted successfully",
-            "deleted_category":category.to_json(),
+            "deleted_category":deleted_category_data,
             "recalculation": recalculation
             }), status
     
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
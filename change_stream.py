@@ -0,0 +1,193 @@
+# change_stream.py by Eden Pardo
+# Server-Sent Events so the frontend can stop polling: GET /api/users/<id>/events streams one compact
+# event per committed change to the user's budgets, items, categories and purchases.
+# Changes are collected from every flush (so every write route and background job is covered) and
+# published only after the commit, through an in-process pub/sub. Each subscriber has a bounded
+# queue; a client that falls behind gets a single "resync" event instead of an ever growing backlog.
+# The pub/sub is per process: with several server processes each only sees its own writes.
+#   SSE_QUEUE_SIZE=100            events buffered per subscriber
+#   SSE_MAX_SUBSCRIBERS=10        open streams per user
+#   SSE_HEARTBEAT_SECONDS=15      keep-alive comment interval
+import itertools
+import json
+import os
+import queue
+import threading
+from flask import Blueprint, Response, current_app, jsonify
+from sqlalchemy import event, select
+from models import Users, Budget, BudgetExpense, BudgetIncome, Category, Purchase, RecurringPurchase
+from extensions import db, RoutingSession
+
+change_stream_bp = Blueprint('change_stream', __name__)
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_SUBSCRIBERS = 10
+DEFAULT_HEARTBEAT_SECONDS = 15
+
+# Entity name sent to clients for each tracked model
+TRACKED_MODELS = {
+    Budget: "budget",
+    BudgetExpense: "budget_expense",
+    BudgetIncome: "budget_income",
+    Category: "category",
+    Purchase: "purchase",
+    RecurringPurchase: "recurring_purchase",
+}
+
+class ChangeBroker:
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, max_subscribers=DEFAULT_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = {} # user_id --> set of queues
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    # Returns the subscriber's queue, or None if the user already has too many streams open
+    def subscribe(self, user_id):
+        with self.lock:
+            queues = self.subscribers.setdefault(user_id, set())
+            if len(queues) >= self.max_subscribers:
+                return None
+            subscriber = queue.Queue(maxsize=self.queue_size)
+            queues.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        with self.lock:
+            queues = self.subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(subscriber)
+                if not queues:
+                    del self.subscribers[user_id]
+
+    # Never blocks the writer: a full queue is emptied and told to resync
+    def publish(self, user_id, change):
+        with self.lock:
+            queues = list(self.subscribers.get(user_id, ()))
+        change = {"seq": next(self.sequence), **change}
+        for subscriber in queues:
+            try:
+                subscriber.put_nowait(change)
+            except queue.Full:
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait({"seq": change["seq"], "type": "resync"})
+
+change_broker = ChangeBroker()
+
+# Changes waiting for the commit, kept on the session: [(user_id or None, budget_id, change)]
+def pending_changes(session):
+    return session.info.setdefault("pending_changes", [])
+
+# For writes that bypass the ORM unit of work (bulk inserts). Call before the commit.
+def record_change(session, entity, entity_id, budget_id, op, version=None):
+    if change_broker.has_subscribers():
+        user_id = session.execute(
+            select(Budget.user_id).where(Budget.id == budget_id), execution_options={"include_deleted": True}
+        ).scalar()
+        pending_changes(session).append((user_id, budget_id, {
+            "type": "change", "entity": entity, "id": entity_id, "budget_id": budget_id, "version": version, "op": op
+        }))
+
+def change_op(session, obj):
+    if obj in session.new:
+        return "created"
+    if obj in session.deleted:
+        return "deleted"
+    # Soft deletes are updates that set deleted_at
+    if isinstance(obj, Budget) and obj.deleted_at is not None:
+        return "deleted"
+    return "updated"
+
+@event.listens_for(RoutingSession, "after_flush")
+def collect_changes(session, flush_context):
+    if not change_broker.has_subscribers():
+        return
+    changes = pending_changes(session)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        entity = TRACKED_MODELS.get(type(obj))
+        if entity is None or (obj in session.dirty and not session.is_modified(obj)):
+            continue
+        values = obj.__dict__ # Loaded values only, nothing is lazy loaded here
+        budget_id = values.get("id") if isinstance(obj, Budget) else values.get("budget_id")
+        user_id = values.get("user_id") if isinstance(obj, Budget) else None
+        changes.append((user_id, budget_id, {
+            "type": "change",
+            "entity": entity,
+            "id": values.get("id"),
+            "budget_id": budget_id,
+            "version": values.get("version"),
+            "change_seq": values.get("change_seq"),
+            "op": change_op(session, obj)
+        }))
+
+    # Owner of every budget still missing one, in one query
+    missing = {budget_id for user_id, budget_id, change in changes if user_id is None and budget_id is not None}
+    if missing:
+        owners = dict(session.execute(
+            select(Budget.id, Budget.user_id).where(Budget.id.in_(missing)),
+            execution_options={"include_deleted": True}
+        ).all())
+        session.info["pending_changes"] = [
+            (user_id if user_id is not None else owners.get(budget_id), budget_id, change)
+            for user_id, budget_id, change in changes
+        ]
+
+@event.listens_for(RoutingSession, "after_commit")
+def publish_changes(session):
+    # Commits inside an atomic batch are not final: batch_routes.py publishes once the batch commits
+    if "atomic_batch" in session.info:
+        return
+    for user_id, budget_id, change in session.info.pop("pending_changes", []):
+        if user_id is not None:
+            change_broker.publish(user_id, change)
+
+@event.listens_for(RoutingSession, "after_rollback")
+def discard_changes(session):
+    session.info.pop("pending_changes", None)
+
+def init_change_stream(app):
+    app.config.setdefault("SSE_QUEUE_SIZE", int(os.environ.get("SSE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)))
+    app.config.setdefault("SSE_MAX_SUBSCRIBERS", int(os.environ.get("SSE_MAX_SUBSCRIBERS", DEFAULT_MAX_SUBSCRIBERS)))
+    app.config.setdefault("SSE_HEARTBEAT_SECONDS", float(os.environ.get("SSE_HEARTBEAT_SECONDS", DEFAULT_HEARTBEAT_SECONDS)))
+    change_broker.queue_size = app.config["SSE_QUEUE_SIZE"]
+    change_broker.max_subscribers = app.config["SSE_MAX_SUBSCRIBERS"]
+
+def format_event(change):
+    return f"id: {change['seq']}\nevent: {change['type']}\ndata: {json.dumps(change, separators=(',', ':'))}\n\n"
+
+# Stream of change events for one user: `event: change` for each committed change,
+# `event: resync` when the client missed events and should reload.
+@change_stream_bp.route("/api/users/<int:user_id>/events", methods=["GET"])
+def stream_user_changes(user_id):
+    user = Users.query.get(user_id)
+    if not user:
+        return jsonify({"status": "error", "msg": "User not found"}), 404
+    # Nothing below uses the database: give the connection back before streaming
+    db.session.remove()
+
+    subscriber = change_broker.subscribe(user_id)
+    if subscriber is None:
+        return jsonify({"status": "error", "msg": "Too many open event streams for this user"}), 429
+    heartbeat = current_app.config["SSE_HEARTBEAT_SECONDS"]
+
+    def events():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    change = subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(change)
+        finally:
+            change_broker.unsubscribe(user_id, subscriber)
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no" # Do not let a proxy buffer the stream
+    })
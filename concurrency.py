@@ -0,0 +1,35 @@
+# concurrency.py by Eden Pardo
+# Optimistic concurrency for budgets, budget items, categories and purchases.
+# Every row has a `version` column (SQLAlchemy version_id_col) that is checked and bumped on
+# each UPDATE/DELETE. GET/PATCH responses send it as the ETag; PATCH/DELETE requests can send
+# it back in If-Match and get 412 Precondition Failed if someone else changed the row first.
+from flask import request, jsonify
+
+def etag_for(entity):
+    return f'"{entity.version}"'
+
+# True if the request sent an If-Match that does not match the entity's current version.
+# No If-Match (or "*") means the client does not care and the write goes ahead.
+def if_match_failed(entity):
+    header = request.headers.get("If-Match")
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    if "*" in tags:
+        return False
+    return etag_for(entity) not in [tag.removeprefix("W/") for tag in tags]
+
+def precondition_failed(entity=None):
+    response = jsonify({
+        "status": "error",
+        "msg": "This item was changed by another request. Reload it and try again."
+    })
+    response.status_code = 412
+    if entity is not None:
+        response.headers["ETag"] = etag_for(entity)
+    return response
+
+# Add the entity's ETag to a jsonify() response
+def with_etag(response, entity):
+    response.headers["ETag"] = etag_for(entity)
+    return response
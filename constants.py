@@ -12,7 +12,10 @@ VALID_PERIODS = {
 }
 
 # Valid category types for expenses
-VALID_CATEGORIES_503020 = ["Necessities", "Wants", "Savings"]
+VALID_CATEGORIES_503020 = ["Needs", "Wants", "Savings"]
+
+# Share of income (percent) for each 50-30-20 category
+SPLIT_503020 = {"Needs": 50, "Wants": 30, "Savings": 20}
 
 # Valid budget methods
 VALID_METHODS = ["50-30-20", "zero-based", "pay-yourself-first"]
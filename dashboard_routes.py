@@ -0,0 +1,109 @@
+# dashboard_routes.py by Eden Pardo
+# Everything the home screen needs in one request: the user, a totals-only summary of every budget,
+# the active budget's categories with spent/remaining and its latest purchases.
+# The number of queries is fixed whatever the number of budgets, items or purchases:
+#   user, initial incomes, initial expenses (selectinload) - budget summaries (one aggregate query) -
+#   categories - spending per category (purchase rollups) - latest purchases (ix_purchase_budget_id_date)
+# Query string: budget_id (default: the most recently updated budget), purchases (0-50, default 10)
+from datetime import datetime
+from flask import Blueprint, request, jsonify
+from sqlalchemy import select, func
+from sqlalchemy.orm import selectinload, joinedload
+from models import Users, Budget, BudgetExpense, BudgetIncome, Category, Purchase, PurchaseRollup
+from money import format_money
+from purchase_rollups import category_totals
+from extensions import db
+
+dashboard_bp = Blueprint('dashboard', __name__)
+
+DEFAULT_RECENT_PURCHASES = 10
+MAX_RECENT_PURCHASES = 50
+
+def item_total(column, budget_column):
+    return select(func.coalesce(func.sum(column), 0)).where(budget_column == Budget.id).correlate(Budget).scalar_subquery()
+
+# Totals of every budget of a user in one query (no items are loaded)
+def budget_summaries(user_id):
+    rows = db.session.execute(
+        select(
+            Budget,
+            item_total(BudgetIncome.amount, BudgetIncome.budget_id),
+            item_total(BudgetExpense.amount, BudgetExpense.budget_id),
+            item_total(PurchaseRollup.total, PurchaseRollup.budget_id)
+        ).where(Budget.user_id == user_id).order_by(Budget.id)
+    ).all()
+    return [{
+        "id": budget.id,
+        "version": budget.version,
+        "title": budget.title,
+        "method": budget.method,
+        "period": budget.period,
+        "updatedAt": budget.updated_at.strftime("%d/%m/%y") if budget.updated_at else None,
+        "total_income": format_money(total_income),
+        "total_expenses": format_money(total_expenses),
+        "balance_after_expenses": format_money(total_income - total_expenses),
+        "unassigned_amount": format_money(budget.unassigned_amount),
+        "total_spent": format_money(total_spent),
+        "last_change": budget.updated_at or budget.created_at or datetime.min
+    } for budget, total_income, total_expenses, total_spent in rows]
+
+# Categories of a budget with what was spent against each and what is left
+def category_spending(budget_id):
+    spending = category_totals(budget_id)
+    categories = Category.query.filter_by(budget_id=budget_id).order_by(Category.priority, Category.id).all()
+    return [{
+        **category.to_json(),
+        "spent": format_money(spending.get(category.id, 0)),
+        "remaining": format_money(category.allocated_amount - spending.get(category.id, 0))
+    } for category in categories], spending.get(None, 0)
+
+def recent_purchases(budget_id, count):
+    if count == 0:
+        return []
+    purchases = Purchase.query.options(joinedload(Purchase.budget_expense)).filter(
+        Purchase.budget_id == budget_id
+    ).order_by(Purchase.date.desc(), Purchase.id.desc()).limit(count).all()
+    return [purchase.to_json() for purchase in purchases]
+
+@dashboard_bp.route("/api/users/<int:user_id>/dashboard", methods=["GET"])
+def get_dashboard(user_id):
+    try:
+        user = Users.query.options(
+            selectinload(Users.initial_incomes), selectinload(Users.initial_expenses)
+        ).filter_by(id=user_id).first()
+        if not user:
+            return jsonify({"status": "error", "msg": "User not found"}), 404
+
+        count = request.args.get("purchases", DEFAULT_RECENT_PURCHASES, type=int)
+        if not 0 <= count <= MAX_RECENT_PURCHASES:
+            return jsonify({"status": "error", "msg": f"purchases must be between 0 and {MAX_RECENT_PURCHASES}"}), 400
+
+        budgets = budget_summaries(user_id)
+        budget_id = request.args.get("budget_id", type=int)
+        if budget_id is not None:
+            active = next((budget for budget in budgets if budget["id"] == budget_id), None)
+            if active is None:
+                return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        else:
+            active = max(budgets, key=lambda budget: (budget["last_change"], budget["id"]), default=None)
+        for budget in budgets:
+            del budget["last_change"]
+
+        active_budget = None
+        if active is not None:
+            categories, uncategorized_spent = category_spending(active["id"])
+            active_budget = {
+                **active,
+                "categories": categories,
+                "uncategorized_spent": format_money(uncategorized_spent),
+                "recent_purchases": recent_purchases(active["id"], count)
+            }
+
+        return jsonify({
+            "user": user.to_json(),
+            "budgets": budgets,
+            "active_budget": active_budget
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,111 @@
+# db_routing.py by Eden Pardo
+# Optional read/write routing: GET/HEAD requests use a read-only engine, writes use the primary.
+#   DB_READ_ROUTING=1                         turn routing on
+#   SQLALCHEMY_READ_DATABASE_URI=<uri>        replica to read from (SQLite: defaults to the
+#                                             primary file opened with mode=ro)
+#   READ_YOUR_WRITES_SECONDS=5                after a write, that user's reads stay on the primary
+import os
+import threading
+import time
+from flask import request, g, current_app
+from sqlalchemy.engine import make_url
+from models import Budget
+from extensions import db
+
+READ_METHODS = ["GET", "HEAD"]
+DEFAULT_READ_YOUR_WRITES_SECONDS = 5
+
+# Prune expired entries once the map grows past this size
+RECENT_WRITES_PRUNE_SIZE = 10000
+
+# (kind, id) --> time of the last successful write, e.g. ("user", 3) or ("budget", 7)
+recent_writes = {}
+recent_writes_lock = threading.Lock()
+
+# Build a read-only SQLite URI for the same database file
+def sqlite_read_only_uri(database_uri):
+    url = make_url(database_uri)
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        return None
+    if url.query.get("uri"):
+        return url.update_query_dict({"mode": "ro"}).render_as_string(hide_password=False)
+    return f"sqlite:///file:{url.database}?mode=ro&uri=true"
+
+# Call before db.init_app(app): registers the read engine as the "read" bind and the request hooks
+def init_read_routing(app):
+    app.config.setdefault("DB_READ_ROUTING", os.environ.get("DB_READ_ROUTING") == "1")
+    app.config.setdefault("SQLALCHEMY_READ_DATABASE_URI", os.environ.get("SQLALCHEMY_READ_DATABASE_URI"))
+    app.config.setdefault("READ_YOUR_WRITES_SECONDS",
+                          float(os.environ.get("READ_YOUR_WRITES_SECONDS", DEFAULT_READ_YOUR_WRITES_SECONDS)))
+
+    if not app.config["DB_READ_ROUTING"]:
+        return
+
+    read_uri = app.config["SQLALCHEMY_READ_DATABASE_URI"] or sqlite_read_only_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+    if not read_uri:
+        # Nothing to route to (e.g. in-memory SQLite without a replica)
+        app.config["DB_READ_ROUTING"] = False
+        return
+
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds["read"] = read_uri
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    app.before_request(route_request)
+    app.after_request(record_write)
+
+def write_keys():
+    view_args = request.view_args or {}
+    keys = []
+    if "user_id" in view_args:
+        keys.append(("user", view_args["user_id"]))
+    if "budget_id" in view_args:
+        keys.append(("budget", view_args["budget_id"]))
+    return keys
+
+def written_recently(keys, window):
+    now = time.monotonic()
+    with recent_writes_lock:
+        return any(now - recent_writes.get(key, float("-inf")) < window for key in keys)
+
+def route_request():
+    if request.method not in READ_METHODS:
+        return
+
+    window = current_app.config["READ_YOUR_WRITES_SECONDS"]
+
+    keys = write_keys()
+    if recent_writes and keys:
+        view_args = request.view_args or {}
+        # Budget routes do not carry the user id: check the owner too while writes are recent
+        if "budget_id" in view_args and "user_id" not in view_args:
+            owner_id = db.session.query(Budget.user_id).filter_by(id=view_args["budget_id"]).scalar()
+            if owner_id is not None:
+                keys.append(("user", owner_id))
+        if written_recently(keys, window):
+            return
+
+    g.use_read_engine = True
+
+def record_write(response):
+    if request.method in READ_METHODS or response.status_code >= 400:
+        return response
+
+    keys = write_keys()
+    view_args = request.view_args or {}
+    if "budget_id" in view_args and "user_id" not in view_args:
+        owner_id = db.session.query(Budget.user_id).filter_by(id=view_args["budget_id"]).scalar()
+        if owner_id is not None:
+            keys.append(("user", owner_id))
+    if not keys:
+        return response
+
+    now = time.monotonic()
+    with recent_writes_lock:
+        for key in keys:
+            recent_writes[key] = now
+        if len(recent_writes) > RECENT_WRITES_PRUNE_SIZE:
+            window = current_app.config["READ_YOUR_WRITES_SECONDS"]
+            for key in [k for k, written_at in recent_writes.items() if now - written_at >= window]:
+                del recent_writes[key]
+    return response
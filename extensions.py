@@ -1,8 +1,45 @@
 #extensions.py by Eden Pardo
+from flask import g, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+import sqlite3
+
+# Session that picks an engine per query:
+#  - the user's shard when sharding is on (see sharding.py), except for tables marked "global"
+#  - the read-only engine when the current request was routed to it (see db_routing.py)
+#  - the primary engine otherwise
+# Inside an atomic batch (batch_routes.py) every engine is swapped for the batch's open connection,
+# so commits in the routes only end the session's transaction and the batch decides at the end.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = self.route_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        batch = self.info.get("atomic_batch")
+        if batch is not None and isinstance(engine, Engine):
+            return batch.connection(engine)
+        return engine
+
+    def route_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get("shard") is not None:
+            if mapper is None or not sa_inspect(mapper).local_table.info.get("global"):
+                return self._db.engines[f"shard_{g.shard}"]
+        if bind is None and has_request_context() and g.get("use_read_engine") and "atomic_batch" not in self.info:
+            read_engine = self._db.engines.get("read")
+            if read_engine is not None:
+                return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+# SQLite ignores foreign keys (and ON DELETE CASCADE) unless every connection turns them on
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 #Creating db isntance
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # By moving db initialization to a separate file (extensions.py)
-# this breaks the circular dependency of previous db initializaing in app.py
\ No newline at end of file
+# this breaks the circular dependency of previous db initializaing in app.py
@@ -1,11 +1,161 @@
-from flask import Blueprint, request, jsonify
-from models import Users, Budget, InitialExpense, InitialIncome, BudgetExpense, BudgetIncome
+# fiftythirtytwenty_budget_routes.py by Eden Pardo
+# 50-30-20 budgets: income is split into Needs (50%), Wants (30%) and Savings (20%). The three
+# categories are created with the budget, and their allocations are recomputed from the total
+# income in the same transaction as every income change.
+from decimal import Decimal
+from flask import Blueprint, jsonify
+from models import Budget, BudgetExpense, Category
 from extensions import db
-from copy import deepcopy
-from base_budget_routes import* 
+from constants import VALID_CATEGORIES_503020, SPLIT_503020
+from money import to_money, format_money
+from purchase_rollups import category_totals
+from pyf_budget_routes import budget_total_income
 
-fiftythirtytwenty_budget_bp = Blueprint("budget", __name__)
+# Split the income into the three allocations. Savings takes the rounding remainder so the
+# allocations always add up to the income exactly.
+def split_503020_income(total_income):
+    allocations = {}
+    for title in VALID_CATEGORIES_503020[:-1]:
+        allocations[title] = to_money(total_income * Decimal(SPLIT_503020[title]) / 100)
+    allocations[VALID_CATEGORIES_503020[-1]] = total_income - sum(allocations.values())
+    return allocations
 
-@fiftythirtytwenty_budget_bp.route("/api/users/<int:user_id>/budget", methods=["POST"])
-def create_budget(user_id):
-    pass
\ No newline at end of file
+def create_503020_categories(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            raise ValueError("Budget not found")
+
+        allocations = split_503020_income(budget_total_income(budget_id))
+        categories = []
+        for priority, title in enumerate(VALID_CATEGORIES_503020, start=1):
+            category = Category(
+                title=title,
+                priority=priority,
+                budget_id=budget.id,
+                description=f"The 50-30-20 Budgeting method puts {SPLIT_503020[title]}% of income towards {title}.",
+                allocated_amount=allocations[title],
+                is_savings=title == "Savings"
+            )
+            db.session.add(category)
+            categories.append(category)
+        db.session.flush()  # Save categories without committing yet
+        return categories
+
+    except Exception as e:
+        raise e
+
+# Recompute the allocations from the current total income. Call before committing an income
+# change so both are saved together. Does not commit.
+def update_503020_allocations(budget_id):
+    db.session.flush()
+    allocations = split_503020_income(budget_total_income(budget_id))
+    categories = Category.query.filter(
+        Category.budget_id == budget_id,
+        Category.title.in_(VALID_CATEGORIES_503020)
+    ).all()
+    for category in categories:
+        if category.allocated_amount != allocations[category.title]:
+            category.allocated_amount = allocations[category.title]
+    return categories
+
+# Spent vs allocated for each bucket. Totals come from SQL aggregates (purchase rollups and
+# SUM of expenses per category), never from a loop over purchases.
+def fifty_thirty_twenty_calculation(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return {"status": "error", "msg": "Budget not found"}, 404
+
+        total_income = budget_total_income(budget_id)
+        categories = Category.query.filter_by(budget_id=budget_id).all()
+        spent_by_category = category_totals(budget_id)
+        planned_by_category = dict(db.session.query(
+            BudgetExpense.category_id,
+            db.func.sum(BudgetExpense.amount)
+        ).filter(BudgetExpense.budget_id == budget_id).group_by(BudgetExpense.category_id).all())
+
+        buckets = []
+        recommendations = []
+        for category in sorted(categories, key=lambda c: c.priority):
+            spent = spent_by_category.get(category.id, 0)
+            planned = planned_by_category.get(category.id) or 0
+            remaining = category.allocated_amount - spent
+            buckets.append({
+                "id": category.id,
+                "title": category.title,
+                "target_percent": SPLIT_503020.get(category.title),
+                "allocated_amount": format_money(category.allocated_amount),
+                "planned_expenses": format_money(planned),
+                "spent": format_money(spent),
+                "remaining": format_money(remaining),
+                "spent_percent_of_income": round(float(spent * 100 / total_income), 1) if total_income else None
+            })
+            if spent > category.allocated_amount:
+                recommendations.append(f"Overspending detected: '{category.title}' is overspent by ${spent - category.allocated_amount:.2f}")
+            if planned > category.allocated_amount:
+                recommendations.append(
+                    f"Planned expenses in '{category.title}' exceed its {SPLIT_503020.get(category.title)}% share by ${planned - category.allocated_amount:.2f}."
+                )
+
+        unassigned_spent = spent_by_category.get(None, 0)
+        if unassigned_spent:
+            recommendations.append(
+                f"${unassigned_spent:.2f} of purchases are not linked to an expense. Link them so they count towards Needs, Wants or Savings."
+            )
+
+        total_spent = sum(spent_by_category.values())
+        if total_spent > total_income:
+            recommendations.append(
+                f"Warning: You have exceeded your total income for this budget period by ${total_spent - total_income:.2f}."
+            )
+        if not recommendations:
+            recommendations.append("Nice! Spending is within the 50-30-20 split.")
+
+        return {
+            "status": "analyzed",
+            "total_income": format_money(total_income),
+            "total_spent": format_money(total_spent),
+            "unassigned_spent": format_money(unassigned_spent),
+            "buckets": buckets,
+            "recommendations": recommendations
+        }, 200
+
+    except Exception as e:
+        return {"status": "error", "msg": str(e)}, 500
+
+fiftythirtytwenty_budget_bp = Blueprint("fifty_thirty_twenty", __name__)
+
+# Create the Needs/Wants/Savings categories for a 50-30-20 budget that does not have them yet
+@fiftythirtytwenty_budget_bp.route("/api/budgets/<int:budget_id>/50-30-20-budget", methods=["POST"])
+def create_503020_budget_route(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if budget.method.lower() != "50-30-20":
+            return jsonify({"status": "error", "msg": "Budget does not use the 50-30-20 method."}), 400
+        if Category.query.filter(Category.budget_id == budget_id, Category.title.in_(VALID_CATEGORIES_503020)).first():
+            return jsonify({"status": "error", "msg": "50-30-20 categories already exist."}), 400
+
+        categories = create_503020_categories(budget_id)
+        db.session.commit()
+        return jsonify({
+            "msg": "50-30-20 categories created successfully.",
+            "categories": [category.to_json() for category in categories]
+        }), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+# Spent vs allocated per bucket
+@fiftythirtytwenty_budget_bp.route("/api/budgets/<int:budget_id>/50-30-20", methods=["GET"])
+def get_503020_analysis(budget_id):
+    budget = Budget.query.get(budget_id)
+    if not budget:
+        return jsonify({"status": "error", "msg": "Budget not found"}), 404
+    if budget.method.lower() != "50-30-20":
+        return jsonify({"status": "error", "msg": "Budget does not use the 50-30-20 method."}), 400
+
+    result, status = fifty_thirty_twenty_calculation(budget_id)
+    return jsonify(result), status
@@ -0,0 +1,118 @@
+# forecast_routes.py by Eden Pardo
+# Cash-flow forecast for the next N budget periods. Incomes and expenses are summed per frequency
+# in SQL, laid out on a weekly grid as NumPy arrays (VALID_PERIODS counts in weeks) and summed per
+# budget period, so running balances, savings and the first shortfall take a few array operations
+# whatever the horizon. Amounts stay in integer cents until they are formatted.
+# An item with a frequency of n weeks is paid in week 0, n, 2n, ... of the forecast.
+from decimal import Decimal
+import numpy as np
+from flask import Blueprint, request, jsonify
+from models import Budget, BudgetExpense, BudgetIncome, Category
+from extensions import db
+from constants import VALID_FREQUENCIES, VALID_PERIODS
+from money import to_money, format_money, MINOR_UNITS
+
+forecast_bp = Blueprint('forecast', __name__)
+
+DEFAULT_FORECAST_PERIODS = 12
+MAX_FORECAST_PERIODS = 260
+
+# Rows of the flow matrix
+FLOW_KINDS = ["income", "expense", "savings"]
+
+def empty_flows():
+    return {kind: {frequency: Decimal(0) for frequency in VALID_FREQUENCIES} for kind in FLOW_KINDS}
+
+# Budget totals per frequency: {"income": {"weekly": Decimal, ...}, "expense": {...}, "savings": {...}}.
+# Savings are the expenses linked to a savings category (they are also counted as expenses).
+def budget_flows(budget_id):
+    flows = empty_flows()
+    incomes = db.session.query(
+        db.func.lower(BudgetIncome.frequency), db.func.sum(BudgetIncome.amount)
+    ).filter(BudgetIncome.budget_id == budget_id).group_by(db.func.lower(BudgetIncome.frequency)).all()
+    expenses = db.session.query(
+        db.func.lower(BudgetExpense.frequency), db.func.coalesce(Category.is_savings, False), db.func.sum(BudgetExpense.amount)
+    ).outerjoin(Category, BudgetExpense.category_id == Category.id).filter(
+        BudgetExpense.budget_id == budget_id
+    ).group_by(db.func.lower(BudgetExpense.frequency), db.func.coalesce(Category.is_savings, False)).all()
+
+    for frequency, total in incomes:
+        if frequency in VALID_PERIODS:
+            flows["income"][frequency] += total or 0
+    for frequency, is_savings, total in expenses:
+        if frequency in VALID_PERIODS:
+            flows["expense"][frequency] += total or 0
+            if is_savings:
+                flows["savings"][frequency] += total or 0
+    return flows
+
+def to_cents_array(values):
+    return np.array([int(to_money(value) * MINOR_UNITS) for value in values], dtype=np.int64)
+
+def from_cents(value):
+    return format_money(Decimal(int(value)) / MINOR_UNITS)
+
+# Forecast `periods` periods of `period` (a frequency) starting from start_balance.
+# flows is the dict returned by budget_flows().
+def cash_flow_forecast(flows, period, periods, start_balance=0):
+    period_weeks = VALID_PERIODS[period.lower()]
+    weeks = np.arange(periods * period_weeks)
+    steps = np.array([VALID_PERIODS[frequency] for frequency in VALID_FREQUENCIES])
+
+    # (frequencies, weeks): 1 where an item of that frequency is paid that week
+    schedule = (weeks[np.newaxis, :] % steps[:, np.newaxis] == 0).astype(np.int64)
+    # (kinds, frequencies) @ (frequencies, weeks) --> (kinds, weeks) --> (kinds, periods)
+    amounts = np.vstack([to_cents_array(flows[kind][frequency] for frequency in VALID_FREQUENCIES) for kind in FLOW_KINDS])
+    per_period = (amounts @ schedule).reshape(len(FLOW_KINDS), periods, period_weeks).sum(axis=2)
+    income, expense, savings = per_period
+
+    net = income - expense
+    balance = int(to_money(start_balance) * MINOR_UNITS) + np.cumsum(net)
+    saved = np.cumsum(savings)
+    shortfalls = np.flatnonzero(balance < 0)
+
+    return {
+        "period": period,
+        "periods": periods,
+        "start_balance": format_money(start_balance),
+        "ending_balance": from_cents(balance[-1]),
+        "lowest_balance": from_cents(balance.min()),
+        "first_shortfall_period": int(shortfalls[0]) + 1 if shortfalls.size else None,
+        "total_income": from_cents(income.sum()),
+        "total_expenses": from_cents(expense.sum()),
+        "total_saved": from_cents(saved[-1]),
+        "forecast": [{
+            "period": index + 1,
+            "income": from_cents(row[0]),
+            "expenses": from_cents(row[1]),
+            "net": from_cents(row[2]),
+            "balance": from_cents(row[3]),
+            "saved_to_date": from_cents(row[4])
+        } for index, row in enumerate(np.column_stack([income, expense, net, balance, saved]).tolist())]
+    }
+
+# Query string: periods (1-260, default 12) and start_balance (default 0)
+@forecast_bp.route("/api/budgets/<int:budget_id>/forecast", methods=["GET"])
+def get_budget_forecast(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+
+        periods = request.args.get("periods", DEFAULT_FORECAST_PERIODS, type=int)
+        if not 1 <= periods <= MAX_FORECAST_PERIODS:
+            return jsonify({"status": "error", "msg": f"periods must be between 1 and {MAX_FORECAST_PERIODS}"}), 400
+        try:
+            start_balance = to_money(request.args.get("start_balance", 0))
+            if not start_balance.is_finite():
+                raise ValueError # NaN would fail when converted to cents
+        except (ValueError, ArithmeticError):
+            return jsonify({"status": "error", "msg": "start_balance must be a number"}), 400
+        if budget.period.lower() not in VALID_PERIODS:
+            return jsonify({"status": "error", "msg": f"Budget period '{budget.period}' cannot be forecast"}), 400
+
+        result = cash_flow_forecast(budget_flows(budget_id), budget.period.lower(), periods, start_balance)
+        return jsonify({"budget_id": budget.id, **result}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
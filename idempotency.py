@@ -0,0 +1,121 @@
+# idempotency.py by Eden Pardo
+# POST requests may send an `Idempotency-Key` header. The first request runs normally and its
+# response is stored; retries with the same key and body get the stored response back without
+# running the route again (no duplicate purchases/budgets, no extra recalculation).
+#   IDEMPOTENCY_TTL_SECONDS=86400     how long keys are kept
+import click
+import hashlib
+import os
+from datetime import datetime, timedelta
+from flask import request, g, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from models import IdempotencyKey
+from extensions import db
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+MAX_KEY_LENGTH = 255
+
+# Answers that only mean "not now": the key is released so a retry runs the request again
+RETRYABLE_STATUSES = [409, 429]
+
+def request_hash():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode("utf-8"))
+    digest.update(request.path.encode("utf-8"))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+def error_response(status, msg):
+    return current_app.response_class(
+        current_app.json.dumps({"status": "error", "msg": msg}), status=status, mimetype="application/json"
+    )
+
+# before_request hook: replay a stored response or claim the key for this request
+def check_idempotency_key():
+    if request.method != "POST":
+        return None
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return None
+    if len(key) > MAX_KEY_LENGTH:
+        return error_response(400, f"{IDEMPOTENCY_HEADER} too long (max {MAX_KEY_LENGTH} chars)")
+
+    table = IdempotencyKey.__table__
+    path = request.path
+    body_hash = request_hash()
+    now = datetime.utcnow()
+
+    with db.engine.begin() as connection:
+        stored = connection.execute(select(table).where(table.c.key == key, table.c.path == path)).first()
+        if stored is not None and stored.expires_at <= now:
+            connection.execute(delete(table).where(table.c.id == stored.id))
+            stored = None
+
+        if stored is not None:
+            if stored.request_hash != body_hash:
+                return error_response(422, f"{IDEMPOTENCY_HEADER} was already used with a different request.")
+            if stored.status_code is None:
+                return error_response(409, "A request with this Idempotency-Key is still being processed.")
+            response = current_app.response_class(stored.response_body, status=stored.status_code, mimetype="application/json")
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            result = connection.execute(insert(table).values(
+                key=key,
+                path=path,
+                request_hash=body_hash,
+                created_at=now,
+                expires_at=now + timedelta(seconds=current_app.config["IDEMPOTENCY_TTL_SECONDS"])
+            ))
+        except IntegrityError:
+            # Another request with the same key claimed it first
+            return error_response(409, "A request with this Idempotency-Key is still being processed.")
+
+    g.idempotency_key_id = result.inserted_primary_key[0]
+    return None
+
+# after_request hook: store the response for retries (server errors, conflicts and rate limits are
+# not stored so they can be retried)
+def store_idempotent_response(response):
+    key_id = g.pop("idempotency_key_id", None)
+    if key_id is None:
+        return response
+
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+            connection.execute(delete(table).where(table.c.id == key_id))
+        else:
+            connection.execute(update(table).where(table.c.id == key_id).values(
+                status_code=response.status_code,
+                response_body=response.get_data(as_text=True)
+            ))
+    return response
+
+# teardown hook: release the key if the request died before after_request ran
+def release_idempotency_key(exc=None):
+    key_id = g.pop("idempotency_key_id", None)
+    if key_id is not None:
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(delete(table).where(table.c.id == key_id))
+
+def purge_expired_keys():
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(delete(table).where(table.c.expires_at <= datetime.utcnow())).rowcount
+
+def init_idempotency(app):
+    app.config.setdefault("IDEMPOTENCY_TTL_SECONDS", int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", DEFAULT_TTL_SECONDS)))
+    app.before_request(check_idempotency_key)
+    app.after_request(store_idempotent_response)
+    app.teardown_request(release_idempotency_key)
+
+@click.command("purge-idempotency-keys")
+@with_appcontext
+def purge_idempotency_keys_command():
+    click.echo(f"Deleted {purge_expired_keys()} expired idempotency keys.")
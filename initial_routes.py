@@ -1,6 +1,8 @@
 # initial_routes.py by Eden Pardo
 from flask import Blueprint, request, jsonify
 from models import Users, InitialExpense, InitialIncome
+from money import to_money
+from read_paths import INITIAL_INCOMES, INITIAL_EXPENSES, sparse_fieldset, pick
 from extensions import db
 
 initial_bp = Blueprint('initial', __name__)
@@ -28,14 +30,14 @@ def add_initial_income(user_id):
         if len(income_title) > 100:
             return jsonify({"status": "error", "msg": "Title too long"}), 400
 
-        if float(data['amount']) < 0:
+        if to_money(data['amount']) < 0:
             return jsonify({"status":"error","msg": "Amount cannot be negative"}), 400
         
         if data['frequency'] not in ["weekly", "biweekly", "monthly", "yearly"]:
             return jsonify({"status":"error", "msg": "Frquency must be 'weekly', 'biweekly', 'monthly', or 'yearly'"}), 400
 
         # Create new income
-        new_income = InitialIncome(title=data['title'], amount=data['amount'], frequency=data['frequency'], user_id=user_id)
+        new_income = InitialIncome(title=data['title'], amount=to_money(data['amount']), frequency=data['frequency'], user_id=user_id)
         db.session.add(new_income)
         db.session.commit()
 
@@ -64,7 +66,7 @@ def update_initial_income(user_id, income_id):
                 return jsonify({"status": "error", "msg": "Title too long"}), 400
 
         if 'amount' in data:
-            if float(data['amount']) < 0:
+            if to_money(data['amount']) < 0:
                 return jsonify({"status":"error", "msg": "Amount cannot be negative"}), 400
             
         if 'frequency' in data:
@@ -73,7 +75,7 @@ def update_initial_income(user_id, income_id):
 
         # Update the income fields if provided and validated
         income.title = data.get("title", income.title)
-        income.amount = data.get("amount", income.amount)
+        income.amount = to_money(data.get("amount", income.amount))
         income.frequency = data.get("frequency", income.frequency)
 
         db.session.commit()
@@ -87,24 +89,31 @@ def update_initial_income(user_id, income_id):
 @initial_bp.route("/api/users/<int:user_id>/initial-incomes", methods=["GET"])
 def get_all_initial_incomes(user_id):
     try:
+        keys, _ = sparse_fieldset(INITIAL_INCOMES)
         user = Users.query.get(user_id)
         if user is None:
             return jsonify({"status":"error", "msg":"User not found"}), 404
         
-        incomes = [income.to_json() for income in user.initial_incomes]
-        return jsonify(incomes), 200
+        return jsonify(INITIAL_INCOMES.list(user_id, keys)), 200
     
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
     
 # Get specific initial income
 @initial_bp.route("/api/users/<int:user_id>/initial-incomes/<int:income_id>", methods=["GET"])
 def get_specific_income(user_id, income_id):
+        try:
+            keys, _ = sparse_fieldset(INITIAL_INCOMES)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
         income = InitialIncome.query.filter_by(id=income_id, user_id=user_id).first()
         if not income:
             return jsonify({"status":"error", "msg": "Income not found"}), 404
         
-        return jsonify(income.to_json())
+        return jsonify(pick(income.to_json(), keys))
 
 # Delete an initial income
 @initial_bp.route("/api/users/<int:user_id>/initial-incomes/<int:income_id>", methods=["DELETE"])
@@ -138,7 +147,7 @@ def add_initial_expense(user_id):
         if missing_fields:
             return jsonify({"status":"error", "msg":f"Missing required field: {', '.join(missing_fields)}"}), 400
         
-        if float(data['amount']) < 0:
+        if to_money(data['amount']) < 0:
             return jsonify({"status":"error","msg": "Amount cannot be negative"}), 400
         
         expense_title = data["title"].strip()
@@ -151,7 +160,7 @@ def add_initial_expense(user_id):
             return jsonify({"status":"error", "msg": "Frquency must be 'weekly', 'biweekly', 'monthly', or 'yearly'"}), 400
 
         # Create new expense category
-        new_expense = InitialExpense(title=data['title'], amount=data['amount'], frequency=data['frequency'], user_id=user_id)
+        new_expense = InitialExpense(title=data['title'], amount=to_money(data['amount']), frequency=data['frequency'], user_id=user_id)
         db.session.add(new_expense)
         db.session.commit()
 
@@ -172,7 +181,7 @@ def update_initial_expense(user_id, expense_id):
         data = request.json
 
         if 'amount' in data:
-            if float(data['amount']) < 0:
+            if to_money(data['amount']) < 0:
                 return jsonify({"status":"error", "msg": "Amount cannot be negative"}), 400
         
         if 'title' in data:
@@ -188,7 +197,7 @@ def update_initial_expense(user_id, expense_id):
 
         # Update the expense fields if provided and validated
         expense.title = data.get("title", expense.title)
-        expense.amount = data.get("amount", expense.amount)
+        expense.amount = to_money(data.get("amount", expense.amount))
         expense.frequency = data.get("frequency", expense.frequency)
 
         db.session.commit()
@@ -202,24 +211,31 @@ def update_initial_expense(user_id, expense_id):
 @initial_bp.route("/api/users/<int:user_id>/initial-expenses", methods=["GET"])
 def get_all_initial_expenses(user_id):
     try:
+        keys, _ = sparse_fieldset(INITIAL_EXPENSES)
         user = Users.query.get(user_id)
         if user is None:
             return jsonify({"status":"error", "msg":"User not found"}), 404
         
-        expenses = [expense.to_json() for expense in user.initial_expenses]
-        return jsonify(expenses), 200
+        return jsonify(INITIAL_EXPENSES.list(user_id, keys)), 200
     
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error":str(e)}), 500
 
 # Get specific initial expense
 @initial_bp.route("/api/users/<int:user_id>/initial-expenses/<int:expense_id>", methods=["GET"])
 def get_specific_expense(user_id, expense_id):
+        try:
+            keys, _ = sparse_fieldset(INITIAL_EXPENSES)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
         expense = InitialExpense.query.filter_by(id=expense_id, user_id=user_id).first()
         if not expense:
             return jsonify({"status":"error", "msg": "Expense not found"}), 404
         
-        return jsonify(expense.to_json())
+        return jsonify(pick(expense.to_json(), keys))
     
 # Delete an initial expense
 @initial_bp.route("/api/users/<int:user_id>/initial-expenses/<int:expense_id>", methods=["DELETE"])
@@ -0,0 +1,280 @@
+# migrations.py by Eden Pardo
+# One-time data migrations, run at startup after db.create_all()
+from datetime import datetime
+from sqlalchemy import inspect, text, select, insert, update, func, Float, Numeric
+from sqlalchemy.schema import CreateTable, AddConstraint
+from models import (Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                    PurchaseRollup, RecurringPurchase, SchemaMigration, ShardSequence, CHANGE_SEQUENCE)
+from purchase_rollups import rebuild_rollups
+from extensions import db
+
+MONEY_MIGRATION = "money_minor_units"
+ROLLUP_MIGRATION = "purchase_rollup_backfill"
+
+# Every money column that used to be db.Float
+MONEY_COLUMNS = [
+    (InitialIncome, "amount"),
+    (InitialExpense, "amount"),
+    (BudgetExpense, "amount"),
+    (BudgetIncome, "amount"),
+    (Category, "allocated_amount"),
+    (Purchase, "amount"),
+    (PurchaseRollup, "total"),
+]
+
+# Convert float dollar amounts to integer cents in databases created before money.Money existed.
+# Fresh databases already have integer columns and are only marked as migrated.
+def migrate_money_to_minor_units():
+    if db.session.get(SchemaMigration, MONEY_MIGRATION):
+        return False
+
+    inspector = inspect(db.engine)
+    dialect = db.engine.dialect.name
+    migrated = []
+
+    for model, column in MONEY_COLUMNS:
+        table = model.__tablename__
+        if not inspector.has_table(table):
+            continue
+        column_type = next(c["type"] for c in inspector.get_columns(table) if c["name"] == column)
+        if not isinstance(column_type, (Float, Numeric)):
+            continue
+
+        if dialect == "postgresql":
+            db.session.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT USING ROUND({column} * 100)"
+            ))
+        else:
+            # SQLite cannot change a column type; the REAL column just holds whole cents from now on
+            db.session.execute(text(
+                f"UPDATE {table} SET {column} = CAST(ROUND({column} * 100) AS INTEGER)"
+            ))
+        migrated.append(f"{table}.{column}")
+
+    db.session.add(SchemaMigration(name=MONEY_MIGRATION, applied_at=datetime.utcnow()))
+    db.session.commit()
+
+    if migrated:
+        print(f"Migrated money columns to cents: {', '.join(migrated)}")
+    return True
+
+# Columns added to existing tables after the first release: (model, column name)
+ADDED_COLUMNS = [
+    (Budget, "version"),
+    (BudgetExpense, "version"),
+    (BudgetIncome, "version"),
+    (Category, "version"),
+    (Purchase, "version"),
+    (Users, "deleted_at"),
+    (Budget, "deleted_at"),
+    (Budget, "items_version"),
+    (Budget, "unassigned_amount"),
+]
+
+# Tables with a change_seq column (delta sync, see sync_routes.py)
+CHANGE_SEQ_MODELS = [Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                     RecurringPurchase]
+ADDED_COLUMNS += [(model, "change_seq") for model in CHANGE_SEQ_MODELS]
+
+# Fill a newly added column from existing rows: (table, column) --> UPDATE statement
+COLUMN_BACKFILLS = {
+    ("budgets", "unassigned_amount"): (
+        "UPDATE budgets SET unassigned_amount = "
+        "COALESCE((SELECT SUM(amount) FROM budget_income WHERE budget_income.budget_id = budgets.id), 0) - "
+        "COALESCE((SELECT SUM(allocated_amount) FROM categories WHERE categories.budget_id = budgets.id), 0)"
+    ),
+}
+
+# db.create_all() never alters existing tables, so add any missing columns by hand.
+# Safe to run on every start (and on every shard engine).
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as connection:
+        for model, column_name in ADDED_COLUMNS:
+            table = model.__tablename__
+            if not inspector.has_table(table):
+                continue
+            if column_name in {c["name"] for c in inspector.get_columns(table)}:
+                continue
+            column = model.__table__.c[column_name]
+            column_type = column.type.compile(dialect=engine.dialect)
+            default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+            not_null = " NOT NULL" if not column.nullable and default else ""
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_type}{not_null}{default}"))
+            for index in model.__table__.indexes:
+                if column_name in index.columns:
+                    index.create(connection, checkfirst=True)
+            if (table, column_name) in COLUMN_BACKFILLS:
+                connection.execute(text(COLUMN_BACKFILLS[(table, column_name)]))
+            added.append(f"{table}.{column_name}")
+
+    if added:
+        print(f"Added columns: {', '.join(added)}")
+    return added
+
+# Indexes added to models.py after their table was created. Safe to run on every start (and on every shard engine).
+def add_missing_indexes(engine):
+    inspector = inspect(engine)
+    created = []
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    created.append(index.name)
+
+    if created:
+        print(f"Created indexes: {', '.join(created)}")
+    return created
+
+# Foreign keys whose ON DELETE rule in the database differs from models.py, or that models.py
+# no longer has (constraint None): [(table, fk constraint, foreign key in the database)]
+def outdated_foreign_keys(engine):
+    inspector = inspect(engine)
+    outdated = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {
+            tuple(fk["constrained_columns"]): fk for fk in inspector.get_foreign_keys(table.name)
+        }
+        for constraint in table.foreign_key_constraints:
+            if constraint.ondelete is None:
+                continue
+            current = existing.get(tuple(constraint.column_keys))
+            current_rule = (current or {}).get("options", {}).get("ondelete")
+            if (current_rule or "").upper() != constraint.ondelete.upper():
+                outdated.append((table, constraint, current))
+        modelled = {tuple(constraint.column_keys) for constraint in table.foreign_key_constraints}
+        for columns, current in existing.items():
+            if columns not in modelled:
+                outdated.append((table, None, current))
+    return outdated
+
+# Rows left behind by deletes from before the cascades existed (e.g. purchases of deleted budgets)
+# would break the new constraints: apply the ON DELETE rule to them now. Parents first.
+def clean_orphans(connection):
+    for table in db.metadata.sorted_tables:
+        for constraint in table.foreign_key_constraints:
+            if constraint.ondelete is None or not inspect(connection).has_table(table.name):
+                continue
+            column = constraint.column_keys[0]
+            target = constraint.elements[0].column
+            orphaned = (f"{column} IS NOT NULL AND {column} NOT IN "
+                        f"(SELECT {target.name} FROM {target.table.name})")
+            if constraint.ondelete.upper() == "CASCADE":
+                connection.execute(text(f"DELETE FROM {table.name} WHERE {orphaned}"))
+            else:
+                connection.execute(text(f"UPDATE {table.name} SET {column} = NULL WHERE {orphaned}"))
+
+# SQLite cannot alter a constraint: rebuild the table (create new, copy, drop old, rename),
+# following https://www.sqlite.org/lang_altertable.html#otheralter
+def rebuild_sqlite_table(connection, table):
+    new_name = f"{table.name}__new"
+    columns = ", ".join(c["name"] for c in inspect(connection).get_columns(table.name) if c["name"] in table.c)
+    create = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+    connection.execute(text(f"DROP TABLE IF EXISTS {new_name}")) # Left over from an interrupted run
+    connection.execute(text(create.replace(f"CREATE TABLE {table.name} (", f"CREATE TABLE {new_name} (", 1)))
+    connection.execute(text(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}"))
+    connection.execute(text(f"DROP TABLE {table.name}"))
+    connection.execute(text(f"ALTER TABLE {new_name} RENAME TO {table.name}"))
+    for index in table.indexes:
+        index.create(connection)
+
+# Switch existing databases to the ON DELETE CASCADE / SET NULL foreign keys from models.py
+# and drop the foreign keys it removed.
+# Safe to run on every start (and on every shard engine). Triggers on rebuilt SQLite tables
+# (search index) are dropped with the old table and recreated by init_search/create_shards.
+def add_delete_cascades(engine):
+    outdated = outdated_foreign_keys(engine)
+    if not outdated:
+        return []
+
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as connection:
+            # Must be set outside a transaction, and off while tables are swapped
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            connection.commit()
+            try:
+                with connection.begin():
+                    # Orphans first, while the old tables' triggers still keep the search index in sync
+                    clean_orphans(connection)
+                    for table in dict.fromkeys(table for table, _, _ in outdated):
+                        rebuild_sqlite_table(connection, table)
+            finally:
+                connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+                connection.commit()
+    else:
+        with engine.begin() as connection:
+            clean_orphans(connection)
+            for table, constraint, current in outdated:
+                if current is not None and current.get("name"):
+                    connection.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {current['name']}"))
+                if constraint is not None:
+                    connection.execute(AddConstraint(constraint))
+
+    updated = sorted({
+        f"{table.name}.{constraint.column_keys[0] if constraint is not None else current['constrained_columns'][0]}"
+        for table, constraint, current in outdated
+    })
+    print(f"Updated foreign keys: {', '.join(updated)}")
+    return updated
+
+# Rows from before the change sequence existed (change_seq = 0) get unique numbers above everything
+# handed out so far, and the sequence row is created if missing. Safe to run on every start.
+def backfill_change_sequence(engine):
+    inspector = inspect(engine)
+    sequence = ShardSequence.__table__
+    numbered = 0
+    with engine.begin() as connection:
+        next_seq = connection.execute(select(sequence.c.next_id).where(sequence.c.name == CHANGE_SEQUENCE)).scalar()
+        if next_seq is None:
+            next_seq = 1
+            connection.execute(insert(sequence).values(name=CHANGE_SEQUENCE, next_id=next_seq))
+
+        for model in CHANGE_SEQ_MODELS:
+            table = model.__table__
+            if not inspector.has_table(table.name):
+                continue
+            low, high, count = connection.execute(
+                select(func.min(table.c.id), func.max(table.c.id), func.count()).where(table.c.change_seq == 0)
+            ).one()
+            if not count:
+                continue
+            connection.execute(update(table).where(table.c.change_seq == 0).values(change_seq=table.c.id - low + next_seq))
+            next_seq += high - low + 1
+            numbered += count
+
+        connection.execute(update(sequence).where(sequence.c.name == CHANGE_SEQUENCE).values(next_id=next_seq))
+
+    if numbered:
+        print(f"Numbered {numbered} rows in the change sequence")
+    return numbered
+
+# Databases created before purchase_rollup existed have purchases but an empty rollup table:
+# build it from the purchases once. Shards are marked separately (create_shards passes the name).
+def backfill_purchase_rollups(name=ROLLUP_MIGRATION):
+    if db.session.get(SchemaMigration, name):
+        return False
+
+    count = rebuild_rollups()
+    db.session.add(SchemaMigration(name=name, applied_at=datetime.utcnow()))
+    db.session.commit()
+
+    if count:
+        print(f"Built {count} purchase rollup rows")
+    return True
+
+def run_migrations():
+    migrate_money_to_minor_units()
+    # After the money migration: backfilled money columns must be computed from cents
+    add_missing_columns(db.engine)
+    add_missing_indexes(db.engine)
+    backfill_change_sequence(db.engine)
+    # After the money migration: it looks for the old REAL columns a rebuild would replace
+    add_delete_cascades(db.engine)
+    backfill_purchase_rollups()
@@ -1,17 +1,23 @@
 # models.py by Eden Pardo
 from extensions import db
-from datetime import date
+from money import Money, format_money
+import json
+from datetime import date, datetime
 
 class Users(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(100), nullable = False)
     username = db.Column(db.String(100), nullable = False)
     password = db.Column(db.String(100), nullable = False) # Store hashed passwords
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True) # Set = soft-deleted, waiting for soft_delete.py to purge
+    # Position in this database's change sequence, set on every insert/update (sync_routes.py)
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
-    # Relationships
-    initial_incomes = db.relationship("InitialIncome", backref="user", lazy=True, cascade="all, delete-orphan")
-    initial_expenses = db.relationship("InitialExpense", backref="user", lazy=True, cascade="all, delete-orphan")
-    budgets = db.relationship("Budget", backref="user", lazy=True, cascade="all, delete-orphan")
+    # Relationships. Deleting a user is done by the database (ON DELETE CASCADE); passive_deletes
+    # stops SQLAlchemy from loading every child row just to delete it one by one
+    initial_incomes = db.relationship("InitialIncome", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    initial_expenses = db.relationship("InitialExpense", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    budgets = db.relationship("Budget", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
     
     # Taking user and convert to json
     def to_json(self):
@@ -25,32 +31,34 @@ class Users(db.Model):
 
 class InitialIncome(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title = db.Column(db.String(100), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     frequency = db.Column(db.String(100), nullable=False)
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
     def to_json(self):
         return {
             "id": self.id,
             "title": self.title,
-            "amount": self.amount,
+            "amount": format_money(self.amount),
             "frequency": self.frequency,
             "user_id": self.user_id
         }
 
 class InitialExpense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title = db.Column(db.String(100), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     frequency = db.Column(db.String(100), nullable=False)
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
     def to_json(self):
         return {
             "id": self.id,
             "title": self.title,
-            "amount": self.amount,
+            "amount": format_money(self.amount),
             "frequency": self.frequency,
             "user_id": self.user_id
         }
@@ -59,23 +67,36 @@ class Budget(db.Model):
     __tablename__ = 'budgets'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     title = db.Column(db.String(100), default=str(id))
     method = db.Column(db.String(100), nullable=False)
     period = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=lambda: date.today())
-    updated_at = db.Column(db.DateTime, default=lambda: date.today(),
-                           onupdate=lambda: date.today())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True) # Set = soft-deleted, waiting for soft_delete.py to purge
+    # Optimistic concurrency: every UPDATE/DELETE checks and bumps this (exposed as the ETag)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
+    # Bumped whenever a category, income or expense of this budget changes (allocation.py caches on it)
+    items_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Income minus category allocations, kept current by zerobased_budget_routes.py on every change
+    unassigned_amount = db.Column(Money, nullable=False, default=0, server_default="0")
 
-    expenses = db.relationship("BudgetExpense", backref="budget", lazy=True, cascade="all, delete-orphan")
-    incomes = db.relationship("BudgetIncome", backref="budget", lazy=True, cascade="all, delete-orphan")
-    categories = db.relationship("Category", backref="budget", lazy=True, cascade="all, delete-orphan")
+    # Purchases and rollups have no relationship here: the database cascade removes them too
+    expenses = db.relationship("BudgetExpense", backref="budget", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    incomes = db.relationship("BudgetIncome", backref="budget", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    categories = db.relationship("Category", backref="budget", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
 
     def to_json(self):
+        # Amounts are Decimals, so these sums are exact
+        total_income = sum(income.amount for income in self.incomes)
+        total_expenses = sum(expense.amount for expense in self.expenses)
         return {
             "id": self.id,
             "userId": self.user_id,
             "budget_id": self.id,
+            "version": self.version,
             "title": self.title,
             "method": self.method,
             "period": self.period,
@@ -83,29 +104,34 @@ class Budget(db.Model):
             "updatedAt": self.updated_at.strftime("%d/%m/%y") if self.updated_at else None,
             "expenses": [expense.to_json() for expense in self.expenses],
             "incomes": [income.to_json() for income in self.incomes],
-            "total_income": sum(income.amount for income in self.incomes),
-            "total_expenses": sum(expense.amount for expense in self.expenses),
+            "total_income": format_money(total_income),
+            "total_expenses": format_money(total_expenses),
             "all_categories": [category.to_json() for category in self.categories],
-            "balance_after_expenses": sum(income.amount for income in self.incomes) - sum(expense.amount for expense in self.expenses)
+            "balance_after_expenses": format_money(total_income - total_expenses),
+            "unassigned_amount": format_money(self.unassigned_amount)
         }
 
 class BudgetExpense(db.Model):
     __tablename__ = "budget_expense"
     id = db.Column(db.Integer, primary_key=True)
-    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id"), nullable=False)
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False, index=True)
     title = db.Column(db.String(100), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     frequency = db.Column(db.String(100), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey("categories.id"), nullable=True) # Allow null initially
+    category_id = db.Column(db.Integer, db.ForeignKey("categories.id", ondelete="SET NULL"), nullable=True) # Allow null initially
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
     # Relationship to category
-    category = db.relationship("Category", backref="expenses")
+    category = db.relationship("Category", backref=db.backref("expenses", passive_deletes=True))
 
     def to_json(self):
         return {
             "id": self.id,
             "budget_id": self.budget_id,
+            "version": self.version,
             "title": self.title,
-            "amount": self.amount,
+            "amount": format_money(self.amount),
             "frequency": self.frequency,
             "category_id": self.category_id,
             "category_name": self.category.title if self.category else None
@@ -113,61 +139,255 @@ class BudgetExpense(db.Model):
 
 class BudgetIncome(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id"), nullable=False)
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False, index=True)
     title = db.Column(db.String(100), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     frequency = db.Column(db.String(100), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
     def to_json(self):
         return {
             "id": self.id,
             "budget_id": self.budget_id,
+            "version": self.version,
             "title": self.title,
-            "amount": self.amount,
+            "amount": format_money(self.amount),
             "frequency": self.frequency
         }
 
 class Category(db.Model):
     __tablename__ = "categories"
     id = db.Column(db.Integer, primary_key=True)
-    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id"), nullable=False)
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False, index=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(100), nullable=True)
     # For 50/30/20 hard code these allocations
-    allocated_amount = db.Column(db.Float, nullable=False)
+    allocated_amount = db.Column(Money, nullable=False)
     priority = db.Column(db.Integer, nullable=False)
     is_savings = db.Column(db.Boolean, default=False) #Used for PYFB
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
     def to_json(self):
          return {
             "id": self.id,
             "budget_id": self.budget_id,
+            "version": self.version,
             "title": self.title,
             "description": self.description,
-            "allocated_amount": self.allocated_amount,
+            "allocated_amount": format_money(self.allocated_amount),
             "priority": self.priority,
             "is_savings": self.is_savings
         }
     
 class Purchase(db.Model):
+    # Latest purchases of a budget (dashboard) read straight from this index
+    __table_args__ = (db.Index("ix_purchase_budget_id_date", "budget_id", "date"),)
     id = db.Column(db.Integer, primary_key=True)
-    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id"), nullable=False)
-    budget_expense_id = db.Column(db.Integer, db.ForeignKey("budget_expense.id"), nullable=True)  # NULL = uncategorized
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False)
+    budget_expense_id = db.Column(db.Integer, db.ForeignKey("budget_expense.id", ondelete="SET NULL"), nullable=True)  # NULL = uncategorized
     title = db.Column(db.String(100), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(Money, nullable=False)
     date = db.Column(db.DateTime, default=lambda: date.today())
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
 
     # Relationship to BudgetExpense
-    budget_expense = db.relationship("BudgetExpense", backref="purchases")
+    budget_expense = db.relationship("BudgetExpense", backref=db.backref("purchases", passive_deletes=True))
 
     def to_json(self):
         return {
             "id": self.id,
             "budget_id": self.budget_id,
+            "version": self.version,
             "title": self.title,
-            "amount": self.amount,
+            "amount": format_money(self.amount),
             "date": self.date.strftime("%d/%m/%y") if self.date else None,
             "budget_expense_id": self.budget_expense_id,
             "budget_expense": self.budget_expense.title if self.budget_expense else None
         }
 
+
+# Rule that turns a budget expense into a purchase every `frequency` (recurring_routes.py runs them)
+class RecurringPurchase(db.Model):
+    __tablename__ = "recurring_purchase"
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False, index=True)
+    budget_expense_id = db.Column(db.Integer, db.ForeignKey("budget_expense.id", ondelete="CASCADE"), nullable=False, index=True)
+    title = db.Column(db.String(100), nullable=False)
+    amount = db.Column(Money, nullable=False)
+    frequency = db.Column(db.String(100), nullable=False)
+    start_date = db.Column(db.Date, nullable=False) # Occurrence n falls on start_date + n * frequency
+    occurrences = db.Column(db.Integer, nullable=False, default=0) # Purchases generated so far
+    next_run = db.Column(db.Date, nullable=False, index=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+    change_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0", index=True)
+
+    budget_expense = db.relationship("BudgetExpense")
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "budget_id": self.budget_id,
+            "budget_expense_id": self.budget_expense_id,
+            "budget_expense": self.budget_expense.title if self.budget_expense else None,
+            "title": self.title,
+            "amount": format_money(self.amount),
+            "frequency": self.frequency,
+            "start_date": self.start_date.strftime("%d/%m/%y") if self.start_date else None,
+            "next_run": self.next_run.strftime("%d/%m/%y") if self.next_run else None,
+            "occurrences": self.occurrences,
+            "active": self.active,
+            "lastRunAt": self.last_run_at.isoformat() if self.last_run_at else None
+        }
+
+
+# Deleted rows for delta sync (sync_routes.py): clients that synced before a delete learn about it here
+class ChangeTombstone(db.Model):
+    __tablename__ = "change_tombstone"
+    id = db.Column(db.Integer, primary_key=True)
+    change_seq = db.Column(db.BigInteger, nullable=False, index=True)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.BigInteger, nullable=False)
+    budget_id = db.Column(db.BigInteger, nullable=True)
+    user_id = db.Column(db.BigInteger, nullable=True, index=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Operations from offline clients that were already applied (oplog_routes.py), so replayed logs
+# are skipped and temporary ids keep resolving to the rows they created
+class ClientOperation(db.Model):
+    __tablename__ = "client_operation"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "client_id", "op_id", name="uq_client_operation"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    client_id = db.Column(db.String(100), nullable=False)
+    op_id = db.Column(db.String(100), nullable=False)
+    op = db.Column(db.String(20), nullable=False)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.BigInteger, nullable=True)
+    temp_id = db.Column(db.String(100), nullable=True) # Client's id for a created row
+    budget_id = db.Column(db.BigInteger, nullable=True)
+    client_ts = db.Column(db.DateTime, nullable=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Running purchase totals per (budget, expense, category, period bucket)
+# Kept up to date by purchase_rollups.py so analysis does not rescan every purchase
+class PurchaseRollup(db.Model):
+    __tablename__ = "purchase_rollup"
+    __table_args__ = (
+        db.UniqueConstraint("budget_id", "budget_expense_id", "category_id", "period_start", name="uq_purchase_rollup_key"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey("budgets.id", ondelete="CASCADE"), nullable=False, index=True)
+    budget_expense_id = db.Column(db.Integer, nullable=True) # NULL = uncategorized purchases
+    category_id = db.Column(db.Integer, nullable=True)
+    period_start = db.Column(db.Date, nullable=False)
+    total = db.Column(Money, nullable=False, default=0)
+    purchase_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_json(self):
+        return {
+            "budget_id": self.budget_id,
+            "budget_expense_id": self.budget_expense_id,
+            "category_id": self.category_id,
+            "period_start": self.period_start.strftime("%d/%m/%y") if self.period_start else None,
+            "total": format_money(self.total),
+            "purchase_count": self.purchase_count
+        }
+
+# One run of the nightly pay-yourself-first batch analysis (pyf_batch.py)
+class PyfBatchRun(db.Model):
+    __tablename__ = "pyf_batch_run"
+    __table_args__ = {"info": {"global": True}} # Lives in the main database even when sharding
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True) # NULL = interrupted or still running
+    budgets_processed = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "startedAt": self.started_at.isoformat() if self.started_at else None,
+            "finishedAt": self.finished_at.isoformat() if self.finished_at else None,
+            "budgets_processed": self.budgets_processed
+        }
+
+# Latest stored PYF recommendations for a budget
+class PyfAnalysisResult(db.Model):
+    __tablename__ = "pyf_analysis_result"
+    __table_args__ = {"info": {"global": True}}
+    id = db.Column(db.Integer, primary_key=True)
+    # Not a foreign key: with DB_SHARDS the budgets live in the shard files, not next to this table
+    budget_id = db.Column(db.BigInteger, nullable=False, unique=True)
+    run_id = db.Column(db.Integer, db.ForeignKey("pyf_batch_run.id", ondelete="CASCADE"), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    result = db.Column(db.Text, nullable=False) # JSON encoded output of pyf_recommendations
+    analyzed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_json(self):
+        return {
+            "budget_id": self.budget_id,
+            "run_id": self.run_id,
+            "status": self.status,
+            "result": json.loads(self.result),
+            "analyzedAt": self.analyzed_at.isoformat() if self.analyzed_at else None
+        }
+
+# Data migrations that have already run against this database (see migrations.py)
+class SchemaMigration(db.Model):
+    __tablename__ = "schema_migration"
+    __table_args__ = {"info": {"global": True}}
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+## Sharding (sharding.py): the directory lives in the main database,
+# everything not marked "global" lives in the user's shard
+class UserShard(db.Model):
+    __tablename__ = "user_shard"
+    __table_args__ = {"info": {"global": True}}
+    user_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    username = db.Column(db.String(100), nullable=False, unique=True)
+    shard = db.Column(db.Integer, nullable=False, index=True)
+
+class BudgetShard(db.Model):
+    __tablename__ = "budget_shard"
+    __table_args__ = {"info": {"global": True}}
+    budget_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.BigInteger, nullable=False, index=True)
+    shard = db.Column(db.Integer, nullable=False)
+
+# Next id to hand out per table inside one shard file. Each shard starts at
+# shard * SHARD_ID_STRIDE so ids never collide when users move between shards.
+# Every database also keeps its change sequence (sync_routes.py) here, under CHANGE_SEQUENCE.
+CHANGE_SEQUENCE = "change_seq"
+TOMBSTONES_PRUNED = "change_seq_pruned" # Highest change_seq of the tombstones pruned so far
+# First change_seq of a user moved to this shard (sharding.move_user): older cursors must resync
+USER_MOVED = "user_moved_{}"
+
+class ShardSequence(db.Model):
+    __tablename__ = "shard_sequence"
+    name = db.Column(db.String(100), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+# Stored responses for POST requests sent with an Idempotency-Key header (idempotency.py)
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        db.UniqueConstraint("key", "path", name="uq_idempotency_key_path"),
+        {"info": {"global": True}},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True) # NULL = first request still running
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,47 @@
+# money.py by Eden Pardo
+# Money is stored as integer minor units (cents) and handled as Decimal in Python,
+# so SQL SUM() is exact and totals never pick up float rounding errors.
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy.types import TypeDecorator, BigInteger
+
+CENTS = Decimal("0.01")
+MINOR_UNITS = 100
+
+# Convert user input (str/int/float/Decimal) to a Decimal rounded to cents
+def to_money(value):
+    if value is None:
+        return None
+    if not isinstance(value, Decimal):
+        # str() first so floats like 0.1 become Decimal("0.1"), not 0.1000000000000000055...
+        value = Decimal(str(value))
+    return value.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+# Serialize money for JSON responses as a decimal string, e.g. "12.50"
+def format_money(value):
+    if value is None:
+        return None
+    return str(to_money(value))
+
+# format_money() for an amount already in cents (read straight from a Money column), without Decimal
+def format_cents(cents):
+    if cents is None:
+        return None
+    if type(cents) is not int:
+        cents = int(round(cents)) # REAL affinity, see Money.process_result_value
+    units, rest = divmod(abs(cents), MINOR_UNITS)
+    return f"{'-' if cents < 0 else ''}{units}.{rest:02d}"
+
+class Money(TypeDecorator):
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(to_money(value) * MINOR_UNITS)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # SQLite columns migrated from FLOAT keep REAL affinity and hand back 1250.0
+        return to_money(Decimal(int(round(value))) / MINOR_UNITS)
@@ -0,0 +1,386 @@
+# oplog_routes.py by Eden Pardo
+# Offline clients upload everything they recorded while disconnected in one request instead of
+# replaying it call by call (and recalculating the budget after every call):
+# POST /api/users/<id>/operations
+# {"client_id": "phone-1", "operations": [
+#     {"op_id": "a1", "op": "create", "entity": "purchase", "id": "tmp-1", "budget_id": 3,
+#      "data": {"title": "Coffee", "amount": 4.5, "budget_expense_id": 12}, "client_ts": "2026-10-18T08:30:00Z"},
+#     {"op_id": "a2", "op": "update", "entity": "purchase", "id": "tmp-1", "budget_id": 3, "data": {"amount": 5}},
+#     {"op_id": "a3", "op": "delete", "entity": "category", "id": 7, "budget_id": 3, "version": 2}]}
+# Entities: purchase, budget_income, budget_expense, category, with the same checks (and rollup
+# bookkeeping) as their routes, which share them with this module.
+#  - Operations are applied in order in one transaction; the first one that fails rolls the log back.
+#  - "id" on a create is the client's temporary id. Later operations (and budget_expense_id /
+#    category_id in data) may use it, in this log or a later one; the response maps it to the real id.
+#  - op_ids already applied for this client_id are skipped, so a log can be re-sent after a dropped
+#    connection. "version" works like If-Match.
+#  - Every touched budget is recalculated once, after the commit.
+from datetime import datetime, time
+from flask import Blueprint, request, jsonify
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from models import Users, Budget, BudgetExpense, BudgetIncome, Category, Purchase, ClientOperation
+from validation import require, checked_title, checked_amount, parse_timestamp, checked_date
+from pyf_budget_routes import pyf_allocation_calculation
+from fiftythirtytwenty_budget_routes import update_503020_allocations
+from zerobased_budget_routes import check_zero_based_allocations
+from purchase_routes import add_purchase, change_purchase, remove_purchase, purchase_fields
+from budget_item_routes import item_amount, expense_category, set_expense_category, remove_expense
+from category_routes import (checked_priority, checked_description, unique_category_title, check_protected_fields,
+                             check_deletable)
+from recurring_routes import recalculate_budget
+from concurrency import precondition_failed
+from extensions import db
+
+oplog_bp = Blueprint('oplog', __name__)
+
+MAX_OPERATIONS = 500
+MAX_ID_LENGTH = 100
+OPERATIONS = ["create", "update", "delete"]
+
+ENTITY_MODELS = {
+    "purchase": Purchase,
+    "budget_income": BudgetIncome,
+    "budget_expense": BudgetExpense,
+    "category": Category,
+}
+
+# The row was changed since the client last saw it ("version" did not match)
+class VersionConflict(Exception):
+    pass
+
+class OperationLog:
+    """State of one upload: the user's budgets and the temporary ids created so far."""
+
+    def __init__(self, user_id, client_id):
+        self.user_id = user_id
+        self.client_id = client_id
+        self.budgets = {}
+        self.temp_ids = {} # (entity, temporary id) --> id
+        self.touched = {} # budget_id --> entities changed in it
+
+    def budget(self, budget_id):
+        if not isinstance(budget_id, int) or isinstance(budget_id, bool):
+            raise ValueError("budget_id must be a budget id")
+        if budget_id not in self.budgets:
+            budget = Budget.query.filter_by(id=budget_id, user_id=self.user_id).first()
+            if not budget:
+                raise LookupError(f"Budget {budget_id} not found")
+            self.budgets[budget_id] = budget
+        return self.budgets[budget_id]
+
+    # Real id for an id sent by the client: numbers are real ids, strings are temporary ids
+    def resolve(self, entity, ref):
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            return ref
+        if not isinstance(ref, str) or not ref:
+            raise ValueError(f"{entity} id must be a number or a temporary id")
+        if (entity, ref) not in self.temp_ids:
+            created = db.session.query(ClientOperation.entity_id).filter_by(
+                user_id=self.user_id, client_id=self.client_id, op="create", entity=entity, temp_id=ref
+            ).scalar()
+            if created is None:
+                raise LookupError(f"Unknown temporary id '{ref}' for {entity}")
+            self.temp_ids[(entity, ref)] = created
+        return self.temp_ids[(entity, ref)]
+
+    def row(self, entity, ref, budget):
+        row = ENTITY_MODELS[entity].query.filter_by(id=self.resolve(entity, ref), budget_id=budget.id).first()
+        if not row:
+            raise LookupError(f"{entity.replace('_', ' ').capitalize()} {ref} not found in budget {budget.id}")
+        return row
+
+    def expense(self, ref, budget):
+        if ref is None:
+            return None
+        try:
+            return self.row("budget_expense", ref, budget)
+        except LookupError:
+            raise LookupError("Linked Budget Expense not found")
+
+    # category_id (real or temporary) or category_type (title), like the expense routes
+    def category(self, data, budget):
+        if data.get("category_id") is not None:
+            return self.row("category", data["category_id"], budget)
+        return expense_category(budget.id, data["category_type"])
+
+## Purchases
+# Offline purchases keep the day they were made (the column default is today)
+def purchase_date(data, client_ts):
+    if "date" in data:
+        return checked_date(data["date"])
+    return datetime.combine(client_ts.date(), time()) if client_ts else None
+
+def create_purchase(log, budget, data, client_ts):
+    require(data, ["title", "amount"])
+    expense = log.expense(data.get("budget_expense_id"), budget)
+    purchase = Purchase(budget_id=budget.id, budget_expense_id=expense.id if expense else None, **purchase_fields(data))
+    made_on = purchase_date(data, client_ts)
+    if made_on is not None:
+        purchase.date = made_on
+    add_purchase(purchase, budget)
+    return purchase
+
+def update_purchase(log, budget, purchase, data, client_ts):
+    changes = purchase_fields(data)
+    if "budget_expense_id" in data:
+        expense = log.expense(data["budget_expense_id"], budget)
+        changes["budget_expense_id"] = expense.id if expense else None
+    if "date" in data:
+        changes["date"] = checked_date(data["date"])
+    change_purchase(purchase, budget, changes)
+
+def delete_purchase(log, budget, purchase):
+    remove_purchase(purchase, budget)
+
+## Budget incomes
+def create_budget_income(log, budget, data, client_ts):
+    require(data, ["title", "amount", "frequency"])
+    amount, frequency = item_amount(data, budget)
+    income = BudgetIncome(title=checked_title(data["title"]), amount=amount, frequency=frequency, budget_id=budget.id)
+    db.session.add(income)
+    db.session.flush()
+    return income
+
+def update_budget_income(log, budget, income, data, client_ts):
+    amount, frequency = item_amount(data, budget, (income.amount, income.frequency))
+    if "title" in data:
+        income.title = checked_title(data["title"])
+    income.amount, income.frequency = amount, frequency
+
+def delete_budget_income(log, budget, income):
+    db.session.delete(income)
+
+## Budget expenses
+def create_budget_expense(log, budget, data, client_ts):
+    require(data, ["title", "amount", "frequency"])
+    if data.get("category_id") is None:
+        require(data, ["category_type"])
+    amount, frequency = item_amount(data, budget)
+    expense = BudgetExpense(
+        title=checked_title(data["title"]),
+        amount=amount,
+        frequency=frequency,
+        budget_id=budget.id,
+        category_id=log.category(data, budget).id
+    )
+    db.session.add(expense)
+    db.session.flush()
+    return expense
+
+def update_budget_expense(log, budget, expense, data, client_ts):
+    amount, frequency = item_amount(data, budget, (expense.amount, expense.frequency))
+    if "title" in data:
+        expense.title = checked_title(data["title"])
+    expense.amount, expense.frequency = amount, frequency
+    if data.get("category_id") is not None or "category_type" in data:
+        set_expense_category(expense, log.category(data, budget))
+
+def delete_budget_expense(log, budget, expense):
+    remove_expense(expense)
+
+## Categories
+def create_category(log, budget, data, client_ts):
+    if budget.method.lower() == "50-30-20":
+        raise ValueError("Cannot create additional categories for 50-30-20. Only 'Needs', 'Wants', and 'Savings' allowed.")
+    require(data, ["title", "priority", "allocated_amount"])
+    category = Category(
+        title=unique_category_title(checked_title(data["title"]), budget),
+        priority=checked_priority(data["priority"], budget),
+        allocated_amount=checked_amount(data["allocated_amount"], "Allocated amount"),
+        description=checked_description(data.get("description")),
+        budget_id=budget.id
+    )
+    db.session.add(category)
+    db.session.flush()
+    return category
+
+def update_category(log, budget, category, data, client_ts):
+    check_protected_fields(budget, category, data)
+    if "title" in data:
+        category.title = unique_category_title(checked_title(data["title"]), budget, category)
+    if "description" in data:
+        category.description = checked_description(data["description"])
+    if "priority" in data:
+        category.priority = checked_priority(data["priority"], budget, category)
+    if "allocated_amount" in data:
+        category.allocated_amount = checked_amount(data["allocated_amount"], "Allocated amount")
+
+def delete_category(log, budget, category):
+    check_deletable(budget, category)
+    db.session.delete(category)
+
+HANDLERS = {
+    "purchase": (create_purchase, update_purchase, delete_purchase),
+    "budget_income": (create_budget_income, update_budget_income, delete_budget_income),
+    "budget_expense": (create_budget_expense, update_budget_expense, delete_budget_expense),
+    "category": (create_category, update_category, delete_category),
+}
+
+def checked_id(value, label):
+    if not isinstance(value, str) or not value or len(value) > MAX_ID_LENGTH:
+        raise ValueError(f"{label} must be a string of 1 to {MAX_ID_LENGTH} characters")
+    return value
+
+# Apply one operation, returns the ClientOperation that records it
+def apply_operation(log, operation):
+    if not isinstance(operation, dict):
+        raise ValueError("Operation must be an object")
+    op, entity = operation.get("op"), operation.get("entity")
+    if op not in OPERATIONS:
+        raise ValueError(f"op must be one of {', '.join(OPERATIONS)}")
+    if entity not in HANDLERS:
+        raise ValueError(f"entity must be one of {', '.join(HANDLERS)}")
+    data = operation.get("data") or {}
+    if not isinstance(data, dict):
+        raise ValueError("data must be an object")
+    client_ts = parse_timestamp(operation.get("client_ts"), "client_ts")
+    budget = log.budget(operation.get("budget_id"))
+    create, update, delete = HANDLERS[entity]
+
+    temp_id = None
+    if op == "create":
+        if operation.get("id") is not None:
+            temp_id = checked_id(operation["id"], "Temporary id")
+        row = create(log, budget, data, client_ts)
+        if temp_id is not None:
+            log.temp_ids[(entity, temp_id)] = row.id
+    else:
+        if operation.get("id") is None:
+            raise ValueError("Missing required field: id")
+        row = log.row(entity, operation["id"], budget)
+        if "version" in operation and operation["version"] != row.version:
+            raise VersionConflict()
+        if op == "update":
+            update(log, budget, row, data, client_ts)
+        else:
+            delete(log, budget, row)
+    db.session.flush()
+
+    log.touched.setdefault(budget.id, set()).add(entity)
+    return ClientOperation(
+        user_id=log.user_id,
+        client_id=log.client_id,
+        op_id=operation["op_id"],
+        op=op,
+        entity=entity,
+        entity_id=row.id,
+        temp_id=temp_id,
+        budget_id=budget.id,
+        client_ts=client_ts
+    )
+
+# Rules that apply to the budget as a whole, checked once after all its operations
+def finish_budget(budget, entities):
+    method = budget.method.lower()
+    if method == "50-30-20" and "budget_income" in entities:
+        update_503020_allocations(budget.id)
+    elif method == "zero-based" and entities & {"budget_income", "category"}:
+        error = check_zero_based_allocations(budget.id)
+        if error:
+            raise ValueError(error[0]["msg"])
+
+def recalculate(budget, entities):
+    if budget.method.lower() == "pay-yourself-first" and entities == {"category"}:
+        return pyf_allocation_calculation(budget.id)[0]
+    return recalculate_budget(budget.id)[0]
+
+def operation_error(status, msg, index=None, op_id=None):
+    body = {"status": "error", "msg": msg}
+    if index is not None:
+        body.update({"index": index, "op_id": op_id})
+    return jsonify(body), status
+
+@oplog_bp.route("/api/users/<int:user_id>/operations", methods=["POST"])
+def apply_operations(user_id):
+    try:
+        user = Users.query.get(user_id)
+        if not user:
+            return operation_error(404, "User not found")
+
+        data = request.get_json(silent=True) or {}
+        operations = data.get("operations")
+        try:
+            client_id = checked_id(data.get("client_id"), "client_id")
+        except ValueError as e:
+            return operation_error(400, str(e))
+        if not isinstance(operations, list) or not operations:
+            return operation_error(400, "Missing required field: operations")
+        if len(operations) > MAX_OPERATIONS:
+            return operation_error(400, f"At most {MAX_OPERATIONS} operations per request")
+        op_ids = []
+        for index, operation in enumerate(operations):
+            op_id = operation.get("op_id") if isinstance(operation, dict) else None
+            try:
+                op_ids.append(checked_id(op_id, "op_id"))
+            except ValueError as e:
+                return operation_error(400, str(e), index, op_id)
+
+        log = OperationLog(user_id, client_id)
+        # Operations applied by an earlier upload of this log
+        applied = {record.op_id: record for record in ClientOperation.query.filter(
+            ClientOperation.user_id == user_id,
+            ClientOperation.client_id == client_id,
+            ClientOperation.op_id.in_(set(op_ids))
+        )}
+        for record in applied.values():
+            if record.temp_id is not None:
+                log.temp_ids[(record.entity, record.temp_id)] = record.entity_id
+
+        results = []
+        for index, (op_id, operation) in enumerate(zip(op_ids, operations)):
+            if op_id in applied:
+                record = applied[op_id]
+                results.append({"op_id": op_id, "status": "duplicate", "entity": record.entity, "id": record.entity_id})
+                continue
+            try:
+                record = apply_operation(log, operation)
+            except LookupError as e:
+                db.session.rollback()
+                return operation_error(404, str(e), index, op_id)
+            except ValueError as e:
+                db.session.rollback()
+                return operation_error(400, str(e), index, op_id)
+            except (VersionConflict, StaleDataError):
+                db.session.rollback()
+                return operation_error(412, "This item was changed by another request. Reload it and try again.", index, op_id)
+            db.session.add(record)
+            applied[op_id] = record
+            results.append({"op_id": op_id, "status": "applied", "entity": record.entity, "id": record.entity_id})
+
+        try:
+            for budget_id, entities in log.touched.items():
+                finish_budget(log.budgets[budget_id], entities)
+        except ValueError as e:
+            db.session.rollback()
+            return operation_error(400, str(e))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The same log is being applied by another request right now
+            db.session.rollback()
+            return operation_error(409, "These operations are already being applied. Try again shortly.")
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed()
+
+        # Once per budget, however many operations touched it
+        recalculations = {
+            budget_id: recalculate(log.budgets[budget_id], entities) for budget_id, entities in log.touched.items()
+        }
+        id_map = {}
+        for (entity, temp_id), entity_id in log.temp_ids.items():
+            id_map.setdefault(entity, {})[temp_id] = entity_id
+
+        return jsonify({
+            "client_id": client_id,
+            "applied": sum(result["status"] == "applied" for result in results),
+            "duplicates": sum(result["status"] == "duplicate" for result in results),
+            "id_map": id_map,
+            "results": results,
+            "recalculations": recalculations
+        }), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
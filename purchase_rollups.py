@@ -0,0 +1,248 @@
+# purchase_rollups.py by Eden Pardo
+import click
+from datetime import date, datetime, timedelta
+from flask.cli import with_appcontext
+from models import Purchase, PurchaseRollup, BudgetExpense, Budget
+from money import format_money
+from sharding import sharding_enabled, shard_ids, use_shard, lookup_budget_shard
+from extensions import db
+
+# Biweekly buckets are counted from a fixed Monday so every budget lines up the same way
+BIWEEKLY_ANCHOR = date(2024, 1, 1)
+
+# Find the start of the period bucket a purchase date falls into
+def bucket_start(purchase_date, period):
+    if isinstance(purchase_date, datetime):
+        purchase_date = purchase_date.date()
+    if purchase_date is None:
+        purchase_date = date.today()
+
+    period = (period or "weekly").lower()
+    if period == "yearly":
+        return date(purchase_date.year, 1, 1)
+    if period == "monthly":
+        return date(purchase_date.year, purchase_date.month, 1)
+
+    monday = purchase_date - timedelta(days=purchase_date.weekday())
+    if period == "biweekly":
+        weeks_since_anchor = (monday - BIWEEKLY_ANCHOR).days // 7
+        return monday - timedelta(weeks=weeks_since_anchor % 2)
+    return monday
+
+# Build the rollup key for a purchase as it currently looks
+def rollup_key(purchase, period):
+    category_id = None
+    if purchase.budget_expense_id:
+        expense = db.session.get(BudgetExpense, purchase.budget_expense_id)
+        category_id = expense.category_id if expense else None
+    return (purchase.budget_id, purchase.budget_expense_id, category_id, bucket_start(purchase.date, period))
+
+# Add (sign=1) or remove (sign=-1) an amount from a rollup row. Does not commit.
+def apply_to_rollup(key, amount, sign=1):
+    budget_id, budget_expense_id, category_id, period_start = key
+    rollup = PurchaseRollup.query.filter_by(
+        budget_id=budget_id,
+        budget_expense_id=budget_expense_id,
+        category_id=category_id,
+        period_start=period_start
+    ).first()
+
+    if rollup is None:
+        if sign < 0:
+            # Nothing to remove from; a rebuild will fix any drift
+            return None
+        rollup = PurchaseRollup(
+            budget_id=budget_id,
+            budget_expense_id=budget_expense_id,
+            category_id=category_id,
+            period_start=period_start,
+            total=0,
+            purchase_count=0
+        )
+        db.session.add(rollup)
+
+    rollup.total = (rollup.total or 0) + sign * amount
+    rollup.purchase_count = (rollup.purchase_count or 0) + sign
+
+    if rollup.purchase_count <= 0:
+        db.session.delete(rollup)
+    return rollup
+
+# Helpers called from purchase_routes inside the same transaction as the purchase change
+def add_purchase_to_rollup(purchase, period):
+    apply_to_rollup(rollup_key(purchase, period), purchase.amount, 1)
+
+def remove_purchase_from_rollup(purchase, period):
+    apply_to_rollup(rollup_key(purchase, period), purchase.amount, -1)
+
+# Keep rollup category in sync when an expense moves category or is deleted
+def move_expense_rollups(budget_expense_id, category_id):
+    PurchaseRollup.query.filter_by(budget_expense_id=budget_expense_id).update(
+        {"category_id": category_id}, synchronize_session=False
+    )
+
+# Deleting an expense unlinks its purchases (ON DELETE SET NULL): fold the expense's rollup rows into
+# the budget's uncategorized rows the same way. Call before deleting the expense. Does not commit.
+def detach_expense_rollups(budget_expense_id):
+    for rollup in PurchaseRollup.query.filter_by(budget_expense_id=budget_expense_id).all():
+        uncategorized = PurchaseRollup.query.filter_by(
+            budget_id=rollup.budget_id,
+            budget_expense_id=None,
+            category_id=None,
+            period_start=rollup.period_start
+        ).first()
+        if uncategorized is None:
+            uncategorized = PurchaseRollup(
+                budget_id=rollup.budget_id,
+                budget_expense_id=None,
+                category_id=None,
+                period_start=rollup.period_start,
+                total=0,
+                purchase_count=0
+            )
+            db.session.add(uncategorized)
+        uncategorized.total = (uncategorized.total or 0) + rollup.total
+        uncategorized.purchase_count = (uncategorized.purchase_count or 0) + rollup.purchase_count
+        db.session.delete(rollup)
+
+# Totals per category for a budget: {category_id: total}. None key = not linked to a category
+def category_totals(budget_id):
+    rows = db.session.query(
+        PurchaseRollup.category_id,
+        db.func.sum(PurchaseRollup.total)
+    ).filter(PurchaseRollup.budget_id == budget_id).group_by(PurchaseRollup.category_id).all()
+    return {category_id: total or 0 for category_id, total in rows}
+
+# Totals per period bucket for a budget, oldest first
+def period_totals(budget_id):
+    rows = db.session.query(
+        PurchaseRollup.period_start,
+        db.func.sum(PurchaseRollup.total),
+        db.func.sum(PurchaseRollup.purchase_count)
+    ).filter(PurchaseRollup.budget_id == budget_id).group_by(PurchaseRollup.period_start).order_by(PurchaseRollup.period_start).all()
+    return [{
+        "period_start": period_start.strftime("%d/%m/%y"),
+        "total": format_money(total or 0),
+        "purchase_count": count or 0
+    } for period_start, total, count in rows]
+
+# Recompute the rollups for one budget (or all budgets) straight from the purchase table
+def rebuild_rollups(budget_id=None):
+    delete_query = PurchaseRollup.query
+    if budget_id is not None:
+        delete_query = delete_query.filter_by(budget_id=budget_id)
+    delete_query.delete(synchronize_session=False)
+
+    rows = db.session.query(
+        Purchase.budget_id,
+        Purchase.budget_expense_id,
+        BudgetExpense.category_id,
+        Purchase.date,
+        Purchase.amount,
+        Budget.period
+    ).join(Budget, Budget.id == Purchase.budget_id).outerjoin(BudgetExpense, BudgetExpense.id == Purchase.budget_expense_id)
+    if budget_id is not None:
+        rows = rows.filter(Purchase.budget_id == budget_id)
+
+    totals = {}
+    for row_budget_id, expense_id, category_id, purchase_date, amount, period in rows.yield_per(1000):
+        key = (row_budget_id, expense_id, category_id, bucket_start(purchase_date, period))
+        total, count = totals.get(key, (0, 0))
+        totals[key] = (total + amount, count + 1)
+
+    db.session.bulk_insert_mappings(PurchaseRollup, [{
+        "budget_id": key[0],
+        "budget_expense_id": key[1],
+        "category_id": key[2],
+        "period_start": key[3],
+        "total": total,
+        "purchase_count": count
+    } for key, (total, count) in totals.items()])
+    db.session.commit()
+    return len(totals)
+
+# Compare rollup totals against the raw purchase table, per budget and expense
+def reconcile_rollups(budget_id=None):
+    raw_query = db.session.query(
+        Purchase.budget_id,
+        Purchase.budget_expense_id,
+        db.func.sum(Purchase.amount),
+        db.func.count(Purchase.id)
+    ).group_by(Purchase.budget_id, Purchase.budget_expense_id)
+    rollup_query = db.session.query(
+        PurchaseRollup.budget_id,
+        PurchaseRollup.budget_expense_id,
+        db.func.sum(PurchaseRollup.total),
+        db.func.sum(PurchaseRollup.purchase_count)
+    ).group_by(PurchaseRollup.budget_id, PurchaseRollup.budget_expense_id)
+    if budget_id is not None:
+        raw_query = raw_query.filter(Purchase.budget_id == budget_id)
+        rollup_query = rollup_query.filter(PurchaseRollup.budget_id == budget_id)
+
+    raw = {(b, e): (total or 0, count or 0) for b, e, total, count in raw_query.all()}
+    rolled = {(b, e): (total or 0, count or 0) for b, e, total, count in rollup_query.all()}
+
+    mismatches = []
+    for key in set(raw) | set(rolled):
+        raw_total, raw_count = raw.get(key, (0, 0))
+        rollup_total, rollup_count = rolled.get(key, (0, 0))
+        if raw_count != rollup_count or raw_total != rollup_total:
+            mismatches.append({
+                "budget_id": key[0],
+                "budget_expense_id": key[1],
+                "purchase_total": format_money(raw_total),
+                "rollup_total": format_money(rollup_total),
+                "purchase_count": raw_count,
+                "rollup_count": rollup_count
+            })
+    return mismatches
+
+# Databases the commands below go through: every shard, or only the one holding budget_id.
+# None is the main database (sharding off).
+def rollup_shards(budget_id=None):
+    if not sharding_enabled():
+        return [None]
+    if budget_id is not None:
+        shard = lookup_budget_shard(budget_id)
+        return [shard] if shard is not None else []
+    return shard_ids()
+
+@click.command("rebuild-rollups")
+@click.option("--budget-id", type=int, default=None, help="Only rebuild this budget.")
+@with_appcontext
+def rebuild_rollups_command(budget_id):
+    count = 0
+    for shard in rollup_shards(budget_id):
+        with use_shard(shard):
+            count += rebuild_rollups(budget_id)
+            db.session.remove() # Next shard starts with a fresh session
+    click.echo(f"Rebuilt {count} rollup rows.")
+
+@click.command("check-rollups")
+@click.option("--budget-id", type=int, default=None, help="Only check this budget.")
+@click.option("--fix", is_flag=True, help="Rebuild the affected budgets when mismatches are found.")
+@with_appcontext
+def check_rollups_command(budget_id, fix):
+    mismatches = [] # (shard, mismatch)
+    for shard in rollup_shards(budget_id):
+        with use_shard(shard):
+            mismatches += [(shard, mismatch) for mismatch in reconcile_rollups(budget_id)]
+            db.session.remove()
+    if not mismatches:
+        click.echo("Rollups match purchases.")
+        return
+
+    for shard, mismatch in mismatches:
+        click.echo(
+            f"Budget {mismatch['budget_id']} expense {mismatch['budget_expense_id']}: "
+            f"purchases ${mismatch['purchase_total']} ({mismatch['purchase_count']}) vs "
+            f"rollup ${mismatch['rollup_total']} ({mismatch['rollup_count']})"
+        )
+    if fix:
+        for shard, broken_budget_id in sorted({(shard, m["budget_id"]) for shard, m in mismatches}):
+            with use_shard(shard):
+                rebuild_rollups(broken_budget_id)
+                db.session.remove()
+        click.echo("Rebuilt affected budgets.")
+    else:
+        raise SystemExit(1)
@@ -2,10 +2,43 @@
 from flask import Blueprint, request, jsonify
 from models import Purchase, Budget, BudgetExpense
 from pyf_budget_routes import pyf_purchase_calculation
+from fiftythirtytwenty_budget_routes import fifty_thirty_twenty_calculation
+from purchase_rollups import add_purchase_to_rollup, remove_purchase_from_rollup, category_totals, period_totals
+from money import format_money
+from validation import require, checked_title, checked_amount
+from concurrency import if_match_failed, precondition_failed, with_etag
+from read_paths import PURCHASES, sparse_fieldset, pick
+from sqlalchemy.orm.exc import StaleDataError
 from extensions import db
 
 purchase_bp = Blueprint('purchase', __name__)
 
+## Purchase writes shared with the operation log (oplog_routes.py): the rollups follow every change
+def add_purchase(purchase, budget):
+    db.session.add(purchase)
+    db.session.flush() # Get the purchase date before updating the rollup
+    add_purchase_to_rollup(purchase, budget.period)
+
+def change_purchase(purchase, budget, changes):
+    # Take the old amount/expense/date out of the rollup before changing anything
+    remove_purchase_from_rollup(purchase, budget.period)
+    for field, value in changes.items():
+        setattr(purchase, field, value)
+    add_purchase_to_rollup(purchase, budget.period)
+
+def remove_purchase(purchase, budget):
+    remove_purchase_from_rollup(purchase, budget.period)
+    db.session.delete(purchase)
+
+# Title and amount sent for a purchase, checked
+def purchase_fields(data):
+    fields = {}
+    if "title" in data:
+        fields["title"] = checked_title(data["title"])
+    if "amount" in data:
+        fields["amount"] = checked_amount(data["amount"])
+    return fields
+
 # Create a purchase (linked or unlinked to an expense)
 @purchase_bp.route("/api/budgets/<int:budget_id>/purchases", methods=["POST"])
 def create_purchase(budget_id):
@@ -17,20 +50,8 @@ def create_purchase(budget_id):
         data = request.json
 
         # Validate required fields
-        required_fields = ["title", "amount"]
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            return jsonify({"status":"error", "msg": f"Missing required field: {', '.join(missing_fields)}"}), 400
-
-        if float(data['amount']) < 0:
-            return jsonify({"status": "error", "msg": "Amount cannot be negative"}), 400
-
-        purchase_title = data["title"].strip()
-        if len(purchase_title) == 0:
-            return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-        if len(purchase_title) > 100:
-            return jsonify({"status": "error", "msg": "Title too long"}), 400
+        require(data, ["title", "amount"])
+        fields = purchase_fields(data)
 
         # Check if a budget expense is linked
         expense_id = data.get("budget_expense_id")
@@ -41,17 +62,16 @@ def create_purchase(budget_id):
                 return jsonify({"status": "error", "msg": "Linked Budget Expense not found"}), 404
 
         # Create the purchase
-        new_purchase = Purchase(
-            title=data['title'],
-            amount=float(data['amount']),
-            budget_id=budget_id,
-            budget_expense_id=expense_id
-        )
-        db.session.add(new_purchase)
+        new_purchase = Purchase(budget_id=budget_id, budget_expense_id=expense_id, **fields)
+        add_purchase(new_purchase, budget)
         db.session.commit()
 
+        recalculation = None
+        status = 201
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
 
         return jsonify({
             "msg": "Purchase created successfully",
@@ -59,6 +79,9 @@ def create_purchase(budget_id):
             "recalculation": recalculation
             }), status
 
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -71,57 +94,57 @@ def update_purchase(budget_id, purchase_id):
         if not purchase:
             return jsonify({"status": "error", "msg": "Purchase not found"}), 404
 
-        data = request.json
-
-        if 'amount' in data and float(data['amount']) < 0:
-            return jsonify({"status": "error", "msg": "Amount cannot be negative"}), 400
-
-        if 'title' in data:
-            purchase_title = data["title"].strip()
-            if len(purchase_title) == 0:
-                return jsonify({"status": "error", "msg": "Title cannot be empty"}), 400
-            if len(purchase_title) > 100:
-                return jsonify({"status": "error", "msg": "Title too long"}), 400
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if if_match_failed(purchase):
+            return precondition_failed(purchase)
 
-        # Update fields if provided
-        purchase.title = data.get("title", purchase.title)
-        purchase.amount = float(data.get("amount", purchase.amount))
+        data = request.json
+        changes = purchase_fields(data)
 
         # Update linked budget expense (if provided)
         if "budget_expense_id" in data:
             new_expense_id = data["budget_expense_id"]
 
-        # None = unlink the purchase
-        if new_expense_id is None:
-            purchase.budget_expense_id = None
-        else:
-            # Validate expense exists and belongs to the budget
-            new_expense = BudgetExpense.query.filter_by(
-                id=new_expense_id,
-                budget_id=budget_id
-            ).first()
-            if not new_expense:
-                return jsonify({
-                "status": "error",
-                "msg": f"Expense with ID {new_expense_id} not found in this budget."
-            }), 404
-            purchase.budget_expense_id = new_expense.id
-
+            # None = unlink the purchase
+            if new_expense_id is None:
+                changes["budget_expense_id"] = None
+            else:
+                # Validate expense exists and belongs to the budget
+                new_expense = BudgetExpense.query.filter_by(
+                    id=new_expense_id,
+                    budget_id=budget_id
+                ).first()
+                if not new_expense:
+                    return jsonify({
+                    "status": "error",
+                    "msg": f"Expense with ID {new_expense_id} not found in this budget."
+                }), 404
+                changes["budget_expense_id"] = new_expense.id
+
+        change_purchase(purchase, budget, changes)
         db.session.commit()
 
-        budget = Budget.query.get(budget_id)
-        if not budget:
-            return jsonify({"status": "error", "msg": "Budget not found"}), 404
-
+        recalculation = None
+        status = 200
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
 
-        return jsonify({
+        return with_etag(jsonify({
             "msg": "Purchase updated successfully",
             "purchase": purchase.to_json(),
             "recalculation": recalculation
-        }), status
+        }), purchase), status
 
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -130,10 +153,32 @@ def update_purchase(budget_id, purchase_id):
 @purchase_bp.route("/api/budgets/<int:budget_id>/purchases", methods=["GET"])
 def get_all_purchases(budget_id):
     try:
-        purchases = Purchase.query.filter_by(budget_id=budget_id).all()
+        keys, _ = sparse_fieldset(PURCHASES)
+        purchases = PURCHASES.list(budget_id, keys)
         if not purchases:
             return jsonify({"msg": "User has made no purchases."}), 200
-        return jsonify([purchase.to_json() for purchase in purchases]), 200
+        return jsonify(purchases), 200
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Purchase totals per period and per category, read from the rollup table
+@purchase_bp.route("/api/budgets/<int:budget_id>/purchases/summary", methods=["GET"])
+def get_purchase_summary(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+
+        by_category = category_totals(budget_id)
+        return jsonify({
+            "budget_id": budget_id,
+            "period": budget.period,
+            "periods": period_totals(budget_id),
+            "categories": [{"category_id": category_id, "total": format_money(total)} for category_id, total in by_category.items()],
+            "total_spent": format_money(sum(by_category.values()))
+        }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -141,10 +186,13 @@ def get_all_purchases(budget_id):
 @purchase_bp.route("/api/budgets/<int:budget_id>/purchases/<int:purchase_id>", methods=["GET"])
 def get_specific_purchase(budget_id, purchase_id):
     try:
+        keys, _ = sparse_fieldset(PURCHASES)
         purchase = Purchase.query.filter_by(id=purchase_id, budget_id=budget_id).first()
         if not purchase:
             return jsonify({"status": "error", "msg": "Purchase not found"}), 404
-        return jsonify(purchase.to_json()), 200
+        return with_etag(jsonify(pick(purchase.to_json(), keys)), purchase), 200
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -159,14 +207,20 @@ def delete_purchase(budget_id, purchase_id):
         budget = Budget.query.get(budget_id)
         if not budget:
             return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if if_match_failed(purchase):
+            return precondition_failed(purchase)
 
         deleted_purchase_data = purchase.to_json()
 
-        db.session.delete(purchase)
+        remove_purchase(purchase, budget)
         db.session.commit()
 
+        recalculation = None
+        status = 200
         if budget.method.lower() == "pay-yourself-first":
             recalculation, status = pyf_purchase_calculation(budget_id)
+        elif budget.method.lower() == "50-30-20":
+            recalculation, status = fifty_thirty_twenty_calculation(budget_id)
 
         return jsonify({
             "msg": "Purchase deleted successfully",
@@ -174,6 +228,9 @@ def delete_purchase(budget_id, purchase_id):
             "recalculation": recalculation
         }), status
 
+    except StaleDataError:
+        db.session.rollback()
+        return precondition_failed()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
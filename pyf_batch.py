@@ -0,0 +1,221 @@
+# pyf_batch.py by Eden Pardo
+# Nightly batch job: computes pay-yourself-first recommendations for every PYF budget
+# (of every shard when DB_SHARDS is set; runs and results stay in the main database)
+# Run with: flask --app app pyf-batch --workers 4
+import click
+import json
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, select, func
+from models import Budget, BudgetIncome, Category, Purchase, BudgetExpense, PurchaseRollup, PyfBatchRun, PyfAnalysisResult
+from pyf_budget_routes import pyf_recommendations
+from anomaly import anomaly_detector, find_anomalies, rank_anomalies, purchase_rows_query
+from sharding import sharding_enabled, shard_ids, use_shard
+from extensions import db
+
+PYF_METHOD = "pay-yourself-first"
+
+# Lightweight stand-in for Category rows inside worker processes
+CategoryRow = namedtuple("CategoryRow", ["id", "title", "allocated_amount", "priority", "is_savings"])
+
+# Each worker process opens its own engine once per database (connections cannot cross a fork)
+worker_engines = {}
+
+def get_worker_engine(database_uri):
+    engine = worker_engines.get(database_uri)
+    if engine is None:
+        engine = worker_engines[database_uri] = create_engine(database_uri)
+    return engine
+
+# Analyze one partition of budgets. Runs in a worker process, only reads.
+# Returns [(budget_id, status, result_dict)]
+def analyze_partition(database_uri, budget_ids, threshold, min_purchases):
+    engine = get_worker_engine(database_uri)
+    incomes = BudgetIncome.__table__
+    categories = Category.__table__
+    purchases = Purchase.__table__
+    expenses = BudgetExpense.__table__
+    rollups = PurchaseRollup.__table__
+
+    with engine.connect() as connection:
+        # Total income per budget
+        total_income = dict(connection.execute(
+            select(incomes.c.budget_id, func.sum(incomes.c.amount))
+            .where(incomes.c.budget_id.in_(budget_ids))
+            .group_by(incomes.c.budget_id)
+        ).all())
+
+        # Categories per budget
+        budget_categories = defaultdict(list)
+        for row in connection.execute(
+            select(categories.c.budget_id, categories.c.id, categories.c.title, categories.c.allocated_amount,
+                   categories.c.priority, categories.c.is_savings)
+            .where(categories.c.budget_id.in_(budget_ids))
+        ):
+            budget_categories[row.budget_id].append(
+                CategoryRow(row.id, row.title, row.allocated_amount, row.priority, row.is_savings)
+            )
+
+        # Spending per budget and category, from the rollup table
+        spending = defaultdict(dict)
+        for budget_id, category_id, total in connection.execute(
+            select(rollups.c.budget_id, rollups.c.category_id, func.sum(rollups.c.total))
+            .where(rollups.c.budget_id.in_(budget_ids))
+            .group_by(rollups.c.budget_id, rollups.c.category_id)
+        ):
+            spending[budget_id][category_id] = total or 0
+
+        # Category of the first purchase of each budget
+        ranked = select(
+            purchases.c.budget_id,
+            purchases.c.budget_expense_id,
+            func.row_number().over(partition_by=purchases.c.budget_id, order_by=(purchases.c.date, purchases.c.id)).label("position")
+        ).where(purchases.c.budget_id.in_(budget_ids)).subquery()
+        first_purchase_category = dict(
+            (budget_id, category_id) for budget_id, category_id in connection.execute(
+                select(ranked.c.budget_id, expenses.c.category_id)
+                .select_from(ranked.outerjoin(expenses, expenses.c.id == ranked.c.budget_expense_id))
+                .where(ranked.c.position == 1)
+            )
+        )
+
+        # Purchases not linked to any expense
+        unlinked_titles = defaultdict(list)
+        for budget_id, title in connection.execute(
+            select(purchases.c.budget_id, purchases.c.title)
+            .where(purchases.c.budget_id.in_(budget_ids), purchases.c.budget_expense_id.is_(None))
+            .order_by(purchases.c.date, purchases.c.id)
+        ):
+            unlinked_titles[budget_id].append(title)
+
+        # Unusual purchases, scored for every category of the partition at once
+        flagged = find_anomalies(connection.execute(
+            purchase_rows_query(purchases, expenses).where(purchases.c.budget_id.in_(budget_ids))
+        ).all(), threshold, min_purchases)
+        anomalies = defaultdict(list)
+        for (budget_id, category_id), found in flagged.items():
+            anomalies[budget_id] += found
+
+    results = []
+    for budget_id in budget_ids:
+        if budget_id not in first_purchase_category:
+            results.append((budget_id, 200, {"status": "ok", "msg": "No purchases made yet."}))
+            continue
+        result, status = pyf_recommendations(
+            budget_categories[budget_id],
+            spending[budget_id],
+            total_income.get(budget_id, 0) or 0,
+            first_purchase_category[budget_id],
+            unlinked_titles[budget_id],
+            rank_anomalies(anomalies[budget_id])
+        )
+        results.append((budget_id, status, result))
+    return results
+
+# Stream ids of PYF budgets not yet analyzed in this run, in pages (keyset pagination
+# so the cursor survives the commits made between partitions). The results may be in another
+# database than the budgets, so each page is checked against them in a second query.
+def stream_pending_budget_ids(run_id, page_size):
+    last_id = 0
+    while True:
+        ids = [budget_id for (budget_id,) in db.session.query(Budget.id).filter(
+            func.lower(Budget.method) == PYF_METHOD,
+            Budget.id > last_id
+        ).order_by(Budget.id).limit(page_size).all()]
+        if not ids:
+            return
+        last_id = ids[-1]
+        done = {budget_id for (budget_id,) in db.session.query(PyfAnalysisResult.budget_id).filter(
+            PyfAnalysisResult.run_id == run_id,
+            PyfAnalysisResult.budget_id.in_(ids)
+        ).all()}
+        pending_ids = [budget_id for budget_id in ids if budget_id not in done]
+        if pending_ids:
+            yield pending_ids
+
+# Store one partition's results (one row per budget, replaced on every run)
+def save_results(run_id, results):
+    budget_ids = [budget_id for budget_id, status, result in results]
+    existing = {r.budget_id: r for r in PyfAnalysisResult.query.filter(PyfAnalysisResult.budget_id.in_(budget_ids)).all()}
+    now = datetime.utcnow()
+
+    for budget_id, status, result in results:
+        row = existing.get(budget_id)
+        if row is None:
+            row = PyfAnalysisResult(budget_id=budget_id)
+            db.session.add(row)
+        row.run_id = run_id
+        row.status = result.get("status", "error")
+        row.result = json.dumps(result)
+        row.analyzed_at = now
+
+    PyfBatchRun.query.filter_by(id=run_id).update({"budgets_processed": PyfBatchRun.budgets_processed + len(results)})
+    db.session.commit()
+
+# Analyze the PYF budgets of the current database (the shard selected with use_shard) into one run
+def analyze_budgets(pool, run_id, engine, workers, partition_size):
+    database_uri = engine.url.render_as_string(hide_password=False)
+    processed = 0
+    pending = set()
+    for budget_ids in stream_pending_budget_ids(run_id, partition_size):
+        pending.add(pool.submit(
+            analyze_partition, database_uri, budget_ids, anomaly_detector.threshold, anomaly_detector.min_purchases
+        ))
+        # Keep a bounded number of partitions in flight
+        if len(pending) >= workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                save_results(run_id, results)
+                processed += len(results)
+    for future in pending:
+        results = future.result()
+        save_results(run_id, results)
+        processed += len(results)
+    return processed
+
+def run_pyf_batch(workers, partition_size, resume=False, echo=print):
+    run = None
+    if resume:
+        run = PyfBatchRun.query.filter(PyfBatchRun.finished_at.is_(None)).order_by(PyfBatchRun.id.desc()).first()
+    if run is None:
+        run = PyfBatchRun(budgets_processed=0)
+        db.session.add(run)
+        db.session.commit()
+    else:
+        echo(f"Resuming run {run.id} ({run.budgets_processed} budgets already processed).")
+
+    run_id = run.id
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if not sharding_enabled():
+            processed = analyze_budgets(pool, run_id, db.engine, workers, partition_size)
+        else:
+            processed = 0
+            for shard in shard_ids():
+                with use_shard(shard):
+                    processed += analyze_budgets(pool, run_id, db.engines[f"shard_{shard}"], workers, partition_size)
+                    db.session.remove() # Next shard starts with a fresh session
+
+    run = db.session.get(PyfBatchRun, run_id)
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    elapsed = time.perf_counter() - started
+    rate = processed / elapsed if elapsed > 0 else 0
+    echo(f"Run {run_id}: analyzed {processed} budgets in {elapsed:.2f}s ({rate:.1f} budgets/s).")
+    return run
+
+@click.command("pyf-batch")
+@click.option("--workers", type=int, default=4, show_default=True, help="Number of worker processes.")
+@click.option("--partition-size", type=int, default=200, show_default=True, help="Budgets per partition.")
+@click.option("--resume", is_flag=True, help="Continue the last interrupted run instead of starting a new one.")
+@with_appcontext
+def pyf_batch_command(workers, partition_size, resume):
+    if workers < 1 or partition_size < 1:
+        raise click.BadParameter("--workers and --partition-size must be positive")
+    run_pyf_batch(workers, partition_size, resume, echo=click.echo)
@@ -1,8 +1,12 @@
 # pyf_budget_routes.py by Eden Pardo
 from flask import Blueprint, request, jsonify
-from models import Purchase, BudgetExpense, Budget, Category
+from models import Purchase, BudgetExpense, BudgetIncome, Budget, Category
 from extensions import db
 from constants import VALID_PERIODS
+from money import format_money, to_money
+from purchase_rollups import category_totals
+from allocation import budget_allocation
+from anomaly import anomaly_detector
 
 def create_base_savings_category(budget_id):
     try:
@@ -25,6 +29,10 @@ def create_base_savings_category(budget_id):
     except Exception as e:
         raise e
 
+# Total income of a budget, summed in the database
+def budget_total_income(budget_id):
+    return db.session.query(db.func.sum(BudgetIncome.amount)).filter_by(budget_id=budget_id).scalar() or 0
+
 # Initial budget setup and allocations (when new categories are made)
 def pyf_allocation_calculation(budget_id):
     try:
@@ -33,9 +41,9 @@ def pyf_allocation_calculation(budget_id):
         if not budget:
             return {"status": "error", "msg": "Budget not found"}, 404
 
-        # Calculate total income and total expenses
-        total_income = sum(income.amount for income in budget.incomes)
-        total_expenses = sum(expense.amount for expense in budget.expenses)
+        # Calculate total income and total expenses (exact integer SUM in the database)
+        total_income = budget_total_income(budget_id)
+        total_expenses = db.session.query(db.func.sum(BudgetExpense.amount)).filter_by(budget_id=budget_id).scalar() or 0
 
         # Check that expenses do not exceed income
         if total_expenses > total_income:
@@ -56,14 +64,14 @@ def pyf_allocation_calculation(budget_id):
         for category in budget.categories:
             categories_info.append({
                     "title": category.title,
-                    "allocated_amount": category.allocated_amount,
+                    "allocated_amount": format_money(category.allocated_amount),
                     "priority": category.priority
                 })
         
         return {
             "status": "validated",
-                "total_income": total_income,
-                "total_expenses": total_expenses,
+                "total_income": format_money(total_income),
+                "total_expenses": format_money(total_expenses),
                 "categories": categories_info
         }, 200
 
@@ -72,149 +80,131 @@ def pyf_allocation_calculation(budget_id):
 
 def  pyf_purchase_calculation(budget_id):
     try:
-        recommendations = []
-
         ## 1. Setup --> Loads all budget data
         # Retrieve budget
         budget = Budget.query.get(budget_id)
         if not budget:
             return {"status": "error", "msg": "Budget not found"}, 404
         
-        # Retrieve all purchases linked to the budget
-        purchases = Purchase.query.filter_by(budget_id=budget_id).order_by(Purchase.date).all()
-        if not purchases:
+        # Earliest purchase (only raw row needed for the ordering check)
+        first_purchase = Purchase.query.filter_by(budget_id=budget_id).order_by(Purchase.date, Purchase.id).first()
+        if not first_purchase:
             return {"status": "ok", "msg": "No purchases made yet."}, 200
         
-        # Retrieve all categories and expenses
+        # Retrieve all categories
         categories = Category.query.filter_by(budget_id=budget_id).all()
-        expenses = BudgetExpense.query.filter_by(budget_id=budget_id).all()
 
-        # Find Savings category (PYF focuses on Savings category)
-        savings_category = next((c for c in categories if c.is_savings), None)
-        if not savings_category:
-            return {"status": "error", "msg": "Savings category not found"}, 400
-        
-        expense_lookup = {e.id: e for e in expenses}
+        # Map: category_id-->total spent, read from the rollup table instead of every purchase
+        # (None key = purchases not linked to a category)
+        category_spending = category_totals(budget_id)
 
-        ## 2. First Purchase check --> Savings?
-        first_purchase = purchases[0] # Ordered by date above
-        first_purchase_expense = None
+        # Category the first purchase went to (None if it is not linked)
+        first_purchase_category_id = None
         if first_purchase.budget_expense_id:
             first_purchase_expense = BudgetExpense.query.get(first_purchase.budget_expense_id)
+            if first_purchase_expense:
+                first_purchase_category_id = first_purchase_expense.category_id
 
-        # Check if the first purchse went to Savings Expense (and Category)
-        if first_purchase_expense and first_purchase_expense.category_id == savings_category.id:
-            # Good: First purchase went to Savings
-            pass
-        else:
-            recommendations.append("First purchase was not made towards Savings. Remember to prioritize Savings first.")
-
-        ## 3. Savings fully paid --> Goal met?
-        total_spent_on_savings = 0
-
-        # Calculate total amount spent (purchased) on Savings
-        for purchase in purchases:
-            if purchase.budget_expense_id:
-                linked_expense = expense_lookup.get(purchase.budget_expense_id)
-                if linked_expense and linked_expense.category_id == savings_category.id:
-                    total_spent_on_savings += purchase.amount
-        
-        # Compare total Savings Purchases to Savings allocation
-        if total_spent_on_savings < savings_category.allocated_amount:
-            recommendations.append(
-                f'Savings goal not fully funded yet. ${ savings_category.allocated_amount - total_spent_on_savings:.2f} remaining.')
+        total_income = budget_total_income(budget_id)
 
-        ## 4. Check for overspending
+        unlinked_titles = [title for (title,) in db.session.query(Purchase.title).filter_by(
+            budget_id=budget_id, budget_expense_id=None
+        ).order_by(Purchase.date, Purchase.id).all()]
 
-        # Calculate total spent (all purchases regardless of link)
-        total_spent = sum(p.amount for p in purchases)
-        # Check if user spent more than their income
-        total_income = sum(income.amount for income in budget.incomes)
-        if total_spent > total_income:
-            recommendations.append(
-                f"Warning: You have exceeded your total income for this budget period by ${total_spent - total_income:.2f}."
-            )
+        # Purchases much larger than usual for their category
+        anomalies = anomaly_detector.budget_anomalies(budget_id)
 
-        # Map: category_id-->total spent
-        category_spending = {}
-
-        # For each purchase, if it's linked to an expense and category, it adds the amount
-        for purchase in purchases:
-            if purchase.budget_expense_id:
-                linked_expense = expense_lookup.get(purchase.budget_expense_id)
-                if linked_expense:
-                    category_id = linked_expense.category_id
-                    if category_id:
-                        category_spending[category_id] = category_spending.get(category_id, 0) + purchase.amount
-
-        # Check spending against each category's allocation
-        for category in categories:
-            spent = category_spending.get(category.id, 0)
-            if spent > category.allocated_amount:
-                overspent_amount = spent - category.allocated_amount
-                recommendations.append(
-                    f"Overspending detected: '{category.title}' is overspent by ${overspent_amount:.2f}"
-                )
-        
-        ## 5. Category priority violation check --> Are lower categories being spent first?
-        
-        #########AM I EVEN USING THIS VARIABLE???
-        # Retrieve all categories sorted by priority (lower num = higher priority)
-        '''sorted_categories = sorted(categories, key=lambda c: c.priority)
-        # Track whether higher-priority categories had purchases before lower-priority ones
-        priorities_with_spending = sorted(priority_spending.keys())
-
-        # Use sorted category priorities for order enforcement
-        sorted_priorities = [c.priority for c in sorted_categories]
-
-        for i, current_priority in enumerate(sorted_priorities):
-            if current_priority in priorities_with_spending:
-                for higher_priority in sorted_priorities[:i]:
-                    if higher_priority not in priorities_with_spending:
-                        recommendations.append(
-                            f"Spending detected on lower-priority category (priority {current_priority}) before fully funding higher-priority category (priority {higher_priority})."
-                        )'''
-
-        # Track which priorities have had spending
-        priority_spending = {}
-
-        for purchase in purchases:
-            if purchase.budget_expense_id:
-                linked_expense = expense_lookup.get(purchase.budget_expense_id)
-                if linked_expense and linked_expense.category_id:
-                    # Find the linked category
-                    linked_category = next((c for c in categories if c.id == linked_expense.category_id), None)
-                    if linked_category:
-                        priority_spending[linked_category.priority] = priority_spending.get(linked_category.priority, 0) + purchase.amount
-        
-        # Check if any lower-priority category has spending before higher ones
-        seen_priorities = sorted(priority_spending.keys())
-
-        for idx, priority in enumerate(seen_priorities):
-            # For each priority spent, check if there were any earlier (more important) priorities missing
-            for higher_priority in range(1, priority):
-                if higher_priority not in priority_spending:
-                    recommendations.append(
-                        f"Spending detected on lower-priority category (priority {priority}) before fully funding higher-priority category (priority {higher_priority})."
-                    )
-
-        ## 6. Unexpected Purchase check
-        for purchase in purchases:
-            if not purchase.budget_expense_id:
-                recommendations.append(
-                    f"Unexpected purchase detected: '{purchase.title}' is not linked to any planned expense. Recommend adjusting lower-priority allocations to account for imbalance."
-                )
-        
-        if not recommendations:
-            recommendations.append("Nice! No budgeting issues detected.")
-        return {
-            "status": "analyzed",
-            "recommendations": recommendations
-        }, 200
+        return pyf_recommendations(categories, category_spending, total_income, first_purchase_category_id, unlinked_titles, anomalies)
 
     except Exception as e:
         return {"status": "error", "msg": str(e)}, 500
 
+# Recommendation rules for a PYF budget, from already loaded data.
+# categories only need id, title, allocated_amount, priority and is_savings (ORM objects or rows).
+# anomalies are the flagged purchases from anomaly.py, most unusual first.
+# Shared by pyf_purchase_calculation and the nightly batch job (pyf_batch.py)
+def pyf_recommendations(categories, category_spending, total_income, first_purchase_category_id, unlinked_titles, anomalies=()):
+    recommendations = []
+
+    # Find Savings category (PYF focuses on Savings category)
+    savings_category = next((c for c in categories if c.is_savings), None)
+    if not savings_category:
+        return {"status": "error", "msg": "Savings category not found"}, 400
+
+    ## 2. First Purchase check --> Savings?
+    if first_purchase_category_id != savings_category.id:
+        recommendations.append("First purchase was not made towards Savings. Remember to prioritize Savings first.")
+
+    ## 3. Savings fully paid --> Goal met?
+    # Total amount spent (purchased) on Savings
+    total_spent_on_savings = category_spending.get(savings_category.id, 0)
+    
+    # Compare total Savings Purchases to Savings allocation
+    if total_spent_on_savings < savings_category.allocated_amount:
+        recommendations.append(
+            f'Savings goal not fully funded yet. ${ savings_category.allocated_amount - total_spent_on_savings:.2f} remaining.')
+
+    ## 4. Check for overspending
+
+    # Calculate total spent (all purchases regardless of link)
+    total_spent = sum(category_spending.values())
+    # Check if user spent more than their income
+    if total_spent > total_income:
+        recommendations.append(
+            f"Warning: You have exceeded your total income for this budget period by ${total_spent - total_income:.2f}."
+        )
+
+    # Check spending against each category's allocation
+    for category in categories:
+        spent = category_spending.get(category.id, 0)
+        if spent > category.allocated_amount:
+            overspent_amount = spent - category.allocated_amount
+            recommendations.append(
+                f"Overspending detected: '{category.title}' is overspent by ${overspent_amount:.2f}"
+            )
+    
+    ## 5. Category priority violation check --> Are lower categories being spent first?
+
+    # Track which priorities have had spending
+    priority_spending = {}
+    for category in categories:
+        if category.id in category_spending:
+            priority_spending[category.priority] = priority_spending.get(category.priority, 0) + category_spending[category.id]
+    
+    # Check if any lower-priority category has spending before higher ones. One pass over the
+    # spent priorities, collecting the (more important) priorities skipped so far
+    missing_priorities = []
+    next_priority = 1
+    for priority in sorted(priority_spending.keys()):
+        missing_priorities.extend(range(next_priority, priority))
+        next_priority = max(next_priority, priority + 1)
+        for higher_priority in missing_priorities:
+            recommendations.append(
+                f"Spending detected on lower-priority category (priority {priority}) before fully funding higher-priority category (priority {higher_priority})."
+            )
+
+    ## 6. Unexpected Purchase check
+    for title in unlinked_titles:
+        recommendations.append(
+            f"Unexpected purchase detected: '{title}' is not linked to any planned expense. Recommend adjusting lower-priority allocations to account for imbalance."
+        )
+
+    ## 7. Unusual purchase check --> Much larger than usual for its category?
+    category_titles = {category.id: category.title for category in categories}
+    for anomaly in anomalies:
+        recommendations.append(
+            f"Unusual purchase detected: '{anomaly['title']}' (${anomaly['amount']}) is much larger than usual for "
+            f"'{category_titles.get(anomaly['category_id'], 'Uncategorized')}' (typically ${anomaly['typical_amount']})."
+        )
+
+    if not recommendations:
+        recommendations.append("Nice! No budgeting issues detected.")
+    return {
+        "status": "analyzed",
+        "recommendations": recommendations,
+        "anomalies": list(anomalies)
+    }, 200
+
 # THE PURCHASES ACT AS THE TRACKER BECAUSE THEY CAN SEE WHAT THEY SPENT IN EACH CATEGORY
 
 
@@ -232,3 +222,30 @@ def create_pyf_budget_route(budget_id):
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
+
+# How the budget's income funds each category in priority order (Savings first).
+# ?income=<amount> answers "what if my income per budget period was this?" without saving anything.
+@pyf_budget_bp.route("/api/budgets/<int:budget_id>/allocation", methods=["GET"])
+def get_budget_allocation(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if budget.method.lower() != "pay-yourself-first":
+            return jsonify({"status": "error", "msg": "Allocation is only available for pay-yourself-first budgets."}), 400
+
+        what_if_income = None
+        if "income" in request.args:
+            try:
+                what_if_income = to_money(request.args["income"])
+                if not what_if_income.is_finite():
+                    raise ValueError # NaN cannot even be compared with 0
+            except (ValueError, ArithmeticError):
+                return jsonify({"status": "error", "msg": "Income must be a number"}), 400
+            if what_if_income < 0:
+                return jsonify({"status": "error", "msg": "Income cannot be negative"}), 400
+
+        return jsonify(budget_allocation(budget, what_if_income)), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,343 @@
+# read_paths.py by Eden Pardo
+# Lean read path for the listing routes. Loading ORM objects and calling to_json() on each pays for the
+# identity map, instrumented attributes and one lazy load per relationship; a ReadModel instead selects
+# only the response's columns with SQLAlchemy Core and turns each row (a plain tuple) into the response
+# dict with a serializer generated once per model, e.g.
+#   def serialize_purchase(row):
+#       lead, v0, v1, v2, ... = row
+#       return lead, {'id': v0, 'amount': format_cents(v4), ...}
+# Statements are built once per set of requested fields, so SQLAlchemy's compiled cache is hit on every call.
+# Money is read as integer cents and formatted without Decimal. The output is the same as to_json().
+# ?fields= and ?include= (sparse_fieldset) pick the columns and collections that are queried at all.
+# Compare both paths with: flask --app app benchmark-reads --rows 5000
+import click
+import time
+import tracemalloc
+from collections import namedtuple
+from flask import request
+from flask.cli import with_appcontext
+from sqlalchemy import select, func, bindparam, type_coerce, BigInteger
+from models import (Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                    RecurringPurchase)
+from money import format_cents
+from extensions import db
+
+DATE_FORMAT = "%d/%m/%y"
+
+# How a column is written into the response
+FORMATTERS = {
+    None: "{0}",
+    "money": "format_cents({0})",
+    "date": "({0}.strftime(DATE_FORMAT) if {0} else None)",
+    "timestamp": "({0}.isoformat() if {0} else None)",
+}
+
+# Build the serializer of a read model: one function returning a dict literal, no loop per field.
+# Rows start with a lead column (the item's id or its parent's id), returned next to the dict.
+def compile_serializer(name, fields):
+    names = [f"v{position}" for position in range(len(fields))]
+    items = [f"{key!r}: {FORMATTERS[kind].format(var)}" for (key, column, kind), var in zip(fields, names)]
+    source = f"def serialize_{name}(row):\n    {', '.join(['lead'] + names)}, = row\n    return lead, {{{', '.join(items)}}}\n"
+    namespace = {"format_cents": format_cents, "DATE_FORMAT": DATE_FORMAT}
+    exec(compile(source, f"<read model {name}>", "exec"), namespace)
+    return namespace[f"serialize_{name}"]
+
+# Statements selecting one set of fields (by parent, by several parents, by id) and their serializer
+ReadView = namedtuple("ReadView", ["statement", "many_statement", "one_statement", "serialize"])
+
+class ReadModel:
+    """Columns of one resource, the statements that select them and the serializers for their rows.
+    Each set of requested fields gets its own statements and serializer, built on first use."""
+
+    # joins: [(table, onclause)] outer joined only when one of the selected fields comes from that table
+    def __init__(self, name, fields, table, parent_column, order_by, where=(), joins=()):
+        self.name = name
+        self.fields = fields
+        self.keys = [key for key, column, kind in fields]
+        self.table = table
+        self.joins = joins
+        self.parent_column = parent_column # None: the resource is listed without a parent
+        self.id_column = fields[0][1]
+        self.order_by = order_by
+        self.where = where
+        self.views = {} # (keys, lead) --> ReadView
+
+    # keys: fields to return, None for all of them. lead: "id" or "parent", the column put in front of each row
+    def view(self, keys=None, lead="id"):
+        keys = None if keys is None else tuple(key for key in self.keys if key in keys)
+        view = self.views.get((keys, lead))
+        if view is None:
+            fields = [field for field in self.fields if keys is None or field[0] in keys]
+            lead_column = self.id_column if lead == "id" else self.parent_column
+            # Money columns skip the Money type (and its Decimal) and come back as cents
+            columns = [lead_column.label("lead")] + [
+                (type_coerce(column, BigInteger) if kind == "money" else column).label(key) for key, column, kind in fields
+            ]
+            from_clause = self.table
+            for table, onclause in self.joins:
+                if any(getattr(column, "table", None) is table for key, column, kind in fields):
+                    from_clause = from_clause.outerjoin(table, onclause)
+            statement = select(*columns).select_from(from_clause).where(*self.where).order_by(*self.order_by)
+            parent = self.parent_column
+            view = ReadView(
+                statement if parent is None else statement.where(parent == bindparam("parent_id")),
+                None if parent is None else statement.where(parent.in_(bindparam("parent_ids", expanding=True))),
+                statement.where(self.id_column == bindparam("item_id")),
+                compile_serializer(self.name, fields)
+            )
+            self.views[(keys, lead)] = view
+        return view
+
+    # [(id, item)] of one parent (or of every row when the model has no parent)
+    def keyed(self, parent_id=None, keys=None):
+        view = self.view(keys)
+        params = {} if self.parent_column is None else {"parent_id": parent_id}
+        return list(map(view.serialize, db.session.execute(view.statement, params)))
+
+    def list(self, parent_id=None, keys=None):
+        return [item for item_id, item in self.keyed(parent_id, keys)]
+
+    # {parent_id: [items]} for several parents in one query
+    def grouped(self, parent_ids, keys=None):
+        groups = {parent_id: [] for parent_id in parent_ids}
+        if parent_ids:
+            view = self.view(keys, lead="parent")
+            for parent_id, item in map(view.serialize, db.session.execute(view.many_statement, {"parent_ids": list(parent_ids)})):
+                groups[parent_id].append(item)
+        return groups
+
+    # One item by id, or None
+    def get(self, item_id, keys=None):
+        view = self.view(keys)
+        row = db.session.execute(view.one_statement, {"item_id": item_id}).first()
+        return None if row is None else view.serialize(row)[1]
+
+# Sparse fieldsets: ?fields=id,title,total_income picks the keys of each returned item and
+# ?include=incomes,expenses the collections embedded in it. Without either parameter everything is
+# returned; with fields= but no include=, only the collections named in fields are embedded.
+# Returns (keys or None for all, names of the collections to embed). Raises ValueError for unknown names.
+def sparse_fieldset(read_model, collections=()):
+    def names(parameter):
+        value = request.args.get(parameter)
+        return None if value is None else [name.strip() for name in value.split(",") if name.strip()]
+
+    fields = names("fields")
+    include = names("include")
+    unknown = [name for name in fields or [] if name not in read_model.keys and name not in collections]
+    unknown += [name for name in include or [] if name not in collections]
+    if unknown:
+        available = ", ".join([*read_model.keys, *collections])
+        raise ValueError(f"Unknown field: {', '.join(unknown)}. Available: {available}")
+
+    if fields is None and include is None:
+        return None, list(collections)
+    keys = None if fields is None else [key for key in read_model.keys if key in fields]
+    return keys, [name for name in collections if name in (include or []) or name in (fields or [])]
+
+# Only the requested keys of an already serialized item (single-row routes that still use to_json)
+def pick(item, keys):
+    return item if keys is None else {key: item[key] for key in keys}
+
+# Embed each included collection, one query per collection whatever the number of items
+def with_collections(keyed_items, collections, include):
+    item_ids = [item_id for item_id, item in keyed_items]
+    for name in include:
+        groups = collections[name].grouped(item_ids)
+        for item_id, item in keyed_items:
+            item[name] = groups[item_id]
+    return [item for item_id, item in keyed_items]
+
+incomes = BudgetIncome.__table__
+expenses = BudgetExpense.__table__
+categories = Category.__table__
+purchases = Purchase.__table__
+budgets = Budget.__table__
+recurring = RecurringPurchase.__table__
+initial_incomes = InitialIncome.__table__
+initial_expenses = InitialExpense.__table__
+users = Users.__table__
+
+def initial_item_model(name, table):
+    return ReadModel(name, [
+        ("id", table.c.id, None),
+        ("title", table.c.title, None),
+        ("amount", table.c.amount, "money"),
+        ("frequency", table.c.frequency, None),
+        ("user_id", table.c.user_id, None),
+    ], table, table.c.user_id, [table.c.id])
+
+INITIAL_INCOMES = initial_item_model("initial_income", initial_incomes)
+INITIAL_EXPENSES = initial_item_model("initial_expense", initial_expenses)
+
+BUDGET_INCOMES = ReadModel("budget_income", [
+    ("id", incomes.c.id, None),
+    ("budget_id", incomes.c.budget_id, None),
+    ("version", incomes.c.version, None),
+    ("title", incomes.c.title, None),
+    ("amount", incomes.c.amount, "money"),
+    ("frequency", incomes.c.frequency, None),
+], incomes, incomes.c.budget_id, [incomes.c.id])
+
+BUDGET_EXPENSES = ReadModel("budget_expense", [
+    ("id", expenses.c.id, None),
+    ("budget_id", expenses.c.budget_id, None),
+    ("version", expenses.c.version, None),
+    ("title", expenses.c.title, None),
+    ("amount", expenses.c.amount, "money"),
+    ("frequency", expenses.c.frequency, None),
+    ("category_id", expenses.c.category_id, None),
+    ("category_name", categories.c.title, None),
+], expenses, expenses.c.budget_id, [expenses.c.id], joins=[(categories, categories.c.id == expenses.c.category_id)])
+
+CATEGORIES = ReadModel("category", [
+    ("id", categories.c.id, None),
+    ("budget_id", categories.c.budget_id, None),
+    ("version", categories.c.version, None),
+    ("title", categories.c.title, None),
+    ("description", categories.c.description, None),
+    ("allocated_amount", categories.c.allocated_amount, "money"),
+    ("priority", categories.c.priority, None),
+    ("is_savings", categories.c.is_savings, None),
+], categories, categories.c.budget_id, [categories.c.id])
+
+# Same order as the (budget_id, date) index the listing used to be read through
+PURCHASES = ReadModel("purchase", [
+    ("id", purchases.c.id, None),
+    ("budget_id", purchases.c.budget_id, None),
+    ("version", purchases.c.version, None),
+    ("title", purchases.c.title, None),
+    ("amount", purchases.c.amount, "money"),
+    ("date", purchases.c.date, "date"),
+    ("budget_expense_id", purchases.c.budget_expense_id, None),
+    ("budget_expense", expenses.c.title, None),
+], purchases, purchases.c.budget_id, [purchases.c.date, purchases.c.id],
+   joins=[(expenses, expenses.c.id == purchases.c.budget_expense_id)])
+
+RECURRING_PURCHASES = ReadModel("recurring_purchase", [
+    ("id", recurring.c.id, None),
+    ("budget_id", recurring.c.budget_id, None),
+    ("budget_expense_id", recurring.c.budget_expense_id, None),
+    ("budget_expense", expenses.c.title, None),
+    ("title", recurring.c.title, None),
+    ("amount", recurring.c.amount, "money"),
+    ("frequency", recurring.c.frequency, None),
+    ("start_date", recurring.c.start_date, "date"),
+    ("next_run", recurring.c.next_run, "date"),
+    ("occurrences", recurring.c.occurrences, None),
+    ("active", recurring.c.active, None),
+    ("lastRunAt", recurring.c.last_run_at, "timestamp"),
+], recurring, recurring.c.budget_id, [recurring.c.next_run, recurring.c.id],
+   joins=[(expenses, expenses.c.id == recurring.c.budget_expense_id)])
+
+def item_total(table):
+    return select(func.coalesce(func.sum(table.c.amount), 0)).where(table.c.budget_id == budgets.c.id).correlate(budgets).scalar_subquery()
+
+# Budget.to_json() without the item lists; the totals are summed in the same query
+BUDGETS = ReadModel("budget", [
+    ("id", budgets.c.id, None),
+    ("userId", budgets.c.user_id, None),
+    ("budget_id", budgets.c.id, None),
+    ("version", budgets.c.version, None),
+    ("title", budgets.c.title, None),
+    ("method", budgets.c.method, None),
+    ("period", budgets.c.period, None),
+    ("createdAt", budgets.c.created_at, "date"),
+    ("updatedAt", budgets.c.updated_at, "date"),
+    ("total_income", item_total(incomes), "money"),
+    ("total_expenses", item_total(expenses), "money"),
+    ("balance_after_expenses", item_total(incomes) - item_total(expenses), "money"),
+    ("unassigned_amount", budgets.c.unassigned_amount, "money"),
+], budgets, budgets.c.user_id, [budgets.c.id], where=[budgets.c.deleted_at.is_(None)])
+
+BUDGET_COLLECTIONS = {"expenses": BUDGET_EXPENSES, "incomes": BUDGET_INCOMES, "all_categories": CATEGORIES}
+
+USERS = ReadModel("user", [
+    ("id", users.c.id, None),
+    ("name", users.c.name, None),
+    ("username", users.c.username, None),
+], users, None, [users.c.id], where=[users.c.deleted_at.is_(None)])
+
+USER_COLLECTIONS = {"initial_incomes": INITIAL_INCOMES, "initial_expenses": INITIAL_EXPENSES}
+
+# Every budget of a user as Budget.to_json() returns it: four queries whatever the number of budgets
+# (fewer with keys/include, see sparse_fieldset)
+def user_budgets(user_id, keys=None, include=tuple(BUDGET_COLLECTIONS)):
+    return with_collections(BUDGETS.keyed(user_id, keys), BUDGET_COLLECTIONS, include)
+
+def budget_json(budget_id, keys=None, include=tuple(BUDGET_COLLECTIONS)):
+    return with_collections([(budget_id, BUDGETS.get(budget_id, keys))], BUDGET_COLLECTIONS, include)[0]
+
+# Users as Users.to_json() returns them (every user of the current shard)
+def users_json(keys=None, include=tuple(USER_COLLECTIONS)):
+    return with_collections(USERS.keyed(keys=keys), USER_COLLECTIONS, include)
+
+def user_json(user_id, keys=None, include=tuple(USER_COLLECTIONS)):
+    return with_collections([(user_id, USERS.get(user_id, keys))], USER_COLLECTIONS, include)[0]
+
+# Best of `repeat` runs (each with an empty identity map, like a new request) and peak memory of one run
+def measure(build, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        build()
+        timings.append(time.perf_counter() - started)
+    db.session.expunge_all()
+    tracemalloc.start()
+    result = build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(timings), peak, result
+
+@click.command("benchmark-reads")
+@click.option("--rows", type=int, default=5000, show_default=True, help="Purchases in the benchmark budget.")
+@click.option("--repeat", type=int, default=5, show_default=True, help="Runs per read path (best one is reported).")
+@with_appcontext
+def benchmark_reads_command(rows, repeat):
+    """Compare the ORM to_json() listings with the read models. The sample data is rolled back."""
+    if rows < 1 or repeat < 1:
+        raise click.BadParameter("--rows and --repeat must be positive")
+    try:
+        user = Users(name="Benchmark", username="benchmark-reads", password="-")
+        db.session.add(user)
+        db.session.flush()
+        budget = Budget(user_id=user.id, title="Benchmark", method="pay-yourself-first", period="monthly")
+        db.session.add(budget)
+        db.session.flush()
+        category = Category(budget_id=budget.id, title="Savings", allocated_amount=100, priority=1, is_savings=True)
+        db.session.add(category)
+        db.session.flush()
+        budget_expenses = [
+            BudgetExpense(budget_id=budget.id, title=f"Expense {n}", amount=50 + n, frequency="monthly",
+                          category_id=category.id if n % 2 else None)
+            for n in range(20)
+        ]
+        db.session.add_all(budget_expenses)
+        db.session.flush()
+        db.session.add_all([
+            Purchase(budget_id=budget.id, title=f"Purchase {n}", amount=n % 997 + 0.99,
+                     budget_expense_id=budget_expenses[n % 20].id if n % 5 else None)
+            for n in range(rows)
+        ])
+        db.session.flush()
+        budget_id = budget.id
+
+        listings = [
+            ("purchases", rows,
+             lambda: [purchase.to_json() for purchase in
+                      Purchase.query.filter_by(budget_id=budget_id).order_by(Purchase.date, Purchase.id).all()],
+             lambda: PURCHASES.list(budget_id)),
+            ("budget-expenses", len(budget_expenses),
+             lambda: [expense.to_json() for expense in db.session.get(Budget, budget_id).expenses],
+             lambda: BUDGET_EXPENSES.list(budget_id)),
+        ]
+        for name, count, orm_path, core_path in listings:
+            orm_time, orm_peak, orm_result = measure(orm_path, repeat)
+            core_time, core_peak, core_result = measure(core_path, repeat)
+            click.echo(
+                f"{name} ({count} rows): to_json {orm_time / count * 1e6:.1f} us/row, {orm_peak / count / 1024:.2f} KiB/row peak"
+                f" | read model {core_time / count * 1e6:.1f} us/row, {core_peak / count / 1024:.2f} KiB/row peak"
+                f" | {orm_time / core_time:.1f}x faster, same output: {orm_result == core_result}"
+            )
+    finally:
+        db.session.rollback()
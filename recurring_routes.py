@@ -0,0 +1,340 @@
+# recurring_routes.py by Eden Pardo
+# Recurring purchases: a rule on a budget expense (rent, subscriptions) that creates the purchase
+# every period. The scheduler picks up all due rules in batches; each batch inserts its purchases and
+# rollup changes with bulk statements in one transaction, and every budget that got purchases is
+# recalculated once at the end of the run.
+#   RECURRING_WORKER=1                 run the scheduler in a background thread (otherwise use `flask run-recurring`)
+#   RECURRING_INTERVAL_SECONDS=3600    how often the worker looks for due rules
+#   RECURRING_BATCH_SIZE=500           rules per transaction
+import calendar
+import click
+import os
+import threading
+from datetime import date, datetime, time, timedelta
+from flask import Blueprint, request, jsonify, g
+from flask.cli import with_appcontext
+from sqlalchemy import insert, update
+from models import Budget, BudgetExpense, Purchase, PurchaseRollup, RecurringPurchase
+from extensions import db
+from validation import checked_title, checked_amount, checked_frequency
+from purchase_rollups import bucket_start
+from pyf_budget_routes import pyf_purchase_calculation
+from fiftythirtytwenty_budget_routes import fifty_thirty_twenty_calculation
+from zerobased_budget_routes import zero_based_calculation
+from sharding import sharding_enabled, shard_ids, use_shard, reserve_ids
+from change_stream import record_change
+from sync_routes import reserve_change_seqs
+from read_paths import RECURRING_PURCHASES, sparse_fieldset
+
+recurring_bp = Blueprint('recurring', __name__)
+
+DEFAULT_INTERVAL_SECONDS = 3600
+DEFAULT_BATCH_SIZE = 500
+# A rule that is far behind catches up over several batches
+MAX_OCCURRENCES_PER_BATCH = 60
+
+# Date of occurrence n of a rule. Months and years keep the start day (clamped to the month's
+# length), so a rule starting on the 31st runs on the last day of shorter months without drifting.
+def occurrence_date(start_date, frequency, n):
+    frequency = frequency.lower()
+    if frequency == "weekly":
+        return start_date + timedelta(weeks=n)
+    if frequency == "biweekly":
+        return start_date + timedelta(weeks=2 * n)
+    if frequency == "monthly":
+        month_index = start_date.month - 1 + n
+        year, month = start_date.year + month_index // 12, month_index % 12 + 1
+    elif frequency == "yearly":
+        year, month = start_date.year + n, start_date.month
+    else:
+        raise ValueError(f"Invalid frequency: {frequency}")
+    return date(year, month, min(start_date.day, calendar.monthrange(year, month)[1]))
+
+# Ids for bulk inserts into a shard come from the shard's sequence (mapper events do not run)
+def assign_ids(model, rows):
+    if not rows or g.get("shard") is None:
+        return
+    connection = db.session.connection(bind_arguments={"mapper": model.__mapper__})
+    first_id = reserve_ids(connection, model.__tablename__, len(rows))
+    for offset, row in enumerate(rows):
+        row["id"] = first_id + offset
+
+# Add the new purchases to their rollup rows: one UPDATE per touched row, one bulk INSERT for new rows
+def apply_rollup_totals(totals):
+    new_rows = []
+    for (budget_id, budget_expense_id, category_id, period_start), (total, count) in totals.items():
+        result = db.session.execute(
+            update(PurchaseRollup).where(
+                PurchaseRollup.budget_id == budget_id,
+                PurchaseRollup.budget_expense_id == budget_expense_id,
+                PurchaseRollup.category_id == category_id,
+                PurchaseRollup.period_start == period_start
+            ).values(total=PurchaseRollup.total + total, purchase_count=PurchaseRollup.purchase_count + count),
+            execution_options={"synchronize_session": False}
+        )
+        if result.rowcount == 0:
+            new_rows.append({
+                "budget_id": budget_id,
+                "budget_expense_id": budget_expense_id,
+                "category_id": category_id,
+                "period_start": period_start,
+                "total": total,
+                "purchase_count": count
+            })
+    assign_ids(PurchaseRollup, new_rows)
+    if new_rows:
+        db.session.execute(insert(PurchaseRollup), new_rows)
+
+# Materialize one batch of due rules in one transaction. Returns (rules, purchases, budget ids).
+def run_recurring_batch(today, batch_size):
+    # ORM query, so rules of soft-deleted budgets are skipped
+    due = db.session.query(RecurringPurchase, BudgetExpense.category_id, Budget.period).join(
+        BudgetExpense, BudgetExpense.id == RecurringPurchase.budget_expense_id
+    ).join(Budget, Budget.id == RecurringPurchase.budget_id).filter(
+        RecurringPurchase.active.is_(True),
+        RecurringPurchase.next_run <= today
+    ).order_by(RecurringPurchase.id).limit(batch_size).all()
+    if not due:
+        return 0, 0, set()
+
+    now = datetime.utcnow()
+    purchases = []
+    rollup_totals = {}
+    for rule, category_id, period in due:
+        generated = 0
+        while rule.next_run <= today and generated < MAX_OCCURRENCES_PER_BATCH:
+            purchases.append({
+                "budget_id": rule.budget_id,
+                "budget_expense_id": rule.budget_expense_id,
+                "title": rule.title,
+                "amount": rule.amount,
+                "date": datetime.combine(rule.next_run, time())
+            })
+            key = (rule.budget_id, rule.budget_expense_id, category_id, bucket_start(rule.next_run, period))
+            total, count = rollup_totals.get(key, (0, 0))
+            rollup_totals[key] = (total + rule.amount, count + 1)
+            generated += 1
+            rule.next_run = occurrence_date(rule.start_date, rule.frequency, rule.occurrences + generated)
+        rule.occurrences += generated
+        rule.last_run_at = now
+
+    assign_ids(Purchase, purchases)
+    next_seq = reserve_change_seqs(db.session, len(purchases))
+    for offset, purchase in enumerate(purchases):
+        purchase["change_seq"] = next_seq + offset
+    db.session.execute(insert(Purchase), purchases)
+    apply_rollup_totals(rollup_totals)
+    for budget_id in {purchase["budget_id"] for purchase in purchases}:
+        record_change(db.session, "purchase", None, budget_id, "created")
+    db.session.commit()
+    return len(due), len(purchases), {rule.budget_id for rule, category_id, period in due}
+
+# The same recalculation the purchase routes run after a change
+def recalculate_budget(budget_id):
+    budget = Budget.query.get(budget_id)
+    if not budget:
+        return None, 404
+    if budget.method.lower() == "pay-yourself-first":
+        return pyf_purchase_calculation(budget_id)
+    if budget.method.lower() == "50-30-20":
+        return fifty_thirty_twenty_calculation(budget_id)
+    if budget.method.lower() == "zero-based":
+        return zero_based_calculation(budget_id)
+    return None, 200
+
+# Run every due rule up to `today` on the current database. Returns
+# {"rules": n, "purchases": n, "recalculations": {budget_id: result}}.
+def run_due_rules(today, batch_size):
+    summary = {"rules": 0, "purchases": 0, "recalculations": {}}
+    affected = set()
+    while True:
+        rules, purchases, budget_ids = run_recurring_batch(today, batch_size)
+        if not rules:
+            break
+        summary["rules"] += rules
+        summary["purchases"] += purchases
+        affected |= budget_ids
+
+    # Once per budget, however many batches or occurrences touched it
+    for budget_id in sorted(affected):
+        summary["recalculations"][budget_id] = recalculate_budget(budget_id)[0]
+    db.session.commit()
+    return summary
+
+# Every shard when sharding is on
+def run_recurring(today=None, batch_size=DEFAULT_BATCH_SIZE):
+    today = today or date.today()
+    if not sharding_enabled():
+        return run_due_rules(today, batch_size)
+
+    summary = {"rules": 0, "purchases": 0, "recalculations": {}}
+    for shard in shard_ids():
+        with use_shard(shard):
+            shard_summary = run_due_rules(today, batch_size)
+            db.session.remove() # Next shard starts with a fresh session
+        summary["rules"] += shard_summary["rules"]
+        summary["purchases"] += shard_summary["purchases"]
+        summary["recalculations"].update(shard_summary["recalculations"])
+    return summary
+
+class RecurringWorker:
+    def __init__(self, app):
+        self.app = app
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="recurring-worker", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        config = self.app.config
+        while not self.stop.wait(config["RECURRING_INTERVAL_SECONDS"]):
+            try:
+                with self.app.app_context():
+                    run_recurring(batch_size=config["RECURRING_BATCH_SIZE"])
+            except Exception as e:
+                self.app.logger.warning(f"Recurring purchases failed: {e}")
+
+def init_recurring(app):
+    app.config.setdefault("RECURRING_WORKER", os.environ.get("RECURRING_WORKER", "0") == "1")
+    app.config.setdefault("RECURRING_INTERVAL_SECONDS", float(os.environ.get("RECURRING_INTERVAL_SECONDS", DEFAULT_INTERVAL_SECONDS)))
+    app.config.setdefault("RECURRING_BATCH_SIZE", int(os.environ.get("RECURRING_BATCH_SIZE", DEFAULT_BATCH_SIZE)))
+
+    if app.config["RECURRING_WORKER"]:
+        worker = app.extensions["recurring_worker"] = RecurringWorker(app)
+        worker.start()
+
+@click.command("run-recurring")
+@click.option("--date", "run_date", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Create purchases due up to this day (default: today).")
+@click.option("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rules per transaction.")
+@with_appcontext
+def run_recurring_command(run_date, batch_size):
+    if batch_size < 1:
+        raise click.BadParameter("--batch-size must be positive")
+    summary = run_recurring(run_date.date() if run_date else None, batch_size)
+    click.echo(f"Created {summary['purchases']} purchases from {summary['rules']} rules; "
+               f"recalculated {len(summary['recalculations'])} budgets.")
+
+## Routes
+def parse_start_date(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+# Create a recurring purchase for an expense. All fields are optional and default to the
+# expense's title/amount/frequency; start_date (YYYY-MM-DD) defaults to today.
+@recurring_bp.route("/api/budgets/<int:budget_id>/budget-expenses/<int:budget_expense_id>/recurring", methods=["POST"])
+def create_recurring_purchase(budget_id, budget_expense_id):
+    try:
+        expense = BudgetExpense.query.filter_by(id=budget_expense_id, budget_id=budget_id).first()
+        if not expense:
+            return jsonify({"status": "error", "msg": "Expense not found"}), 404
+
+        data = request.get_json(silent=True) or {}
+
+        title = checked_title(data.get("title", expense.title))
+        amount = checked_amount(data.get("amount", expense.amount))
+        frequency = checked_frequency(data.get("frequency", expense.frequency))
+
+        start_date = date.today()
+        if "start_date" in data:
+            start_date = parse_start_date(data["start_date"])
+            if start_date is None:
+                return jsonify({"status": "error", "msg": "start_date must be a date (YYYY-MM-DD)"}), 400
+
+        rule = RecurringPurchase(
+            budget_id=budget_id,
+            budget_expense_id=expense.id,
+            title=title,
+            amount=amount,
+            frequency=frequency,
+            start_date=start_date,
+            next_run=start_date,
+            occurrences=0,
+            active=True
+        )
+        db.session.add(rule)
+        db.session.commit()
+
+        return jsonify({
+            "msg": "Recurring purchase created successfully",
+            "recurring_purchase": rule.to_json()
+        }), 201
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@recurring_bp.route("/api/budgets/<int:budget_id>/recurring", methods=["GET"])
+def get_recurring_purchases(budget_id):
+    try:
+        keys, _ = sparse_fieldset(RECURRING_PURCHASES)
+        return jsonify(RECURRING_PURCHASES.list(budget_id, keys)), 200
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Update a recurring purchase. A new frequency or start_date restarts the schedule from that date
+# (frequency alone: from the next run).
+@recurring_bp.route("/api/budgets/<int:budget_id>/recurring/<int:recurring_id>", methods=["PATCH"])
+def update_recurring_purchase(budget_id, recurring_id):
+    try:
+        rule = RecurringPurchase.query.filter_by(id=recurring_id, budget_id=budget_id).first()
+        if not rule:
+            return jsonify({"status": "error", "msg": "Recurring purchase not found"}), 404
+
+        data = request.json
+
+        if "title" in data:
+            rule.title = checked_title(data["title"])
+
+        if "amount" in data:
+            rule.amount = checked_amount(data["amount"])
+
+        if "active" in data:
+            rule.active = bool(data["active"])
+
+        start_date = rule.next_run
+        if "start_date" in data:
+            start_date = parse_start_date(data["start_date"])
+            if start_date is None:
+                return jsonify({"status": "error", "msg": "start_date must be a date (YYYY-MM-DD)"}), 400
+        if "frequency" in data:
+            rule.frequency = checked_frequency(data["frequency"])
+        if "start_date" in data or "frequency" in data:
+            rule.start_date = rule.next_run = start_date
+            rule.occurrences = 0
+
+        db.session.commit()
+        return jsonify({
+            "msg": "Recurring purchase updated successfully",
+            "recurring_purchase": rule.to_json()
+        }), 200
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@recurring_bp.route("/api/budgets/<int:budget_id>/recurring/<int:recurring_id>", methods=["DELETE"])
+def delete_recurring_purchase(budget_id, recurring_id):
+    try:
+        rule = RecurringPurchase.query.filter_by(id=recurring_id, budget_id=budget_id).first()
+        if not rule:
+            return jsonify({"status": "error", "msg": "Recurring purchase not found"}), 404
+
+        db.session.delete(rule)
+        db.session.commit()
+        return jsonify({"msg": "Recurring purchase deleted successfully", "id": recurring_id}), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,212 @@
+# scenario_routes.py by Eden Pardo
+# What-if scenarios: evaluate many hypothetical edits of a budget in one request without writing
+# anything. The budget's incomes, expenses and categories are loaded once into NumPy arrays with one
+# row per scenario; each scenario's edits only change its row, and totals, balances and the priority
+# waterfall (see allocation.py) are then computed for all scenarios at once.
+#
+# Body: {"scenarios": [{"name": "Cut dining 20%", "period": "biweekly", "changes": [
+#           {"expense_id": 3, "scale": 0.8},
+#           {"category_id": 1, "amount": 500},
+#           {"income_id": 2, "frequency": "biweekly"},
+#           {"expense_id": 4, "remove": true}]}]}
+# A change names one item and any of: amount (allocated_amount for categories), scale, frequency
+# (incomes/expenses) or remove. "period" re-expresses the whole budget per another period.
+import numpy as np
+from flask import Blueprint, request, jsonify
+from models import Budget, BudgetExpense, BudgetIncome, Category
+from constants import VALID_PERIODS
+from money import to_money, MINOR_UNITS
+from purchase_rollups import category_totals
+from allocation import waterfall_order
+from forecast_routes import from_cents
+
+scenario_bp = Blueprint('scenario', __name__)
+
+MAX_SCENARIOS = 100
+
+# Change key --> index into the item lists loaded for the budget
+ITEM_KEYS = ["income_id", "expense_id", "category_id"]
+
+def to_cents(value):
+    return int(to_money(value) * MINOR_UNITS)
+
+# Cents for an amount sent in a change. Text, null, NaN and Infinity are not amounts.
+def checked_cents(value, label):
+    try:
+        amount = to_money(value)
+        if amount is None or not amount.is_finite():
+            raise ValueError
+        return to_cents(amount)
+    except (ArithmeticError, TypeError, ValueError):
+        raise ValueError(f"{label}: amount must be a number")
+
+def parse_frequency(value, label):
+    if not isinstance(value, str) or value.lower() not in VALID_PERIODS:
+        raise ValueError(f"{label}: frequency must be one of {', '.join(VALID_PERIODS)}")
+    return VALID_PERIODS[value.lower()]
+
+class ScenarioArrays:
+    """Item amounts (cents), frequencies (weeks) and on/off flags with one row per scenario."""
+
+    def __init__(self, budget, count):
+        self.incomes = BudgetIncome.query.filter_by(budget_id=budget.id).order_by(BudgetIncome.id).all()
+        self.expenses = BudgetExpense.query.filter_by(budget_id=budget.id).order_by(BudgetExpense.id).all()
+        self.categories = sorted(Category.query.filter_by(budget_id=budget.id).all(), key=waterfall_order)
+        self.base_period_weeks = VALID_PERIODS.get(budget.period.lower(), VALID_PERIODS["monthly"])
+        self.period_weeks = np.full(count, self.base_period_weeks, dtype=np.float64)
+        self.periods = [budget.period.lower()] * count
+
+        self.index = {}
+        self.arrays = {}
+        for key, items, amount in (("income_id", self.incomes, "amount"),
+                                   ("expense_id", self.expenses, "amount"),
+                                   ("category_id", self.categories, "allocated_amount")):
+            self.index[key] = {item.id: position for position, item in enumerate(items)}
+            self.arrays[key] = {
+                "amount": np.tile(np.array([to_cents(getattr(item, amount)) for item in items], dtype=np.float64), (count, 1)),
+                "weeks": np.tile(np.array([
+                    VALID_PERIODS.get((getattr(item, "frequency", None) or budget.period).lower(), self.base_period_weeks)
+                    for item in items
+                ], dtype=np.float64), (count, 1)),
+                "active": np.ones((count, len(items)), dtype=bool)
+            }
+
+    def apply(self, row, change, label):
+        keys = [key for key in ITEM_KEYS if key in change]
+        if len(keys) != 1:
+            raise ValueError(f"{label}: name exactly one of {', '.join(ITEM_KEYS)}")
+        key = keys[0]
+        position = self.index[key].get(change[key])
+        if position is None:
+            raise LookupError(f"{label}: {key.replace('_id', '')} {change[key]} not found in this budget")
+        arrays = self.arrays[key]
+
+        if change.get("remove"):
+            arrays["active"][row, position] = False
+            return
+        if "amount" in change:
+            amount = checked_cents(change["amount"], label)
+            if amount < 0:
+                raise ValueError(f"{label}: amount cannot be negative")
+            arrays["amount"][row, position] = amount
+        if "scale" in change:
+            scale = change["scale"]
+            if isinstance(scale, bool) or not isinstance(scale, (int, float)) or scale < 0:
+                raise ValueError(f"{label}: scale must be a non-negative number")
+            arrays["amount"][row, position] *= scale
+        if "frequency" in change:
+            if key == "category_id":
+                raise ValueError(f"{label}: categories have no frequency")
+            arrays["weeks"][row, position] = parse_frequency(change["frequency"], label)
+
+    # Amounts of every item per each scenario's period, rounded to cents like convert_frequency
+    def per_period(self, key):
+        arrays = self.arrays[key]
+        return np.rint(arrays["amount"] * self.period_weeks[:, np.newaxis] / arrays["weeks"]) * arrays["active"]
+
+    def evaluate(self, budget, spending):
+        income = self.per_period("income_id").sum(axis=1)
+        expense_amounts = self.per_period("expense_id")
+        expenses = expense_amounts.sum(axis=1)
+        savings_category_ids = {category.id for category in self.categories if category.is_savings}
+        is_savings_expense = np.array([expense.category_id in savings_category_ids for expense in self.expenses], dtype=bool)
+        savings = (expense_amounts * is_savings_expense).sum(axis=1)
+
+        # Category allocations are kept per period, so they scale with the period (weeks column = base period)
+        allocated = self.per_period("category_id")
+        active = self.arrays["category_id"]["active"]
+        # Waterfall for every scenario at once: each category gets what is left after the ones before it
+        funded = np.clip(income[:, np.newaxis] - (np.cumsum(allocated, axis=1) - allocated), 0, allocated)
+        total_allocated = allocated.sum(axis=1)
+        total_funded = funded.sum(axis=1)
+        spent = np.array([to_cents(spending.get(category.id, 0)) for category in self.categories], dtype=np.float64)
+        overspent = spent[np.newaxis, :] - allocated
+        savings_columns = np.array([category.is_savings for category in self.categories], dtype=bool)
+        savings_allocated = (allocated * savings_columns).sum(axis=1)
+
+        pyf = budget.method.lower() == "pay-yourself-first"
+        results = []
+        for row in range(len(self.periods)):
+            recommendations = []
+            if expenses[row] > income[row]:
+                recommendations.append(f"Expenses exceed income by ${from_cents(expenses[row] - income[row])}. Adjust your expenses.")
+            if pyf and savings_allocated[row] <= 0:
+                recommendations.append("Savings category has no allocated amount.")
+            categories = []
+            for column, category in enumerate(self.categories):
+                if not active[row, column]:
+                    continue
+                underfunded = allocated[row, column] - funded[row, column]
+                categories.append({
+                    "id": category.id,
+                    "title": category.title,
+                    "priority": category.priority,
+                    "allocated_amount": from_cents(allocated[row, column]),
+                    "funded": from_cents(funded[row, column]),
+                    "underfunded": from_cents(underfunded)
+                })
+                if underfunded > 0:
+                    recommendations.append(f"'{category.title}' is underfunded by ${from_cents(underfunded)} at this income.")
+                if overspent[row, column] > 0:
+                    recommendations.append(f"Overspending detected: '{category.title}' is overspent by ${from_cents(overspent[row, column])}")
+            if not recommendations:
+                recommendations.append("Nice! No budgeting issues detected.")
+
+            results.append({
+                "period": self.periods[row],
+                "total_income": from_cents(income[row]),
+                "total_expenses": from_cents(expenses[row]),
+                "total_savings": from_cents(savings[row]),
+                "balance": from_cents(income[row] - expenses[row]),
+                "total_allocated": from_cents(total_allocated[row]),
+                "total_funded": from_cents(total_funded[row]),
+                "unallocated_income": from_cents(max(income[row] - total_funded[row], 0)),
+                "categories": categories,
+                "recommendations": recommendations
+            })
+        return results
+
+@scenario_bp.route("/api/budgets/<int:budget_id>/scenarios", methods=["POST"])
+def evaluate_scenarios(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+
+        scenarios = (request.json or {}).get("scenarios")
+        if not isinstance(scenarios, list) or not scenarios:
+            return jsonify({"status": "error", "msg": "Missing required field: scenarios"}), 400
+        if len(scenarios) > MAX_SCENARIOS:
+            return jsonify({"status": "error", "msg": f"At most {MAX_SCENARIOS} scenarios per request"}), 400
+
+        # Row 0 is the budget as it is now
+        arrays = ScenarioArrays(budget, len(scenarios) + 1)
+        try:
+            for row, scenario in enumerate(scenarios, start=1):
+                if not isinstance(scenario, dict):
+                    raise ValueError(f"Scenario {row - 1}: must be an object")
+                if "period" in scenario:
+                    arrays.period_weeks[row] = parse_frequency(scenario["period"], f"Scenario {row - 1}")
+                    arrays.periods[row] = scenario["period"].lower()
+                for number, change in enumerate(scenario.get("changes") or []):
+                    if not isinstance(change, dict):
+                        raise ValueError(f"Scenario {row - 1} change {number}: must be an object")
+                    arrays.apply(row, change, f"Scenario {row - 1} change {number}")
+        except LookupError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 404
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
+        baseline, *results = arrays.evaluate(budget, category_totals(budget_id))
+        return jsonify({
+            "budget_id": budget.id,
+            "method": budget.method,
+            "baseline": baseline,
+            "scenarios": [
+                {"name": scenario.get("name", f"Scenario {index + 1}"), **result}
+                for index, (scenario, result) in enumerate(zip(scenarios, results))
+            ]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,228 @@
+# search_routes.py by Eden Pardo
+import click
+from flask import Blueprint, request, jsonify, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text, inspect, select, literal, union_all
+from sqlalchemy.exc import OperationalError
+from models import Users, Budget, Purchase, BudgetExpense
+from sharding import sharding_enabled, shard_ids, use_shard
+from extensions import db
+
+search_bp = Blueprint('search', __name__)
+
+SEARCH_TYPES = ["purchase", "expense"]
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+# Search index rowids are derived from the source row so triggers can update by rowid:
+# purchases use id*2, budget expenses use id*2+1
+SQLITE_SEARCH_SETUP = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS title_search USING fts5(
+        title, entity_type UNINDEXED, entity_id UNINDEXED, budget_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS purchase_search_insert AFTER INSERT ON purchase BEGIN
+        INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id)
+        VALUES (new.id * 2, new.title, 'purchase', new.id, new.budget_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS purchase_search_update AFTER UPDATE OF title, budget_id ON purchase BEGIN
+        DELETE FROM title_search WHERE rowid = old.id * 2;
+        INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id)
+        VALUES (new.id * 2, new.title, 'purchase', new.id, new.budget_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS purchase_search_delete AFTER DELETE ON purchase BEGIN
+        DELETE FROM title_search WHERE rowid = old.id * 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS expense_search_insert AFTER INSERT ON budget_expense BEGIN
+        INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id)
+        VALUES (new.id * 2 + 1, new.title, 'expense', new.id, new.budget_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS expense_search_update AFTER UPDATE OF title, budget_id ON budget_expense BEGIN
+        DELETE FROM title_search WHERE rowid = old.id * 2 + 1;
+        INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id)
+        VALUES (new.id * 2 + 1, new.title, 'expense', new.id, new.budget_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS expense_search_delete AFTER DELETE ON budget_expense BEGIN
+        DELETE FROM title_search WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+# PostgreSQL fallback: full-text GIN indexes on the title expressions
+POSTGRES_SEARCH_SETUP = [
+    "CREATE INDEX IF NOT EXISTS ix_purchase_title_fts ON purchase USING gin (to_tsvector('simple', title))",
+    "CREATE INDEX IF NOT EXISTS ix_budget_expense_title_fts ON budget_expense USING gin (to_tsvector('simple', title))",
+]
+
+# Create the search index for the current database (called from app.py after create_all)
+def init_search(app):
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        new_index = dialect == "sqlite" and not inspect(db.engine).has_table("title_search")
+        try:
+            if dialect == "sqlite":
+                statements, backend = SQLITE_SEARCH_SETUP, "fts5"
+            elif dialect == "postgresql":
+                statements, backend = POSTGRES_SEARCH_SETUP, "postgresql"
+            else:
+                statements, backend = [], "like"
+
+            with db.engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(text(statement))
+        except OperationalError:
+            # SQLite built without FTS5: fall back to plain LIKE matching
+            backend = "like"
+        app.config["SEARCH_BACKEND"] = backend
+
+        # Existing databases need their current titles indexed once
+        if backend == "fts5" and new_index:
+            rebuild_search_index()
+
+# Rebuild the search index from the purchase and budget_expense tables
+def rebuild_search_index():
+    backend = current_app.config.get("SEARCH_BACKEND")
+    if backend != "fts5":
+        return 0
+
+    db.session.execute(text("DELETE FROM title_search"))
+    db.session.execute(text(
+        "INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id) "
+        "SELECT id * 2, title, 'purchase', id, budget_id FROM purchase"
+    ))
+    db.session.execute(text(
+        "INSERT INTO title_search(rowid, title, entity_type, entity_id, budget_id) "
+        "SELECT id * 2 + 1, title, 'expense', id, budget_id FROM budget_expense"
+    ))
+    db.session.execute(text("INSERT INTO title_search(title_search) VALUES ('optimize')"))
+    db.session.commit()
+    return db.session.execute(text("SELECT count(*) FROM title_search")).scalar()
+
+# Turn user input into an FTS5 query: every word must match, as a prefix
+def to_fts_query(term):
+    words = [word.replace('"', '""') for word in term.split()]
+    return " ".join(f'"{word}"*' for word in words)
+
+def search_fts5(user_id, term, types, limit, offset):
+    type_filter = ", ".join(f"'{t}'" for t in types)
+    rows = db.session.execute(text(
+        "SELECT title_search.entity_type, title_search.entity_id, title_search.budget_id, title_search.title, title_search.rank "
+        "FROM title_search JOIN budgets ON budgets.id = title_search.budget_id "
+        f"WHERE title_search MATCH :query AND budgets.user_id = :user_id AND budgets.deleted_at IS NULL "
+        f"AND title_search.entity_type IN ({type_filter}) "
+        "ORDER BY title_search.rank LIMIT :limit OFFSET :offset"
+    ), {"query": to_fts_query(term), "user_id": user_id, "limit": limit, "offset": offset}).all()
+    return [(entity_type, int(entity_id), int(budget_id), title, rank) for entity_type, entity_id, budget_id, title, rank in rows]
+
+def search_postgres(user_id, term, types, limit, offset):
+    selects = []
+    if "purchase" in types:
+        selects.append(
+            "SELECT 'purchase' AS entity_type, purchase.id AS entity_id, purchase.budget_id, purchase.title, "
+            "ts_rank(to_tsvector('simple', purchase.title), query) AS rank "
+            "FROM purchase JOIN budgets ON budgets.id = purchase.budget_id, plainto_tsquery('simple', :term) query "
+            "WHERE budgets.user_id = :user_id AND budgets.deleted_at IS NULL AND to_tsvector('simple', purchase.title) @@ query"
+        )
+    if "expense" in types:
+        selects.append(
+            "SELECT 'expense' AS entity_type, budget_expense.id AS entity_id, budget_expense.budget_id, budget_expense.title, "
+            "ts_rank(to_tsvector('simple', budget_expense.title), query) AS rank "
+            "FROM budget_expense JOIN budgets ON budgets.id = budget_expense.budget_id, plainto_tsquery('simple', :term) query "
+            "WHERE budgets.user_id = :user_id AND budgets.deleted_at IS NULL AND to_tsvector('simple', budget_expense.title) @@ query"
+        )
+    rows = db.session.execute(text(
+        " UNION ALL ".join(selects) + " ORDER BY rank DESC LIMIT :limit OFFSET :offset"
+    ), {"term": term, "user_id": user_id, "limit": limit, "offset": offset}).all()
+    return [tuple(row) for row in rows]
+
+# % and _ in the term are literal characters, not LIKE wildcards
+def like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def search_like(user_id, term, types, limit, offset):
+    pattern = like_pattern(term)
+    selects = []
+    for entity_type, model in (("purchase", Purchase), ("expense", BudgetExpense)):
+        if entity_type in types:
+            selects.append(
+                select(literal(entity_type).label("entity_type"), model.id.label("entity_id"), model.budget_id,
+                       model.title, literal(0).label("rank"))
+                .join(Budget, Budget.id == model.budget_id)
+                .where(Budget.user_id == user_id, Budget.deleted_at.is_(None), model.title.ilike(pattern, escape="\\"))
+            )
+    # Ordered so pages stay the same between requests
+    query = union_all(*selects).subquery()
+    rows = db.session.execute(
+        select(query).order_by(query.c.title, query.c.entity_type, query.c.entity_id).limit(limit).offset(offset)
+    ).all()
+    return [tuple(row) for row in rows]
+
+SEARCH_BACKENDS = {
+    "fts5": search_fts5,
+    "postgresql": search_postgres,
+    "like": search_like
+}
+
+# Search a user's purchases and budget expenses by title
+@search_bp.route("/api/users/<int:user_id>/search", methods=["GET"])
+def search_titles(user_id):
+    try:
+        user = Users.query.get(user_id)
+        if user is None:
+            return jsonify({"status":"error", "msg":"User not found"}), 404
+
+        term = request.args.get("q", "").strip()
+        if len(term) == 0:
+            return jsonify({"status":"error", "msg":"Missing search term 'q'"}), 400
+        if len(term) > 100:
+            return jsonify({"status":"error", "msg":"Search term too long"}), 400
+
+        types = SEARCH_TYPES
+        if "type" in request.args:
+            if request.args["type"] not in SEARCH_TYPES:
+                return jsonify({"status":"error", "msg":f"Invalid type. Valid options are: {', '.join(SEARCH_TYPES)}"}), 400
+            types = [request.args["type"]]
+
+        page = request.args.get("page", 1, type=int)
+        per_page = min(request.args.get("per_page", DEFAULT_PER_PAGE, type=int), MAX_PER_PAGE)
+        if page < 1 or per_page < 1:
+            return jsonify({"status":"error", "msg":"'page' and 'per_page' must be positive"}), 400
+
+        search = SEARCH_BACKENDS[current_app.config.get("SEARCH_BACKEND", "like")]
+        # Ask for one extra row to know if there is another page
+        rows = search(user_id, term, types, per_page + 1, (page - 1) * per_page)
+
+        results = [{
+            "type": entity_type,
+            "id": entity_id,
+            "budget_id": budget_id,
+            "title": title
+        } for entity_type, entity_id, budget_id, title, rank in rows[:per_page]]
+
+        return jsonify({
+            "query": term,
+            "page": page,
+            "per_page": per_page,
+            "has_more": len(rows) > per_page,
+            "results": results
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@click.command("rebuild-search")
+@with_appcontext
+def rebuild_search_command():
+    backend = current_app.config.get("SEARCH_BACKEND")
+    if backend != "fts5":
+        click.echo(f"Search backend is '{backend}', nothing to rebuild.")
+        return
+    if not sharding_enabled():
+        count = rebuild_search_index()
+    else:
+        count = 0
+        for shard in shard_ids():
+            with use_shard(shard):
+                count += rebuild_search_index()
+                db.session.remove()
+    click.echo(f"Indexed {count} titles.")
@@ -0,0 +1,264 @@
+# sharding.py by Eden Pardo
+# Optional per-user sharding: every user (and all of their budgets, items and purchases) lives in
+# one of N SQLite files. The main database keeps the user/budget --> shard directory.
+#   DB_SHARDS=4        turn sharding on with 4 shard files (budgetUsers_shard0.db ... _shard3.db)
+# Requests pick their shard from the user_id/budget_id in the route (or the username for
+# create_user/login); CLI code can use `with use_shard(n):`.
+import click
+import os
+import zlib
+from contextlib import contextmanager
+from flask import request, g, current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, text, update, delete, insert
+from sqlalchemy.orm import Mapper
+from models import (Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                    PurchaseRollup, RecurringPurchase, ClientOperation, ChangeTombstone, UserShard, BudgetShard,
+                    ShardSequence, CHANGE_SEQUENCE, USER_MOVED)
+from extensions import db
+
+SHARD_ID_STRIDE = 10 ** 12
+
+# Per-user tables and how to find a user's rows in them, parents first
+USER_TABLES = [(Users, "id"), (InitialIncome, "user_id"), (InitialExpense, "user_id"), (Budget, "user_id"),
+               (ClientOperation, "user_id"), (ChangeTombstone, "user_id")]
+# Ids nothing refers to: moved rows take fresh ids from the target's sequence
+RENUMBERED_TABLES = [PurchaseRollup.__tablename__, ChangeTombstone.__tablename__]
+
+BUDGET_TABLES = [(Category, "budget_id"), (BudgetExpense, "budget_id"), (BudgetIncome, "budget_id"),
+                 (Purchase, "budget_id"), (PurchaseRollup, "budget_id"), (RecurringPurchase, "budget_id")]
+
+def shard_count():
+    return current_app.config.get("DB_SHARDS", 0)
+
+def sharding_enabled():
+    return shard_count() > 1
+
+def shard_ids():
+    return range(shard_count())
+
+# Stable hash so the same username always lands on the same shard
+def hash_shard(username):
+    return zlib.crc32(username.strip().lower().encode("utf-8")) % shard_count()
+
+def sharded_tables():
+    return [table for table in db.metadata.sorted_tables if not table.info.get("global")]
+
+@contextmanager
+def use_shard(shard):
+    previous = g.get("shard")
+    g.shard = shard
+    try:
+        yield
+    finally:
+        g.shard = previous
+
+## Directory lookups use their own short connection so the request never holds a
+# transaction open on the main database just to find its shard
+def lookup_user_shard(user_id):
+    with db.engine.connect() as connection:
+        return connection.execute(select(UserShard.shard).where(UserShard.user_id == user_id)).scalar()
+
+def lookup_username_shard(username):
+    with db.engine.connect() as connection:
+        return connection.execute(select(UserShard.shard).where(UserShard.username == username)).scalar()
+
+def lookup_budget_shard(budget_id):
+    with db.engine.connect() as connection:
+        return connection.execute(select(BudgetShard.shard).where(BudgetShard.budget_id == budget_id)).scalar()
+
+## Directory writes (called from the routes, committed with the rest of the request)
+def register_user(user):
+    if sharding_enabled():
+        db.session.merge(UserShard(user_id=user.id, username=user.username, shard=g.shard))
+
+def register_budget(budget):
+    if sharding_enabled():
+        db.session.merge(BudgetShard(budget_id=budget.id, user_id=budget.user_id, shard=g.shard))
+
+def unregister_user(user_id):
+    if sharding_enabled():
+        db.session.execute(delete(BudgetShard).where(BudgetShard.user_id == user_id))
+        db.session.execute(delete(UserShard).where(UserShard.user_id == user_id))
+
+def unregister_budget(budget_id):
+    if sharding_enabled():
+        db.session.execute(delete(BudgetShard).where(BudgetShard.budget_id == budget_id))
+
+# before_request hook: choose the shard for this request
+def select_shard():
+    view_args = request.view_args or {}
+    shard = None
+    if "user_id" in view_args:
+        shard = lookup_user_shard(view_args["user_id"])
+    elif "budget_id" in view_args:
+        shard = lookup_budget_shard(view_args["budget_id"])
+    elif request.endpoint in ("user.create_user", "user.login"):
+        username = (request.get_json(silent=True) or {}).get("username")
+        if isinstance(username, str) and username.strip():
+            shard = lookup_username_shard(username)
+            if shard is None and request.endpoint == "user.create_user":
+                shard = hash_shard(username)
+
+    # Unknown ids still get a shard so the route can answer with its usual 404
+    g.shard = shard if shard is not None else 0
+
+# Reserve `count` ids for a table in the current shard. Must run inside the shard's write
+# transaction: the UPDATE takes SQLite's write lock before the SELECT reads the new value.
+def reserve_ids(connection, table_name, count=1):
+    connection.execute(
+        update(ShardSequence).where(ShardSequence.name == table_name).values(next_id=ShardSequence.next_id + count)
+    )
+    next_id = connection.execute(select(ShardSequence.next_id).where(ShardSequence.name == table_name)).scalar()
+    return next_id - count
+
+# ORM inserts into a shard take their id from the shard's sequence instead of SQLite's rowid
+def assign_shard_id(mapper, connection, target):
+    if not has_app_context() or g.get("shard") is None or mapper.local_table.info.get("global"):
+        return
+    primary_key = mapper.primary_key[0]
+    if len(mapper.primary_key) != 1 or getattr(target, primary_key.key) is not None:
+        return
+    setattr(target, primary_key.key, reserve_ids(connection, mapper.local_table.name))
+
+# Create the shard files, their tables and id sequences
+def create_shards(app):
+    if not app.config.get("DB_SHARDS", 0) > 1:
+        return
+    from search_routes import SQLITE_SEARCH_SETUP
+    from migrations import (add_missing_columns, add_missing_indexes, add_delete_cascades, backfill_change_sequence,
+                            backfill_purchase_rollups, ROLLUP_MIGRATION)
+
+    with app.app_context():
+        tables = sharded_tables()
+        for shard in shard_ids():
+            engine = db.engines[f"shard_{shard}"]
+            db.metadata.create_all(bind=engine, tables=tables)
+            add_missing_columns(engine)
+            add_missing_indexes(engine)
+            add_delete_cascades(engine)
+            backfill_change_sequence(engine)
+            with engine.begin() as connection:
+                existing = set(connection.execute(select(ShardSequence.name)).scalars())
+                missing = [
+                    {"name": table.name, "next_id": shard * SHARD_ID_STRIDE + 1}
+                    for table in tables if table.name not in existing and table.name != ShardSequence.__tablename__
+                ]
+                if missing:
+                    connection.execute(insert(ShardSequence), missing)
+                if engine.dialect.name == "sqlite" and app.config.get("SEARCH_BACKEND") == "fts5":
+                    for statement in SQLITE_SEARCH_SETUP:
+                        connection.execute(text(statement))
+            with use_shard(shard):
+                backfill_purchase_rollups(f"{ROLLUP_MIGRATION}_shard{shard}")
+                db.session.remove()
+
+# Call before db.init_app(app): registers one bind per shard and the request hook
+def init_sharding(app):
+    app.config.setdefault("DB_SHARDS", int(os.environ.get("DB_SHARDS", 0)))
+    if app.config["DB_SHARDS"] <= 1:
+        return
+
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    for shard in range(app.config["DB_SHARDS"]):
+        binds[f"shard_{shard}"] = f"sqlite:///budgetUsers_shard{shard}.db"
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    app.before_request(select_shard)
+    event.listen(Mapper, "before_insert", assign_shard_id)
+
+# Give the moved rows new change_seqs from the target's change sequence, in their old order.
+# The target's sequence first jumps past the source's, so every cursor the client got from the source
+# is below the new numbers; the USER_MOVED marker makes those cursors answer 410 (sync_routes.py).
+def renumber_changes(source_connection, target_connection, user_id, moved_rows):
+    source_next = source_connection.execute(
+        select(ShardSequence.next_id).where(ShardSequence.name == CHANGE_SEQUENCE)
+    ).scalar() or 1
+    target_connection.execute(
+        update(ShardSequence).where(ShardSequence.name == CHANGE_SEQUENCE, ShardSequence.next_id < source_next)
+        .values(next_id=source_next)
+    )
+    moved_rows.sort(key=lambda row: row["change_seq"])
+    first_seq = reserve_ids(target_connection, CHANGE_SEQUENCE, len(moved_rows) + 1)
+    for offset, row in enumerate(moved_rows, start=1):
+        row["change_seq"] = first_seq + offset
+
+    marker = USER_MOVED.format(user_id)
+    source_connection.execute(delete(ShardSequence).where(ShardSequence.name == marker))
+    target_connection.execute(delete(ShardSequence).where(ShardSequence.name == marker))
+    target_connection.execute(insert(ShardSequence).values(name=marker, next_id=first_seq))
+
+# Copy one user's rows to another shard, update the directory, then delete the old rows
+def move_user(user_id, target_shard):
+    source_shard = lookup_user_shard(user_id)
+    if source_shard is None:
+        raise ValueError(f"User {user_id} is not in the shard directory")
+    if source_shard == target_shard:
+        return False
+
+    source = db.engines[f"shard_{source_shard}"]
+    target = db.engines[f"shard_{target_shard}"]
+
+    with source.begin() as source_connection, target.begin() as target_connection:
+        budget_ids = list(source_connection.execute(select(Budget.id).where(Budget.user_id == user_id)).scalars())
+
+        copies = []
+        for model, column in USER_TABLES:
+            table = model.__table__
+            copies.append((table, table.c[column] == user_id))
+        for model, column in BUDGET_TABLES:
+            table = model.__table__
+            copies.append((table, table.c[column].in_(budget_ids)))
+
+        copied = []
+        for table, condition in copies:
+            rows = [dict(row._mapping) for row in source_connection.execute(select(table).where(condition))]
+            if rows and table.name in RENUMBERED_TABLES:
+                first_id = reserve_ids(target_connection, table.name, len(rows))
+                for offset, row in enumerate(rows):
+                    row["id"] = first_id + offset
+            copied.append((table, rows))
+
+        renumber_changes(source_connection, target_connection, user_id,
+                         [row for table, rows in copied if "change_seq" in table.c for row in rows])
+        for table, rows in copied:
+            if rows:
+                target_connection.execute(insert(table), rows)
+
+        for table, condition in reversed(copies):
+            source_connection.execute(delete(table).where(condition))
+
+        # Directory switch happens last: until here requests still go to the source shard
+        with db.engine.begin() as directory:
+            directory.execute(update(UserShard).where(UserShard.user_id == user_id).values(shard=target_shard))
+            directory.execute(update(BudgetShard).where(BudgetShard.user_id == user_id).values(shard=target_shard))
+    return True
+
+@click.command("rebalance-shards")
+@click.option("--user-id", type=int, default=None, help="Move only this user.")
+@click.option("--to-shard", type=int, default=None, help="Target shard for --user-id (default: its hash shard).")
+@click.option("--dry-run", is_flag=True, help="Only list the moves.")
+@with_appcontext
+def rebalance_shards_command(user_id, to_shard, dry_run):
+    if not sharding_enabled():
+        raise click.UsageError("Sharding is off (set DB_SHARDS to 2 or more).")
+    if to_shard is not None and not 0 <= to_shard < shard_count():
+        raise click.BadParameter(f"--to-shard must be between 0 and {shard_count() - 1}")
+
+    query = db.session.query(UserShard)
+    if user_id is not None:
+        query = query.filter(UserShard.user_id == user_id)
+
+    # Default: move every user whose shard no longer matches the hash (e.g. after changing DB_SHARDS)
+    moves = []
+    for entry in query.all():
+        target_shard = to_shard if to_shard is not None and user_id is not None else hash_shard(entry.username)
+        if entry.shard != target_shard:
+            moves.append((entry.user_id, entry.shard, target_shard))
+    db.session.commit()
+
+    for move_user_id, source_shard, target_shard in moves:
+        click.echo(f"User {move_user_id}: shard {source_shard} -> {target_shard}")
+        if not dry_run:
+            move_user(move_user_id, target_shard)
+    click.echo(f"{len(moves)} user(s) {'to move' if dry_run else 'moved'}.")
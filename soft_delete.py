@@ -0,0 +1,175 @@
+# soft_delete.py by Eden Pardo
+# Deleting a user or budget only sets `deleted_at` and returns right away. Soft-deleted rows are
+# hidden from every ORM query, and a background worker hard-deletes them later in small batches
+# with pauses in between, so no single transaction holds the SQLite write lock for long.
+#   PURGE_WORKER=0                 do not start the background worker (use `flask purge-deleted`)
+#                                  it starts with the first request, so CLI commands never run it
+#   PURGE_INTERVAL_SECONDS=60      how often the worker looks for deleted rows
+#   PURGE_BATCH_SIZE=500           rows deleted per transaction
+#   PURGE_PAUSE_SECONDS=0.05       pause between batches
+import click
+import os
+import threading
+import time
+from datetime import datetime
+from flask import request, jsonify, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, delete, update
+from sqlalchemy.orm import with_loader_criteria
+from models import (Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                    PurchaseRollup, RecurringPurchase, ClientOperation)
+from extensions import db, RoutingSession
+
+SOFT_DELETE_MODELS = [Users, Budget]
+
+# What the purge removes, children before parents so the database cascade has nothing left to do
+# (that keeps each DELETE to one batch). Purchases go before expenses and expenses before categories
+# so the ON DELETE SET NULL updates never fire.
+BUDGET_CHILDREN = [Purchase, PurchaseRollup, RecurringPurchase, BudgetExpense, BudgetIncome, Category]
+USER_CHILDREN = [InitialIncome, InitialExpense, ClientOperation]
+
+DEFAULT_INTERVAL_SECONDS = 60
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PAUSE_SECONDS = 0.05
+
+# Global criteria: every ORM SELECT skips soft-deleted users and budgets (including joins and
+# relationship loads). Pass .execution_options(include_deleted=True) to see them.
+@event.listens_for(RoutingSession, "do_orm_execute")
+def hide_soft_deleted(execute_state):
+    if (
+        execute_state.is_select
+        and not execute_state.is_column_load
+        and not execute_state.is_relationship_load
+        and not execute_state.execution_options.get("include_deleted", False)
+    ):
+        execute_state.statement = execute_state.statement.options(*[
+            with_loader_criteria(model, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+            for model in SOFT_DELETE_MODELS
+        ])
+
+## Called from the delete routes. Does not commit.
+def soft_delete_budget(budget):
+    budget.deleted_at = datetime.utcnow()
+
+def soft_delete_user(user):
+    now = datetime.utcnow()
+    user.deleted_at = now
+    # Budgets are reachable without the user in the URL, so they are hidden right away too
+    db.session.execute(
+        update(Budget).where(Budget.user_id == user.id, Budget.deleted_at.is_(None)).values(deleted_at=now),
+        execution_options={"synchronize_session": False}
+    )
+
+# before_request hook: routes that look up children by budget/user id alone (purchases, items,
+# categories) answer 404 for soft-deleted parents instead of showing rows waiting to be purged
+def hide_deleted_parents():
+    view_args = request.view_args or {}
+    checks = [(Budget, view_args.get("budget_id")), (Users, view_args.get("user_id"))]
+    for model, entity_id in checks:
+        if entity_id is None:
+            continue
+        deleted = db.session.execute(
+            select(model.id).where(model.id == entity_id, model.deleted_at.is_not(None)),
+            execution_options={"include_deleted": True}
+        ).first()
+        if deleted is not None:
+            response = jsonify({"status": "error", "msg": f"{'Budget' if model is Budget else 'User'} not found"})
+            response.status_code = 404
+            return response
+    return None
+
+def purge_engines():
+    shards = current_app.config.get("DB_SHARDS", 0)
+    if shards > 1:
+        return [db.engines[f"shard_{shard}"] for shard in range(shards)]
+    return [db.engine]
+
+# Delete up to batch_size rows of `model` matching `condition` in one short transaction
+def delete_batch(engine, model, condition, batch_size):
+    table = model.__table__
+    batch = select(table.c.id).where(condition).limit(batch_size)
+    with engine.begin() as connection:
+        return connection.execute(delete(table).where(table.c.id.in_(batch))).rowcount
+
+def purge_deleted(batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE_SECONDS):
+    budgets, users = Budget.__table__, Users.__table__
+    deleted_budgets = select(budgets.c.id).where(budgets.c.deleted_at.is_not(None))
+    deleted_users = select(users.c.id).where(users.c.deleted_at.is_not(None))
+
+    steps = [(model, model.__table__.c.budget_id.in_(deleted_budgets)) for model in BUDGET_CHILDREN]
+    steps.append((Budget, budgets.c.deleted_at.is_not(None)))
+    steps += [(model, model.__table__.c.user_id.in_(deleted_users)) for model in USER_CHILDREN]
+    # A user goes last, once none of its budgets are left
+    steps.append((Users, users.c.deleted_at.is_not(None) & users.c.id.not_in(select(budgets.c.user_id))))
+
+    purged = {}
+    for engine in purge_engines():
+        for model, condition in steps:
+            while True:
+                count = delete_batch(engine, model, condition, batch_size)
+                if count:
+                    purged[model.__tablename__] = purged.get(model.__tablename__, 0) + count
+                if count < batch_size:
+                    break
+                time.sleep(pause) # Let request transactions take the write lock in between
+    return purged
+
+class PurgeWorker:
+    def __init__(self, app):
+        self.app = app
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.thread = threading.Thread(target=self.run, name="purge-worker", daemon=True)
+
+    # before_request hook: only a process that serves requests runs the worker (not the CLI,
+    # nor the reloader's parent process)
+    def start(self):
+        if self.started:
+            return
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.thread.start()
+
+    # Purge soon after a delete instead of waiting for the next interval
+    def notify(self):
+        self.wake.set()
+
+    def run(self):
+        config = self.app.config
+        while True:
+            self.wake.wait(config["PURGE_INTERVAL_SECONDS"])
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    purge_deleted(config["PURGE_BATCH_SIZE"], config["PURGE_PAUSE_SECONDS"])
+            except Exception as e:
+                self.app.logger.warning(f"Purge of deleted users/budgets failed: {e}")
+
+def request_purge():
+    worker = current_app.extensions.get("purge_worker")
+    if worker is not None:
+        worker.notify()
+
+# Call after init_sharding so the request hook runs once the shard is chosen
+def init_soft_delete(app):
+    app.config.setdefault("PURGE_WORKER", os.environ.get("PURGE_WORKER", "1") != "0")
+    app.config.setdefault("PURGE_INTERVAL_SECONDS", float(os.environ.get("PURGE_INTERVAL_SECONDS", DEFAULT_INTERVAL_SECONDS)))
+    app.config.setdefault("PURGE_BATCH_SIZE", int(os.environ.get("PURGE_BATCH_SIZE", DEFAULT_BATCH_SIZE)))
+    app.config.setdefault("PURGE_PAUSE_SECONDS", float(os.environ.get("PURGE_PAUSE_SECONDS", DEFAULT_PAUSE_SECONDS)))
+    if app.config["PURGE_WORKER"]:
+        worker = app.extensions["purge_worker"] = PurgeWorker(app)
+        app.before_request(worker.start)
+    app.before_request(hide_deleted_parents)
+
+@click.command("purge-deleted")
+@click.option("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows deleted per transaction.")
+@click.option("--pause", type=float, default=DEFAULT_PAUSE_SECONDS, help="Seconds to wait between batches.")
+@with_appcontext
+def purge_deleted_command(batch_size, pause):
+    purged = purge_deleted(batch_size, pause)
+    if not purged:
+        click.echo("Nothing to purge.")
+    for table, count in purged.items():
+        click.echo(f"{table}: {count} rows deleted")
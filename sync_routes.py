@@ -0,0 +1,268 @@
+# sync_routes.py by Eden Pardo
+# Delta sync: GET /api/users/<id>/sync?since=<cursor> returns only the rows that changed after the
+# cursor, oldest first and paginated, so clients stop refetching whole budgets.
+# Every synced table has a change_seq column. Each flush takes numbers from the database's change
+# sequence (a ShardSequence row) for the rows it inserts or updates; deletes leave a ChangeTombstone
+# with their own number. The sequence row stays locked until the commit, so numbers become visible
+# in order and a cursor never skips a change that commits later.
+#   SYNC_PAGE_SIZE=500    changes per page (clients may ask for up to 1000)
+#   flask prune-tombstones --days 90    drop old tombstones; older cursors get 410 and must resync
+# Moving a user to another shard renumbers their rows, so their older cursors get 410 as well.
+import click
+import os
+from datetime import date, datetime, timedelta
+from flask import Blueprint, request, jsonify, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, update, delete, func, bindparam, inspect
+from models import (Users, InitialIncome, InitialExpense, Budget, BudgetExpense, BudgetIncome, Category, Purchase,
+                    RecurringPurchase, ChangeTombstone, ShardSequence, CHANGE_SEQUENCE, TOMBSTONES_PRUNED,
+                    USER_MOVED)
+from money import Money, format_money
+from extensions import db, RoutingSession
+from sharding import sharding_enabled, shard_ids, use_shard
+
+sync_bp = Blueprint('sync', __name__)
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+DEFAULT_TOMBSTONE_DAYS = 90
+
+# Entity name sent to clients for each synced model
+SYNC_ENTITIES = {
+    Users: "user",
+    InitialIncome: "initial_income",
+    InitialExpense: "initial_expense",
+    Budget: "budget",
+    BudgetExpense: "budget_expense",
+    BudgetIncome: "budget_income",
+    Category: "category",
+    Purchase: "purchase",
+    RecurringPurchase: "recurring_purchase",
+}
+
+# Never sent to clients
+EXCLUDED_COLUMNS = {"password"}
+
+# Changing one of these also changes its budget's row (items_version, unassigned_amount)
+BUDGET_ITEM_MODELS = (Category, BudgetIncome, BudgetExpense)
+
+# Rows the database changes when a parent is deleted: ON DELETE SET NULL rows count as updated,
+# ON DELETE CASCADE rows as deleted
+DELETE_DEPENDENTS = {
+    Category: [(BudgetExpense, "category_id", "updated")],
+    BudgetExpense: [(Purchase, "budget_expense_id", "updated"), (RecurringPurchase, "budget_expense_id", "deleted")],
+}
+
+# Take `count` numbers from the change sequence, returns the first. Runs inside the flush's transaction.
+def reserve_change_seqs(session, count):
+    sequence = ShardSequence.__table__
+    bind_arguments = {"mapper": ShardSequence.__mapper__}
+    session.execute(
+        update(sequence).where(sequence.c.name == CHANGE_SEQUENCE).values(next_id=sequence.c.next_id + count),
+        bind_arguments=bind_arguments
+    )
+    next_seq = session.execute(
+        select(sequence.c.next_id).where(sequence.c.name == CHANGE_SEQUENCE), bind_arguments=bind_arguments
+    ).scalar()
+    return next_seq - count
+
+def owner_id(obj):
+    if isinstance(obj, Users):
+        return obj.id
+    return getattr(obj, "user_id", None)
+
+def soft_deleted_now(obj):
+    return isinstance(obj, Budget) and obj.deleted_at is not None and inspect(obj).attrs.deleted_at.history.added
+
+@event.listens_for(RoutingSession, "before_flush")
+def assign_change_seqs(session, flush_context, instances):
+    changed = [
+        obj for obj in (*session.new, *session.dirty)
+        if type(obj) in SYNC_ENTITIES and (obj in session.new or session.is_modified(obj))
+    ]
+    # (entity, id, budget_id, user_id) of every row that goes away
+    removed = [
+        (SYNC_ENTITIES[type(obj)], obj.id, obj.id if isinstance(obj, Budget) else getattr(obj, "budget_id", None), owner_id(obj))
+        for obj in session.deleted if type(obj) in SYNC_ENTITIES
+    ]
+    # Soft-deleted budgets disappear for clients right away (the purge removes them later)
+    removed += [("budget", obj.id, obj.id, obj.user_id) for obj in changed if soft_deleted_now(obj)]
+
+    # Rows changed by the database itself when their parent is deleted
+    dependent_updates = []
+    for model, dependents in DELETE_DEPENDENTS.items():
+        parent_ids = [obj.id for obj in session.deleted if isinstance(obj, model)]
+        if not parent_ids:
+            continue
+        for dependent, column, change in dependents:
+            rows = session.execute(
+                select(dependent.id, dependent.budget_id).where(getattr(dependent, column).in_(parent_ids))
+            ).all()
+            if change == "deleted":
+                removed += [(SYNC_ENTITIES[dependent], row_id, budget_id, None) for row_id, budget_id in rows]
+            else:
+                dependent_updates += [(dependent, row_id) for row_id, budget_id in rows]
+
+    changed_budgets = {obj.id for obj in changed if isinstance(obj, Budget)}
+    dependent_updates += [(Budget, budget_id) for budget_id in {
+        obj.budget_id for obj in (*changed, *session.deleted) if isinstance(obj, BUDGET_ITEM_MODELS)
+    } - changed_budgets if budget_id is not None]
+
+    count = len(changed) + len(removed) + len(dependent_updates)
+    if not count:
+        return
+    next_seq = reserve_change_seqs(session, count)
+
+    for obj in changed:
+        obj.change_seq = next_seq
+        next_seq += 1
+
+    for dependent in {model for model, row_id in dependent_updates}:
+        rows = [{"row_id": row_id} for model, row_id in dependent_updates if model is dependent]
+        for row in rows:
+            row["seq"] = next_seq
+            next_seq += 1
+        table = dependent.__table__
+        session.execute(
+            update(table).where(table.c.id == bindparam("row_id")).values(change_seq=bindparam("seq")),
+            rows, bind_arguments={"mapper": dependent.__mapper__}
+        )
+
+    # Budget children only know their budget: look the owners up in one query
+    budget_ids = {budget_id for entity, row_id, budget_id, user_id in removed if user_id is None and budget_id is not None}
+    owners = {}
+    if budget_ids:
+        owners = dict(session.execute(
+            select(Budget.id, Budget.user_id).where(Budget.id.in_(budget_ids)),
+            execution_options={"include_deleted": True}
+        ).all())
+    for entity, row_id, budget_id, user_id in removed:
+        session.add(ChangeTombstone(
+            change_seq=next_seq,
+            entity=entity,
+            entity_id=row_id,
+            budget_id=budget_id,
+            user_id=user_id if user_id is not None else owners.get(budget_id)
+        ))
+        next_seq += 1
+
+# Plain column values (no nested lists), money as decimal strings and dates in ISO format
+def sync_json(obj):
+    data = {}
+    for column in obj.__table__.columns:
+        if column.key in EXCLUDED_COLUMNS:
+            continue
+        value = getattr(obj, column.key)
+        if isinstance(column.type, Money):
+            value = format_money(value)
+        elif isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        data[column.key] = value
+    return data
+
+# Rows of one user in each synced table
+def owner_filters(user_id):
+    user_budgets = select(Budget.id).where(Budget.user_id == user_id)
+    return {
+        Users: Users.id == user_id,
+        InitialIncome: InitialIncome.user_id == user_id,
+        InitialExpense: InitialExpense.user_id == user_id,
+        Budget: Budget.user_id == user_id,
+        BudgetExpense: BudgetExpense.budget_id.in_(user_budgets),
+        BudgetIncome: BudgetIncome.budget_id.in_(user_budgets),
+        Category: Category.budget_id.in_(user_budgets),
+        Purchase: Purchase.budget_id.in_(user_budgets),
+        RecurringPurchase: RecurringPurchase.budget_id.in_(user_budgets),
+    }
+
+def pruned_through():
+    return db.session.query(ShardSequence.next_id).filter(ShardSequence.name == TOMBSTONES_PRUNED).scalar() or 0
+
+# First change_seq of the user on this shard if they were moved here (older cursors came from another shard)
+def moved_at(user_id):
+    return db.session.query(ShardSequence.next_id).filter(ShardSequence.name == USER_MOVED.format(user_id)).scalar() or 0
+
+# Changes after `since` for a user, oldest first. Each table returns at most limit + 1 rows in
+# change_seq order, so the first `limit` of their union is exactly the next page.
+def user_changes(user_id, since, limit):
+    candidates = []
+    for model, condition in owner_filters(user_id).items():
+        rows = model.query.filter(condition, model.change_seq > since).order_by(model.change_seq).limit(limit + 1).all()
+        candidates += [(row.change_seq, SYNC_ENTITIES[model], row) for row in rows]
+    tombstones = ChangeTombstone.query.filter(
+        ChangeTombstone.user_id == user_id, ChangeTombstone.change_seq > since
+    ).order_by(ChangeTombstone.change_seq).limit(limit + 1).all()
+    candidates += [(tombstone.change_seq, tombstone.entity, tombstone) for tombstone in tombstones]
+
+    candidates.sort(key=lambda candidate: candidate[0])
+    page = candidates[:limit]
+    changes = []
+    for change_seq, entity, row in page:
+        if isinstance(row, ChangeTombstone):
+            changes.append({"entity": entity, "op": "delete", "id": row.entity_id, "budget_id": row.budget_id, "change_seq": change_seq})
+        else:
+            changes.append({"entity": entity, "op": "upsert", "id": row.id, "change_seq": change_seq, "data": sync_json(row)})
+    return changes, len(candidates) > limit
+
+@sync_bp.route("/api/users/<int:user_id>/sync", methods=["GET"])
+def sync_user(user_id):
+    try:
+        user = Users.query.get(user_id)
+        if not user:
+            return jsonify({"status": "error", "msg": "User not found"}), 404
+
+        since = request.args.get("since", 0, type=int)
+        limit = request.args.get("limit", current_app.config["SYNC_PAGE_SIZE"], type=int)
+        if since < 0:
+            return jsonify({"status": "error", "msg": "since must be a cursor returned by this endpoint"}), 400
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"status": "error", "msg": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+        if 0 < since < max(pruned_through(), moved_at(user_id)):
+            return jsonify({
+                "status": "error",
+                "msg": "This cursor is too old. Sync again from since=0.",
+                "reset": True
+            }), 410
+
+        changes, has_more = user_changes(user_id, since, limit)
+        return jsonify({
+            "since": since,
+            "cursor": changes[-1]["change_seq"] if changes else since,
+            "has_more": has_more,
+            "changes": changes
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def init_sync(app):
+    app.config.setdefault("SYNC_PAGE_SIZE", int(os.environ.get("SYNC_PAGE_SIZE", DEFAULT_PAGE_SIZE)))
+
+# Delete tombstones older than `days` and remember the highest change_seq removed
+def prune_tombstones(days):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    highest = db.session.query(func.max(ChangeTombstone.change_seq)).filter(ChangeTombstone.deleted_at < cutoff).scalar()
+    if highest is None:
+        return 0
+    count = db.session.execute(delete(ChangeTombstone).where(ChangeTombstone.change_seq <= highest)).rowcount
+    marker = db.session.get(ShardSequence, TOMBSTONES_PRUNED)
+    if marker is None:
+        db.session.add(ShardSequence(name=TOMBSTONES_PRUNED, next_id=highest))
+    else:
+        marker.next_id = max(marker.next_id, highest)
+    db.session.commit()
+    return count
+
+@click.command("prune-tombstones")
+@click.option("--days", type=int, default=DEFAULT_TOMBSTONE_DAYS, show_default=True, help="Keep tombstones this many days.")
+@with_appcontext
+def prune_tombstones_command(days):
+    if not sharding_enabled():
+        count = prune_tombstones(days)
+    else:
+        count = 0
+        for shard in shard_ids():
+            with use_shard(shard):
+                count += prune_tombstones(days)
+                db.session.remove()
+    click.echo(f"Pruned {count} tombstones.")
@@ -1,28 +1,49 @@
 # user_routes.py by Eden Pardo
 from flask import Blueprint, request, jsonify
 from models import Users
+from sqlalchemy.exc import IntegrityError
+from sharding import sharding_enabled, shard_ids, use_shard, register_user, unregister_user, lookup_username_shard
+from soft_delete import soft_delete_user, request_purge
+from read_paths import USERS, USER_COLLECTIONS, sparse_fieldset, users_json, user_json
 from extensions import db
 from bcrypt import hashpw, gensalt, checkpw
 
 user_bp = Blueprint("user", __name__)
 
-# Get all users
+# Get all users (?fields= and ?include=initial_incomes,initial_expenses, see read_paths.sparse_fieldset)
 @user_bp.route("/api/users", methods = ["GET"])
 def get_users():
-    users = Users.query.all()
-    result = [user.to_json() for user in users]
+    try:
+        keys, include = sparse_fieldset(USERS, USER_COLLECTIONS)
+    except ValueError as e:
+        return jsonify({"status": "error", "msg": str(e)}), 400
+
+    if sharding_enabled():
+        # Users are spread over the shards: collect them from each one
+        result = []
+        for shard in shard_ids():
+            with use_shard(shard):
+                result += users_json(keys, include)
+        return jsonify(result), 200
+
+    result = users_json(keys, include)
     # [ {...}, {...}, {...}] What we are story in the result var
     return jsonify(result), 200
 
 # Get specific user
 @user_bp.route("/api/users/<int:user_id>", methods = ["GET"])
 def get_specific_user(user_id):
+        try:
+            keys, include = sparse_fieldset(USERS, USER_COLLECTIONS)
+        except ValueError as e:
+            return jsonify({"status": "error", "msg": str(e)}), 400
+
         user = Users.query.get(user_id)
 
         if user is None:
             return jsonify({"status":"error", "msg": "User not found"}), 404
         
-        return jsonify(user.to_json()), 200
+        return jsonify(user_json(user_id, keys, include)), 200
 
 # Create a user
 @user_bp.route("/api/users", methods=["POST"]) # 'POST' corresponds to an official method: As seen in POSTMAN Collections
@@ -65,6 +86,8 @@ def create_user():
                             )  # Store the hashed password as a string
         # Add to database session. Will not immediately add, need to commit
         db.session.add(new_user)
+        db.session.flush() # Get the new user ID for the shard directory
+        register_user(new_user)
         db.session.commit()
         return jsonify({"msg":"User created successfully", "new_user": new_user.to_json()}), 201
 
@@ -79,10 +102,18 @@ def delete_user(user_id):
         user = Users.query.get(user_id)
         if user is None:
             return jsonify({"status":"error", "msg":"User not found"}), 404
-        
-        db.session.delete(user)
+
+        # Serializing the user loads all of its items: only do it when asked (?return_deleted=true)
+        deleted_user_data = {"id": user_id}
+        if request.args.get("return_deleted", "").lower() == "true":
+            deleted_user_data = user.to_json()
+
+        # Soft delete: the user and its budgets disappear now, the purge worker removes the rows later
+        soft_delete_user(user)
+        unregister_user(user_id)
         db.session.commit()
-        return jsonify({"msg":"User deleted successfully", "deleted_user":user.to_json()}), 200
+        request_purge()
+        return jsonify({"msg":"User deleted successfully", "deleted_user":deleted_user_data}), 200
     
     except Exception as e:
         # Rollback to previous state b/c something unexpected happened
@@ -106,7 +137,8 @@ def update_user(user_id):
         new_username = data.get("username")
         if new_username and (new_username != user.username): # if new username exists and it does not equal old username...
             existing_user = Users.query.filter_by(username=new_username).first()
-            if existing_user:
+            # With sharding the username may belong to a user on another shard: ask the directory
+            if existing_user or (sharding_enabled() and lookup_username_shard(new_username) is not None):
                 return jsonify({"status":"error", "msg": "Username already taken"}), 400
             check_username = new_username.strip()
             if len(check_username) == 0:
@@ -114,6 +146,7 @@ def update_user(user_id):
             if len(check_username) > 100:
                 return jsonify({"status": "error", "msg": "Username too long"}), 400
             user.username = new_username
+            register_user(user) # Keep the shard directory's username in sync
 
         # Check if password is being updated and length requirement fulfilled
         new_password = data.get("password")
@@ -125,6 +158,10 @@ def update_user(user_id):
         db.session.commit() # Can immediately commit b/c we have updated fields directly
         return jsonify({"msg":"User updated successfully", "updated_user":user.to_json()}), 200
     
+    except IntegrityError:
+        # Taken by a concurrent request between the check and the commit
+        db.session.rollback()
+        return jsonify({"status":"error", "msg": "Username already taken"}), 400
     except Exception as e:
         # Rollback to previous state b/c something unexpected happened
         db.session.rollback()
@@ -1,9 +1,21 @@
 # utils.py by Eden Pardo
 from constants import VALID_PERIODS
+from money import to_money
 
 # Helper function to convert amounts to weekly equivalent
 def normalize_to_weekly(amount, frequency, periods):
-    frequency.lower()
+    frequency = frequency.lower()
     if frequency not in periods:
         raise ValueError(f"Invalid frequency: {frequency}")
-    return amount / periods[frequency]
\ No newline at end of file
+    return to_money(amount) / periods[frequency]
+
+# Convert an amount from one frequency to another, rounding to cents only once
+# (going through a rounded weekly amount drifts, e.g. yearly->monthly)
+def convert_frequency(amount, frequency, target_frequency, periods):
+    frequency = frequency.lower()
+    target_frequency = target_frequency.lower()
+    if frequency not in periods:
+        raise ValueError(f"Invalid frequency: {frequency}")
+    if target_frequency not in periods:
+        raise ValueError(f"Invalid frequency: {target_frequency}")
+    return to_money(to_money(amount) * periods[target_frequency] / periods[frequency])
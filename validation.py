@@ -0,0 +1,64 @@
+# validation.py by Eden Pardo
+# Field checks shared by the budget item routes and the operation log (oplog_routes.py).
+# Each check raises ValueError with the message the API answers with (400).
+from datetime import datetime, time, timezone
+from constants import VALID_FREQUENCIES, VALID_PERIODS
+from utils import convert_frequency
+from money import to_money
+
+def require(data, fields):
+    missing = [field for field in fields if field not in data]
+    if missing:
+        raise ValueError(f"Missing required field: {', '.join(missing)}")
+
+def checked_title(title, max_length=100):
+    if not isinstance(title, str):
+        raise ValueError("Title must be text")
+    title = title.strip()
+    if len(title) == 0:
+        raise ValueError("Title cannot be empty")
+    if len(title) > max_length:
+        raise ValueError(f"Title too long (max {max_length} chars)")
+    return title
+
+# null is not an amount, and NaN and Infinity parse as Decimal but cannot be compared or stored
+def checked_amount(value, label="Amount"):
+    try:
+        amount = to_money(value)
+        if amount is None or not amount.is_finite():
+            raise ValueError
+    except (ArithmeticError, ValueError, TypeError):
+        raise ValueError(f"{label} must be a number")
+    if amount < 0:
+        raise ValueError(f"{label} cannot be negative")
+    return amount
+
+def checked_frequency(value):
+    if not isinstance(value, str) or value.lower() not in VALID_FREQUENCIES:
+        raise ValueError("Frequency must be 'weekly', 'biweekly', 'monthly', or 'yearly'")
+    return value.lower()
+
+# Item amounts are stored per budget period: (amount, frequency) converted to it
+def per_budget_period(amount, frequency, budget):
+    budget_period = budget.period.lower()
+    if frequency != budget_period:
+        return convert_frequency(amount, frequency, budget_period, VALID_PERIODS), budget_period
+    return amount, frequency
+
+# Optional timestamp (None stays None), as naive UTC
+def parse_timestamp(value, label):
+    if value is None:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{label} must be an ISO 8601 date or timestamp")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+# Purchase date (midnight of the day). Unlike parse_timestamp, null is rejected: it would clear the date.
+def checked_date(value, label="date"):
+    if value is None:
+        raise ValueError(f"{label} must be an ISO 8601 date or timestamp")
+    return datetime.combine(parse_timestamp(value, label).date(), time())
@@ -1,8 +1,192 @@
 # zerobased_budget_routes.py by Eden Pardo
+# Zero-based budgets: every dollar of income is assigned to a category. Budget.unassigned_amount
+# (income minus category allocations) is kept current incrementally: each flush that adds, changes
+# or deletes an income or a category applies the difference with one atomic UPDATE, so it is never
+# recomputed from all rows. Zero-based budgets may never allocate more than their income.
 from flask import Blueprint, request, jsonify
-from models import Users, Budget, InitialExpense, InitialIncome, BudgetExpense, BudgetIncome
-from extensions import db
-from copy import deepcopy
-from base_budget_routes import* 
+from sqlalchemy import event, inspect, update
+from models import Budget, BudgetIncome, Category
+from extensions import db, RoutingSession
+from money import to_money, format_money
+from purchase_rollups import category_totals
+from validation import checked_amount
 
-zerobased_budget_bp = Blueprint("budget", __name__)
\ No newline at end of file
+# Change in an amount attribute caused by this flush (new rows count fully, deleted rows negatively)
+def amount_delta(session, obj, attribute):
+    if obj in session.new:
+        return getattr(obj, attribute) or 0
+    if obj in session.deleted:
+        return -(getattr(obj, attribute) or 0)
+    history = inspect(obj).attrs[attribute].history
+    if not history.added or not history.deleted:
+        return 0
+    return (history.added[0] or 0) - (history.deleted[0] or 0)
+
+@event.listens_for(RoutingSession, "after_flush")
+def apply_unassigned_deltas(session, flush_context):
+    deltas = {}
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, BudgetIncome):
+            delta = amount_delta(session, obj, "amount")
+        elif isinstance(obj, Category):
+            delta = -amount_delta(session, obj, "allocated_amount")
+        else:
+            continue
+        if delta and obj.budget_id is not None:
+            deltas[obj.budget_id] = deltas.get(obj.budget_id, 0) + delta
+
+    for budget_id, delta in deltas.items():
+        if not delta:
+            continue
+        session.execute(
+            update(Budget).where(Budget.id == budget_id).values(unassigned_amount=Budget.unassigned_amount + delta),
+            execution_options={"synchronize_session": False}
+        )
+        budget = session.identity_map.get(session.identity_key(Budget, budget_id))
+        if budget is not None:
+            session.expire(budget, ["unassigned_amount"])
+
+# Current unassigned amount, read after flushing pending changes
+def unassigned_amount(budget_id):
+    db.session.flush()
+    return db.session.query(Budget.unassigned_amount).filter(Budget.id == budget_id).scalar() or 0
+
+# Error response if the budget's allocations now exceed its income, otherwise None.
+# Call before committing; the caller rolls back on an error.
+def check_zero_based_allocations(budget_id):
+    unassigned = unassigned_amount(budget_id)
+    if unassigned < 0:
+        return {
+            "status": "error",
+            "msg": f"Allocations exceed income by ${-unassigned:.2f}. Zero-based budgets cannot allocate more than their income."
+        }, 400
+    return None
+
+def zero_based_calculation(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return {"status": "error", "msg": "Budget not found"}, 404
+
+        categories = Category.query.filter_by(budget_id=budget_id).order_by(Category.priority, Category.id).all()
+        spent_by_category = category_totals(budget_id)
+        unassigned = budget.unassigned_amount
+
+        recommendations = []
+        if unassigned > 0:
+            recommendations.append(f"${unassigned:.2f} of income is not assigned yet. Give every dollar a job.")
+        for category in categories:
+            spent = spent_by_category.get(category.id, 0)
+            if spent > category.allocated_amount:
+                recommendations.append(
+                    f"Overspending detected: '{category.title}' is overspent by ${spent - category.allocated_amount:.2f}. Move money from another category."
+                )
+        if not recommendations:
+            recommendations.append("Nice! Every dollar is assigned.")
+
+        return {
+            "status": "balanced" if unassigned == 0 else "unbalanced",
+            "unassigned_amount": format_money(unassigned),
+            "total_allocated": format_money(sum(category.allocated_amount for category in categories)),
+            "categories": [{
+                "id": category.id,
+                "title": category.title,
+                "allocated_amount": format_money(category.allocated_amount),
+                "spent": format_money(spent_by_category.get(category.id, 0)),
+                "available": format_money(category.allocated_amount - spent_by_category.get(category.id, 0))
+            } for category in categories],
+            "recommendations": recommendations
+        }, 200
+
+    except Exception as e:
+        return {"status": "error", "msg": str(e)}, 500
+
+zerobased_budget_bp = Blueprint("zero_based", __name__)
+
+# Unassigned amount and per-category allocations/spending
+@zerobased_budget_bp.route("/api/budgets/<int:budget_id>/zero-based", methods=["GET"])
+def get_zero_based_budget(budget_id):
+    budget = Budget.query.get(budget_id)
+    if not budget:
+        return jsonify({"status": "error", "msg": "Budget not found"}), 404
+    if budget.method.lower() != "zero-based":
+        return jsonify({"status": "error", "msg": "Budget does not use the zero-based method."}), 400
+
+    result, status = zero_based_calculation(budget_id)
+    return jsonify(result), status
+
+# Move allocated money between categories in one transaction.
+# Body: {"moves": [{"from_category_id": 1, "to_category_id": 2, "amount": 50}, ...]}
+# A null from/to category means the unassigned pool.
+@zerobased_budget_bp.route("/api/budgets/<int:budget_id>/zero-based/reassign", methods=["POST"])
+def reassign_allocations(budget_id):
+    try:
+        budget = Budget.query.get(budget_id)
+        if not budget:
+            return jsonify({"status": "error", "msg": "Budget not found"}), 404
+        if budget.method.lower() != "zero-based":
+            return jsonify({"status": "error", "msg": "Budget does not use the zero-based method."}), 400
+
+        moves = (request.json or {}).get("moves")
+        if not isinstance(moves, list) or not moves:
+            return jsonify({"status": "error", "msg": "Missing required field: moves"}), 400
+
+        # Validate every move before changing anything
+        parsed_moves = []
+        for index, move in enumerate(moves):
+            if not isinstance(move, dict) or "amount" not in move:
+                return jsonify({"status": "error", "msg": f"Move {index}: missing amount"}), 400
+            amount = checked_amount(move["amount"], f"Move {index}: amount")
+            if amount <= 0:
+                return jsonify({"status": "error", "msg": f"Move {index}: amount must be positive"}), 400
+
+            source_id, target_id = move.get("from_category_id"), move.get("to_category_id")
+            if source_id is None and target_id is None:
+                return jsonify({"status": "error", "msg": f"Move {index}: needs from_category_id or to_category_id"}), 400
+            for category_id in (source_id, target_id):
+                if category_id is not None and (not isinstance(category_id, int) or isinstance(category_id, bool)):
+                    return jsonify({"status": "error", "msg": f"Move {index}: category ids must be numbers"}), 400
+            parsed_moves.append((index, source_id, target_id, amount))
+
+        category_ids = {category_id for _, source_id, target_id, _ in parsed_moves
+                        for category_id in (source_id, target_id)} - {None}
+        categories = {c.id: c for c in Category.query.filter(
+            Category.budget_id == budget_id, Category.id.in_(category_ids)
+        ).all()}
+        for position, (index, source_id, target_id, amount) in enumerate(parsed_moves):
+            for category_id in (source_id, target_id):
+                if category_id is not None and category_id not in categories:
+                    return jsonify({"status": "error", "msg": f"Move {index}: category {category_id} not found in this budget"}), 404
+            parsed_moves[position] = (index, categories.get(source_id), categories.get(target_id), amount)
+
+        # Apply them in order; a category can pass on money it received in an earlier move
+        for index, source, target, amount in parsed_moves:
+            if source is not None:
+                if source.allocated_amount < amount:
+                    db.session.rollback()
+                    return jsonify({
+                        "status": "error",
+                        "msg": f"Move {index}: '{source.title}' only has ${source.allocated_amount:.2f} allocated."
+                    }), 400
+                source.allocated_amount -= amount
+            if target is not None:
+                target.allocated_amount += amount
+
+        error = check_zero_based_allocations(budget_id)
+        if error:
+            db.session.rollback()
+            return jsonify(error[0]), error[1]
+        db.session.commit()
+
+        recalculation, status = zero_based_calculation(budget_id)
+        return jsonify({
+            "msg": "Allocations reassigned successfully",
+            "recalculation": recalculation
+        }), status
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "msg": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500